@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import hashlib
+import argparse
+import pathlib
+import sys
+import re
+
+from nao_projection import area_selection, log_pressure_interpolation
+from nao_calculation import projection
+import pattern_cache
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import paths
+from anomalies import load_climatology, subtract_climatology
+
+
+# areas of the indices (as in nao_calculation.py), and the two latitudes
+# whose difference of the zonal mean EOF pattern sets the sign convention
+indices = {
+    'nao' : dict(area=dict(lat=slice(80,20),lon=slice(-90,40)), sign_lats=(35,70)), # Hurrel based definition
+    'nam' : dict(area=dict(lat=slice(90,20)), sign_lats=(35,70)),
+    'sam' : dict(area=dict(lat=slice(-20,-90)), sign_lats=(-35,-70)),
+}
+
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index',type=str,default='nao',choices=indices,help='index to compute')
+    parser.add_argument('--eof',type=str,default='./reanalysis_Z_winter_nao.nc',help='file with the EOF pattern (from nao_calculation.py)')
+    parser.add_argument('--climatology',type=str,default='./reanalysis_climatology.nc',help='file with the reanalysis climatology')
+    parser.add_argument('--models',type=str,nargs='*',default=paths.models,help='source_ids (known to paths.py)')
+    parser.add_argument('--experiments',type=str,nargs='*',default=paths.experiments)
+    parser.add_argument('--start_dates',type=str,nargs='*',default=paths.start_dates)
+    parser.add_argument('--output',type=str,default='./snapsi_index.nc')
+    parser.add_argument('--cache_dir',type=str,default=str(pattern_cache.cache_dir),help='where regridded EOF patterns are cached')
+    parser.add_argument('--cache_size',type=int,default=pattern_cache.max_cache_bytes,help='max size of the cache in bytes')
+    return parser.parse_args()
+
+
+
+def resolve_samples(models,experiments,start_dates,variable='zg'):
+    '''
+        All archive files of variable for every model/experiment/start date/member,
+        resolved through paths.py (see paths.find_archive_files)
+
+        - members are found from the variant directories of each start date
+        - the latest version of each member is used
+    '''
+    files = []
+    for model in models:
+        members = set()
+        for experiment in experiments:
+            for start_date in start_dates:
+                directory = '%s%s/%s/%s/%s/' % (paths.archive,paths.centers[model],model,experiment,start_date)
+                members.update(int(re.match(r'r(\d+)i',name).group(1)) for name in paths.list_archive_dir(directory)
+                               if re.match(r'r(\d+)i',name))
+
+        base_paths = paths.get_archive_base_paths([model],experiments,start_dates,[variable],sorted(members),version='latest')
+        files.append(paths.find_archive_files(base_paths))
+
+    return pd.concat(files,ignore_index=True)
+
+
+
+def grid_hash(sample):
+    '''
+        Key of the (lat, lon, plev) grid of a sample, to share regridded patterns between samples
+    '''
+    sha = hashlib.sha1()
+    for dim in ('lat','lon','plev'):
+        if dim in sample.coords:
+            sha.update(dim.encode())
+            sha.update(np.ascontiguousarray(sample[dim].values,dtype=np.double).tobytes())
+    return sha.hexdigest()[:16]
+
+
+
+def regrid_pattern(eof,clim,sample):
+    '''
+        EOF pattern on the grid of sample, with everything the projection needs precomputed
+
+        - eof: the interpolated pattern
+        - weights: cos(lat) weights
+        - norm: (eof**2 * weights).sum over lat and lon
+        - clim: climatological index value (projection of the climatology) on the plev of sample
+    '''
+    eof = eof.interp(lat=sample.lat,lon=sample.lon)
+    if 'plev' in eof.dims:
+        eof = log_pressure_interpolation(eof,sample.plev)
+        clim = log_pressure_interpolation(clim,sample.plev)
+
+    weights = np.cos(np.radians(sample.lat))
+    pattern = xr.Dataset(dict(eof=eof,
+                              weights=weights,
+                              norm=(eof ** 2 * weights).sum(('lat','lon')),
+                              clim=clim))
+    return pattern.compute()
+
+
+
+def project_ensemble(sample,pattern):
+    '''
+        projection of a whole ensemble (all members, time steps and levels) at once,
+        as one weighted dot product over lat and lon
+
+        - missing values of sample (and of the pattern) are skipped, as in projection
+    '''
+    weighted_eof = (pattern['eof'] * pattern['weights']).fillna(0)
+    series = xr.dot(sample.fillna(0),weighted_eof,dims=('lat','lon')) / pattern['norm']
+
+    # remove climatological index value
+    return subtract_climatology(series,pattern['clim'])
+
+
+
+def project_target(model,experiment,start_date,members,eof,clim,area,patterns,**cache_kwargs):
+    '''
+        Index of all members of one model/experiment/start date, as a function of lead time
+
+        - patterns holds the regridded EOF patterns by grid_hash, so that each is only
+          loaded once however many samples share its grid
+        - regridded patterns are kept on disk (see pattern_cache.py), so that they are only
+          interpolated once per EOF, whatever the number of runs
+    '''
+    sample = paths.open_archive(model,experiment,start_date,['zg'],members,version='latest')['zg']
+    sample = area_selection(sample,area)
+
+    key = grid_hash(sample)
+    if key not in patterns:
+        def regrid():
+            print('Interpolating EOF pattern onto grid of %s (%s)' % (model,key))
+            return regrid_pattern(eof,clim,sample)
+        patterns[key] = pattern_cache.cached_pattern(pattern_cache.hash_arrays(eof,clim),key,regrid,**cache_kwargs)
+
+    series = project_ensemble(sample,patterns[key]).compute()
+
+    series = series.assign_coords(lead_time=('time',paths.lead_times(series['time'],start_date)))
+    series = series.swap_dims(time='lead_time').rename(time='valid_time')
+    return series
+
+
+
+def batch_projection(files,eof,clim,area,**cache_kwargs):
+    '''
+        Index of every model/experiment/start date/member of files (from resolve_samples),
+        as one DataArray along a target dimension (with model, experiment and init coordinates)
+
+        - cache_kwargs (directory, max_bytes) are passed on to pattern_cache.cached_pattern
+    '''
+    patterns = {}
+    series = []
+    for (model,experiment,start_date), target in files.groupby(['model','experiment','start_date'],sort=False):
+        print('Projecting %s %s %s (%d members)' % (model,experiment,start_date,target.member.nunique()))
+        target_series = project_target(model,experiment,start_date,sorted(target.member.unique()),eof,clim,area,patterns,**cache_kwargs)
+        series.append(target_series.expand_dims('target').assign_coords(model=('target',[model]),
+                                                                        experiment=('target',[experiment]),
+                                                                        init=('target',[start_date])))
+
+    print('Used %d EOF patterns for %d targets' % (len(patterns),len(series)))
+    return xr.concat(series,dim='target',join='outer')
+
+
+
+if __name__ == '__main__':
+
+    args = parse_commandline_args()
+    area = indices[args.index]['area']
+
+    # load EOF pattern and transform geopotential to geopotential height
+    eof = xr.open_dataset(args.eof)['eof'] / 9.81
+    eof = area_selection(eof,area)
+
+    # check sign convention
+    lat1, lat2 = indices[args.index]['sign_lats']
+    sign = np.sign(eof.sel(lat=lat1,method='nearest').mean('lon') - eof.sel(lat=lat2,method='nearest').mean('lon'))
+    eof = eof * sign
+
+    # compute climatological index value
+    clim = load_climatology(args.climatology,'Z') / 9.81
+    clim = projection(area_selection(clim,area),eof).compute()
+
+    files = resolve_samples(args.models,args.experiments,args.start_dates)
+    print('Resolved %d zg files' % len(files))
+
+    index = batch_projection(files,eof,clim,area,directory=args.cache_dir,max_bytes=args.cache_size)
+    print(index)
+
+    xr.Dataset({args.index:index}).to_netcdf(args.output)
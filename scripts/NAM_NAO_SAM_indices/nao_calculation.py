@@ -1,11 +1,15 @@
 
 import numpy as np
 import xarray as xr
-import scipy.ndimage
 import os
 
-from numba import guvectorize
+import dask.array
 from dask.distributed import Client
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from anomalies import load_climatology, subtract_climatology
 
 
 
@@ -29,19 +33,61 @@ def detrend(da):
 
 
 
-@guvectorize(
-    "(float64[:], float64[:], float64[:])",
-    "(m), (n) -> (m)",
-    forceobj=True
-)
-def vectorized_convolution(x,kernel,out):
+def boxcar_sums(x,m):
+    '''
+        Sums of all windows of m consecutive values along the last axis ('valid' part only)
+
+        - difference of a cumulative sum, so the cost does not depend on m
+        - cumulative sum in double precision to limit round-off over long series
+    '''
+    cs = np.cumsum(x,axis=-1,dtype=np.double)
+    cs = np.concatenate([np.zeros(cs.shape[:-1]+(1,)),cs],axis=-1)
+    return cs[...,m:] - cs[...,:-m]
+
+
+
+def triangular_filter(x,n):
+    '''
+        Convolution with triangular window of length n along the last axis ('valid' part only)
+
+        - triangular window = boxcar of ceil(n/2) convolved with boxcar of floor(n/2)+1,
+          i.e., two running sums via cumulative sums instead of a convolution
+        - output i is centered like scipy.ndimage.convolve at input i + n - 1 - n//2
+        - windows containing NaN are NaN
+    '''
+    a, b = int(np.ceil(n/2)), n//2 + 1
+    nans = np.isnan(x)
+    if nans.any():
+        filtered = boxcar_sums(boxcar_sums(np.where(nans,0,x),a),b)
+        filtered[boxcar_sums(boxcar_sums(nans,a),b) > 0] = np.nan
+    else:
+        filtered = boxcar_sums(boxcar_sums(x,a),b)
+    return filtered / (a*b)
+
+
+
+def periodic_triangular_filter(x,n,axis):
+    '''
+        Convolution with triangular window along axis, input is assumed being periodic
+    '''
+    x = np.moveaxis(x,axis,-1)
+    pad = [(0,0)] * (x.ndim-1) + [(n - 1 - n//2, n//2)]
+    filtered = triangular_filter(np.pad(x,pad,mode='wrap'),n).astype(x.dtype)
+    return np.moveaxis(filtered,-1,axis)
+
+
+
+def overlapped_triangular_filter(x,n,axis):
     '''
-        Vectorized convolution -> generalized NumPy universal function
+        Convolution with triangular window along axis of a block extended by n//2 values on each side
 
-        - mode='wrap' means that input is assumed being periodic
-        - mode='mirror' means that input is extended by reflectinf about the center of the last pixel
+        - for dask map_overlap: output has the shape of the extended block, of which only
+          the values at least n//2 from either end (that map_overlap keeps) are valid
     '''
-    out[:] = scipy.ndimage.convolve(x,kernel,mode='wrap')
+    x = np.moveaxis(x,axis,-1)
+    pad = [(0,0)] * (x.ndim-1) + [(n - 1 - n//2, n//2)]
+    filtered = np.pad(triangular_filter(x,n),pad).astype(x.dtype)
+    return np.moveaxis(filtered,-1,axis)
 
 
 
@@ -49,59 +95,155 @@ def lowpass(da,dim,n,valid=False):
     '''
         Convolution with triangular window
 
-        -convolution in time space is multiplication in frequency space
-        - no chunking along core dimension dim
+        - computed as two running boxcar sums, so the cost does not depend on n
+        - dim can be chunked: chunks are extended by n//2 values on each side via map_overlap
+          (chunks must be at least n//2 long), otherwise the whole array is filtered at once
     '''
 
-    kernel = np.hstack([np.arange(1,np.ceil(n/2)+1),np.arange(np.floor(n/2),0,-1)])
-    kernel /= kernel.sum()
-    kernel = xr.DataArray(kernel,dims=('kernel'))
-
-    filtered = xr.apply_ufunc(vectorized_convolution,
-                              da,kernel,
-                              input_core_dims=[[dim,],['kernel']],
-                              output_core_dims=[[dim,],],
-                              dask='parallelized',
-                              output_dtypes=[da.dtype])
+    axis = da.get_axis_num(dim)
+    if da.chunks is None:
+        filtered = periodic_triangular_filter(da.values,n,axis)
+    else:
+        filtered = da.data.map_overlap(overlapped_triangular_filter,
+                                       depth={axis:n//2},
+                                       boundary='periodic',
+                                       dtype=da.dtype,
+                                       n=n,axis=axis)
+    filtered = da.copy(data=filtered)
 
     # input is assumed to be periodic
     # remove beginning and end if unvalid
     if valid:
         valid_slice = slice((n - 1) // 2, -(n - 1) // 2)
-        filtered = filtered.isel(time=valid_slice)
+        filtered = filtered.isel({dim:valid_slice})
 
     return filtered
 
 
 
-@guvectorize(
-    "(float64[:,:], float64[:], float64[:,:], float64[:,:], float64[:])",
-    "(m,n), (k) -> (m,k), (n,k), (k)",
-    forceobj=True
-)
-def vectorized_svd(X,dummy,U,VS,S2):
+def randomized_svd(X,k,oversampling=10,power_iterations=4,seed=0):
+    '''
+        Leading k singular triplets of X by randomized SVD (Halko et al., 2011)
+
+        - X is projected onto k+oversampling random directions, refined by power iterations
+        - only matrices of k+oversampling columns/rows are ever decomposed
+    '''
+    rng = np.random.default_rng(seed)
+    l = min(k + oversampling, *X.shape)
+    Q, _ = np.linalg.qr(X @ rng.standard_normal((X.shape[1],l)))
+    for i in range(power_iterations):
+        Q, _ = np.linalg.qr(X.T @ Q)
+        Q, _ = np.linalg.qr(X @ Q)
+    u, s, vh = np.linalg.svd(Q.T @ X,full_matrices=False)
+    return (Q @ u)[:,:k], s[:k], vh[:k]
+
+
+
+def gram_svd(X,k):
+    '''
+        Leading k singular triplets of X from the eigen-decomposition of its smaller Gram matrix
+
+        - X X^T if X has fewer rows than columns, X^T X otherwise
+        - for a dask X the Gram matrix is accumulated over the chunks, and the other
+          singular vectors are returned as a (lazy) projection of X
+    '''
+    m, n = X.shape
+    G = X @ X.T if m <= n else X.T @ X
+    G = np.asarray(G.compute() if hasattr(G,'compute') else G)
+
+    # eigenvalues in ascending order
+    lam, vec = np.linalg.eigh(G)
+    lam, vec = lam[::-1][:k], vec[:,::-1][:,:k]
+    s = np.sqrt(np.clip(lam,0,None))
+
+    if m <= n:
+        return vec, s, (vec.T @ X) / s[:,None]
+    return (X @ vec) / s, s, vec.T
+
+
+
+def tsqr_svd(X,k):
+    '''
+        Leading k singular triplets of a tall-and-skinny X by a tall-skinny QR over chunks of rows
+
+        - each chunk of rows (time steps) is decomposed separately, so X is streamed
+          through and never has to be in memory as a whole
+        - the columns (spatial points) must fit into a single chunk
+    '''
+    X = dask.array.asarray(X)
+    X = X.rechunk({0:X.chunks[0] if X.numblocks[0] > 1 else 'auto',1:-1})
+    u, s, vh = dask.array.linalg.svd(X)
+    return u[:,:k], s[:k], vh[:k]
+
+
+
+def truncated_svd(X,k,method='gram'):
+    '''
+        Leading k singular triplets (U,S,VH) of a (time x points) matrix
+
+        - method='svd': full singular value decomposition, then truncated
+        - method='gram': eigen-decomposition of the smaller Gram matrix
+        - method='randomized': randomized SVD (dask.array.linalg.svd_compressed for dask arrays)
+        - method='tsqr': tall-skinny QR over time-chunked dask arrays
+        - X can be a NumPy or a (time-chunked) dask array
+    '''
+    is_dask = isinstance(X,dask.array.Array)
+    if method == 'svd':
+        u, s, vh = np.linalg.svd(np.asarray(X),full_matrices=False)
+        return u[:,:k], s[:k], vh[:k]
+    if method == 'gram':
+        return gram_svd(X,k)
+    if method == 'randomized':
+        if is_dask:
+            return dask.array.linalg.svd_compressed(X,k,n_power_iter=4,seed=0)
+        return randomized_svd(X,k)
+    if method == 'tsqr':
+        return tsqr_svd(X,k)
+    raise ValueError('Unknown method %s' % method)
+
+
+
+def pca_modes(stacked,n_modes,method):
+    '''
+        Leading principal components of a (time, allpoints) DataArray
+
+        - U is standardized, as for the full decomposition
+        - explained variance is relative to the total variance (not only of the modes computed)
     '''
-        Vectorized singular value decomposition  -> generalized NumPy universal function
+    X = stacked.data.astype(np.double)
+    u, s, vh = truncated_svd(X,n_modes,method)
+
+    u_std = u.std(axis=0)
+    pc = xr.DataArray(u/u_std,dims=('time','number'),coords={'time':stacked['time']})
+    eof = xr.DataArray(vh.T * s * u_std,dims=('allpoints','number'),coords={'allpoints':stacked['allpoints']})
+    expl = xr.DataArray(s**2 / (X**2).sum(),dims=('number'))
+
+    return pc, eof, expl
 
-        - X = U @ np.diag(S) @ VH
-        - U is standardized
-        - m is dimension of time, n is stacked dimension, k = min(m,n)
+
+
+def pca_stacked(stacked,n_modes,method):
+    '''
+        pca_modes for each combination of the dimensions apart from time and allpoints
     '''
-    u, s, vh = np.linalg.svd(X,full_matrices=False)
-    u_std = np.std(u,axis=0)
-    U[:,:] = u/u_std
-    VS[:,:] = vh.transpose() * s * u_std
-    S2[:] = s**2
+    others = [dim for dim in stacked.dims if dim not in ('time','allpoints')]
+    if len(others) == 0:
+        return pca_modes(stacked.transpose('time','allpoints'),n_modes,method)
 
+    modes = [pca_stacked(stacked.isel({others[0]:i}),n_modes,method) for i in range(stacked.sizes[others[0]])]
+    return [xr.concat(mode,dim=stacked[others[0]]) for mode in zip(*modes)]
 
 
-def pca(anomalies,coords_to_stack):
+
+def pca(anomalies,coords_to_stack,n_modes=None,method='gram'):
     '''
-        Principal component analysis using a sigular value decomposition algorithm
+        Principal component analysis computing only the leading n_modes modes
 
         - stack spatial dimensions given by coords_to_stack
-        - all dimensions apart from time and allpoints are broadcasted over
-        - no chunking along core-dimensions
+        - all dimensions apart from time and allpoints are looped over
+        - n_modes=None computes all modes
+        - method is one of 'svd', 'gram', 'randomized' or 'tsqr' (see truncated_svd);
+          'gram', 'randomized' and 'tsqr' work on time-chunked dask arrays
     '''
     # apply area weighting
     # exclude poles for data on regular grid to avoid zero-devision
@@ -111,22 +253,11 @@ def pca(anomalies,coords_to_stack):
 
     # stack spatial dimensions
     stacked = anomalies.stack(allpoints=coords_to_stack)
+    if n_modes is None:
+        n_modes = min(len(stacked.allpoints),len(stacked.time))
 
     # singular value decomposition
-    dummy = min(len(stacked.allpoints),len(stacked.time))
-    dummy = xr.DataArray(np.zeros(dummy),dims=('number'))
-    pc, eof_stacked, expl = xr.apply_ufunc(vectorized_svd,
-                                           stacked,dummy,
-                                           input_core_dims=[['time','allpoints'],['number']],
-                                           output_core_dims=[['time','number'],
-                                                             ['allpoints','number'],
-                                                             ['number']],
-                                           dask='parallelized',
-                                           output_dtypes=3*[stacked.dtype])
-
-
-    # ratio of explained variance
-    expl = expl/expl.sum('number')
+    pc, eof_stacked, expl = pca_stacked(stacked,n_modes,method)
 
     eof = eof_stacked.unstack('allpoints')
 
@@ -139,11 +270,17 @@ def pca(anomalies,coords_to_stack):
 
 
 
-def projection(sample,eof):
-    
-    weights = np.cos(np.radians(sample.lat))
+def projection(sample,eof,weights=None,norm=None):
+    '''
+        Linear projection of sample on pattern eof
+
+        - weights and norm can be passed in precomputed, e.g., from pattern_cache.py
+    '''
+    if weights is None:
+        weights = np.cos(np.radians(sample.lat))
     series = (eof * sample * weights).sum(('lat','lon'))
-    norm = (eof ** 2 * weights).sum(('lat','lon'))
+    if norm is None:
+        norm = (eof ** 2 * weights).sum(('lat','lon'))
     series = series / norm
 
     return series
@@ -160,7 +297,9 @@ if __name__ == '__main__':
 
 
     # configure computing environment
-    client = Client(n_workers=1,threads_per_worker=1,memory_limit='600GB',host=os.environ['HOSTNAME'])
+    # only the leading mode is computed (from the Gram matrix, accumulated
+    # over the time chunks), so no worker needs to hold a full decomposition
+    client = Client(host=os.environ['HOSTNAME'])
     print(client)
 
     # choose area according to index
@@ -209,14 +348,14 @@ if __name__ == '__main__':
 
 
     # compute anomalies  and apply lowpass filter
-    clim = xr.open_dataset('./reanalysis_climatology.nc')['Z']
+    clim = load_climatology('./reanalysis_climatology.nc','Z')
     clim['lon'] = xr.where(clim['lon']>180,clim['lon']-360,clim['lon'])
     clim = clim.sortby('lon')
 
-    anomalies = da.groupby('time.dayofyear') - clim
+    anomalies = subtract_climatology(da,clim)
 
     #anomalies = detrend(anomalies) # detrending whilst the summer is still included is problematic
-    anomalies = lowpass(anomalies.chunk(dict(time=-1)),dim='time',n=n)
+    anomalies = lowpass(anomalies,dim='time',n=n)
     anomalies = anomalies.where(anomalies['time.month'].isin([12,1,2]),drop=True)
 
     print('\n ANOMALIES:')
@@ -228,7 +367,7 @@ if __name__ == '__main__':
     # perform PCA and store to disk
     # (here, msl is only three dimensional
     # for a field with a fourth dimension ,e.g. level, this routines works just as fine, obtaining of NAO pattern for each level
-    nao = pca(anomalies,('lat','lon'))
+    nao = pca(anomalies,('lat','lon'),n_modes=1,method='gram')
     nao = nao.isel(number=0)
 
     print('\n PCA:')
@@ -2,28 +2,35 @@ import numpy as np
 import xarray as xr
 import matplotlib.pyplot as plt
 import os
+import pathlib
+import sys
 
 from dask.distributed import Client
 from nao_calculation import projection, lowpass
 
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import vertical_interpolation
+from anomalies import load_climatology, subtract_climatology
+
 
 def area_selection(da,area):
     
     da['lon'] = xr.where(da['lon']>180,da['lon']-360,da['lon'])
     da = da.sortby('lon')
+    # order latitudes like the selected slice (reanalyses run north to south, CMOR grids south to north)
+    if isinstance(area.get('lat'),slice) and None not in (area['lat'].start,area['lat'].stop):
+        da = da.sortby('lat',ascending=bool(area['lat'].start < area['lat'].stop))
     da = da.sel(**area)
     
     return da
 
 
 def log_pressure_interpolation(da,plev,ps=100000):
-    
-    tmp = da.copy()
-    tmp['plev'] = -np.log(tmp.plev/ps)
-    tmp = tmp.interp(plev=-np.log(plev/ps))
-    tmp['plev'] = plev
-    
-    return tmp
+    '''
+        Linear interpolation in log-pressure onto plev, with weights computed once
+        per pair of level sets (see vertical_interpolation.py)
+    '''
+    return vertical_interpolation.log_pressure_interpolation(da,plev,ps)
     
 
 if __name__ == '__main__':
@@ -41,7 +48,7 @@ if __name__ == '__main__':
     #area = dict(lat=slice(-20,90)) # SAM
     
     # load climatology and EOF pattern
-    clim = xr.open_dataset('./reanalysis_climatology.nc')['Z']
+    clim = load_climatology('./reanalysis_climatology.nc','Z')
     clim = area_selection(clim,area)
     
     # transform geopotential to geopotential height
@@ -64,7 +71,7 @@ if __name__ == '__main__':
     #############################
     # define file list for sample
     directory = '/badc/snap/data/post-cmip6/SNAPSI/UKMO/GloSea6/control/s20180125/r9i1p1f1/6hrPt/zg/gn/v20230403/'
-    file = directory + zg_6hrPt_GloSea6_control_s20180125-r9i1p1f1_gn_201801250600-201803260000.nc
+    file = directory + 'zg_6hrPt_GloSea6_control_s20180125-r9i1p1f1_gn_201801250600-201803260000.nc'
 
     sample = xr.open_dataset(file)['zg']
     sample = area_selection(sample,area)
@@ -86,7 +93,7 @@ if __name__ == '__main__':
 
     
     # remove climatological index value
-    index = index.groupby('time.dayofyear') - clim
+    index = subtract_climatology(index,clim)
     
     # check sign convention
     sign = np.sign(eof.sel(lat=35,method='nearest').mean('lon') - eof.sel(lat=70,method='nearest').mean('lon'))
@@ -0,0 +1,109 @@
+import numpy as np
+import xarray as xr
+import hashlib
+import pathlib
+import uuid
+import os
+
+
+# where the regridded patterns are kept, and how much disk they may use
+cache_dir = pathlib.Path(os.environ.get('SNAPSI_PATTERN_CACHE','./pattern_cache'))
+max_cache_bytes = 2**30
+
+
+
+def hash_arrays(*arrays):
+    '''
+        Hash of the values and coordinates of DataArrays
+    '''
+    sha = hashlib.sha1()
+    for da in arrays:
+        for name in [da.name] + sorted(da.coords):
+            values = da.values if name == da.name else da[name].values
+            sha.update(str(name).encode())
+            sha.update(str(values.shape).encode())
+            sha.update(np.ascontiguousarray(values).tobytes())
+    return sha.hexdigest()[:16]
+
+
+
+def pattern_key(pattern_hash,grid_hash):
+    '''
+        Key of a pattern regridded onto a model grid
+
+        - pattern_hash (of the source EOF and climatology, see hash_arrays) changes with
+          the source EOF, so that entries of a previous EOF are never used again
+          (and are eventually evicted)
+        - grid_hash covers lat, lon and the set of plev of the grid
+    '''
+    return '%s_%s' % (pattern_hash,grid_hash)
+
+
+
+def load_pattern(key,directory=cache_dir):
+    '''
+        Regridded pattern of key from the cache, or None if it is not cached
+    '''
+    path = pathlib.Path(directory) / ('%s.nc' % key)
+    try:
+        with xr.open_dataset(path) as ds:
+            pattern = ds.load()
+    except (FileNotFoundError,OSError,ValueError):
+        return None
+
+    # mark as recently used, for eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return pattern
+
+
+
+def store_pattern(key,pattern,directory=cache_dir,max_bytes=max_cache_bytes):
+    '''
+        Add a regridded pattern to the cache, then evict the least recently used
+        patterns until the cache is no larger than max_bytes
+
+        - written to a temporary file first, so that concurrent runs never see partial files
+    '''
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True,exist_ok=True)
+    tmp = directory / ('.%s.%s.tmp' % (key,uuid.uuid4().hex))
+    pattern.to_netcdf(tmp)
+    os.replace(tmp,directory / ('%s.nc' % key))
+
+    evict(directory,max_bytes)
+
+
+
+def evict(directory=cache_dir,max_bytes=max_cache_bytes):
+    '''
+        Remove the least recently used patterns until the cache is no larger than max_bytes
+    '''
+    entries = []
+    with os.scandir(directory) as scan:
+        for entry in scan:
+            if entry.name.endswith('.nc'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime,stat.st_size,entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        pathlib.Path(path).unlink(missing_ok=True)
+        total -= size
+
+
+
+def cached_pattern(pattern_hash,grid_hash,regrid,directory=cache_dir,max_bytes=max_cache_bytes):
+    '''
+        Regridded pattern from the cache, or from regrid() (which is then cached)
+    '''
+    key = pattern_key(pattern_hash,grid_hash)
+    pattern = load_pattern(key,directory)
+    if pattern is None:
+        pattern = regrid()
+        store_pattern(key,pattern,directory,max_bytes)
+    return pattern
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask.array
+import functools
+import hashlib
+import pathlib
+import sys
+import os
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parent / 'climatology'))
+from calc_climatology import noleap_day_index
+
+# dimensions of a climatology (from calc_climatology.py) that are matched to the time steps
+clim_dims = ('dayofyear', 'hour')
+
+# days of the climatology in each block read from its memory map
+clim_day_chunk = 16
+
+# where the .npy copies of climatologies are kept (the source files may be read-only)
+clim_cache_dir = pathlib.Path(os.environ.get('SNAPSI_CLIMATOLOGY_CACHE', '~/.cache/snapsi/climatology')).expanduser()
+
+def climatology_array_path(path, variable, directory = clim_cache_dir):
+    '''
+        Path of the .npy copy of variable in the netCDF file path, named after the
+        file and a hash of its full path, so that files of the same name do not clash
+    '''
+    path = pathlib.Path(path).resolve()
+    path_hash = hashlib.sha1(str(path).encode()).hexdigest()[:12]
+    return pathlib.Path(directory) / ('%s.%s.%s.npy' % (path.stem, variable, path_hash))
+
+def write_climatology_array(clim, array_path):
+    '''
+        Copy the values of clim into the .npy file array_path (via a temporary file,
+        so that readers never see a partial copy); returns False if it cannot be written
+    '''
+    tmp = array_path.with_name('.%s.%d.tmp.npy' % (array_path.name, os.getpid()))
+    try:
+        array_path.parent.mkdir(parents = True, exist_ok = True)
+        np.save(tmp, clim.values)
+        os.replace(tmp, array_path)
+    except OSError as e:
+        print('Unable to cache %s in %s (%s); keeping it in memory' % (clim.name, array_path.parent, e))
+        if tmp.exists(): tmp.unlink()
+        return False
+    return True
+
+@functools.lru_cache(maxsize = 16)
+def _mapped_array(path, mtime):
+    return np.load(path, mmap_mode = 'r')
+
+def _read_mapped_block(path, mtime, block_info = None):
+    location = block_info[None]['array-location']
+    return np.array(_mapped_array(path, mtime)[tuple(slice(start, stop) for start, stop in location)])
+
+def mapped_dask_array(path, chunks):
+    '''
+        A dask array of the .npy file path, each block of which is read from a memory map
+        of the file opened by path, so that the graph holds the path rather than the values
+        (and computing a few blocks, on any worker, only reads those)
+    '''
+    mtime = pathlib.Path(path).stat().st_mtime
+    values = _mapped_array(path, mtime)
+    return dask.array.map_blocks(_read_mapped_block, path, mtime, \
+                                 chunks = dask.array.core.normalize_chunks(chunks, values.shape), \
+                                 dtype = values.dtype, meta = np.array((), dtype = values.dtype))
+
+@functools.lru_cache(maxsize = 16)
+def _load_climatology(path, variable, directory):
+    path = pathlib.Path(path)
+    array_path = climatology_array_path(path, variable, directory)
+
+    with xr.open_dataset(path) as ds:
+        clim = ds[variable]
+        if not array_path.exists() or array_path.stat().st_mtime < path.stat().st_mtime:
+            if not write_climatology_array(clim, array_path):
+                return clim.load()
+
+        chunks = tuple(clim_day_chunk if dim == 'dayofyear' else -1 for dim in clim.dims)
+        values = mapped_dask_array(str(array_path), chunks)
+        return xr.DataArray(values, coords = {name: coord.values for name, coord in clim.coords.items()}, \
+                            dims = clim.dims, name = clim.name, attrs = clim.attrs)
+
+def load_climatology(path, variable, directory = None):
+    '''
+        The climatology of variable in the netCDF file path (e.g. the smoothed output of
+        calc_climatology.py), as a lazy DataArray read from a memory map
+
+        - the values are copied once into a .npy file in directory (clim_cache_dir by
+          default, set by $SNAPSI_CLIMATOLOGY_CACHE; again whenever path is newer), which
+          is then memory-mapped, so that only the days that are used are ever read, and
+          all processes on a node share them through the page cache
+        - if the copy cannot be written, the climatology is held in memory instead
+        - backed by a dask array whose blocks (of clim_day_chunk days) read the .npy file
+          by path, so selections, arithmetic and sorting stay lazy, and dask graphs (and
+          workers) never carry the whole climatology
+        - memoized, so that every diagnostic of a run reuses the same climatology
+          (each caller gets its own shallow copy, to change coordinates of)
+    '''
+    directory = clim_cache_dir if directory is None else directory
+    return _load_climatology(str(path), variable, str(directory)).copy(deep = False)
+
+def climatology_positions(time, clim, drop = 'jun30'):
+    '''
+        Position of each time step along the (flattened) dayofyear[, hour] dimensions of clim
+
+        - for 365-day climatologies (calc_climatology.py), days are counted in a noleap year
+          with drop removed from leap years (see noleap_day_index), and the removed day
+          uses the climatology of the day before
+        - for 366-day climatologies (as from groupby('time.dayofyear')), days are calendar
+          days of the year, as with groupby arithmetic
+        - computed once per time axis, for all members, levels and grid points
+    '''
+    time = xr.DataArray(np.asarray(time), dims = 'time')
+    steps_per_day = clim.sizes.get('hour', 1)
+
+    if clim.sizes['dayofyear'] == 366:
+        day = time.dt.dayofyear.values
+    else:
+        index = noleap_day_index(time, drop)
+        dropped = index < 0
+        index[dropped] = noleap_day_index(time[dropped] - np.timedelta64(1, 'D'), drop)
+        day = index + 1
+
+    positions = pd.Index(clim['dayofyear'].values).get_indexer(day)
+    if np.any(positions < 0):
+        raise ValueError('The climatology has no days %s' % np.unique(day[positions < 0]))
+
+    if 'hour' in clim.dims:
+        hours = (time.dt.hour.values * 60 + time.dt.minute.values) * steps_per_day // (24 * 60)
+        positions = positions * steps_per_day + hours
+
+    return positions
+
+def _subtract(x, clim):
+    return np.subtract(x, clim, dtype = x.dtype)
+
+def subtract_climatology(da, clim, time_dim = 'time', drop = 'jun30'):
+    '''
+        Anomalies of da (with a time dimension, and any others, e.g. member_id) from
+        the climatology clim (dayofyear[, hour], ...), e.g. from load_climatology
+
+        - a replacement for da.groupby('time.dayofyear') - clim: the climatology of every
+          time step is gathered by position (see climatology_positions) and subtracted
+          as one vectorized operation, across all members and lead times
+        - only the days of clim that are needed are gathered (and, for a lazy clim as from
+          load_climatology, read); on dask arrays this happens block by block as they are
+          computed, with the gathered days chunked like the time steps of da
+        - clim is selected onto the coordinates of da if they differ
+    '''
+    grid_dims = [dim for dim in clim.dims if dim not in clim_dims]
+    for dim in grid_dims:
+        if dim in da.coords and dim in clim.coords and not np.array_equal(da[dim].values, clim[dim].values):
+            clim = clim.sel({dim : da[dim].values})
+
+    positions = climatology_positions(da[time_dim].values, clim, drop)
+    values = clim.transpose(*[dim for dim in clim_dims if dim in clim.dims], *grid_dims).data
+    values = values.reshape((-1,) + values.shape[values.ndim - len(grid_dims):])[positions]
+
+    if da.chunks is None:
+        values = np.asarray(values)
+    else:
+        values = dask.array.asarray(values).rechunk({0 : da.chunksizes[time_dim]})
+    values = xr.DataArray(values, dims = (time_dim, *grid_dims))
+
+    anomalies = xr.apply_ufunc(_subtract, da, values, \
+                               dask = 'parallelized', \
+                               output_dtypes = [da.dtype], \
+                               keep_attrs = True)
+
+    return anomalies.transpose(*da.dims)
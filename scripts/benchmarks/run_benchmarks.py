@@ -0,0 +1,329 @@
+import numpy as np
+import xarray as xr
+import concurrent.futures
+import multiprocessing
+import subprocess
+import datetime
+import platform
+import resource
+import argparse
+import pathlib
+import shutil
+import json
+import time
+import sys
+import os
+
+scripts = pathlib.Path(__file__).resolve().parents[1]
+for directory in ('', 'zdlawren', 'climatology', 'NAM_NAO_SAM_indices', 'benchmarks'):
+    sys.path.append(str(scripts / directory))
+
+import dask
+import pyzome
+import paths
+import synthetic_data
+import build_intake_esm_catalog
+import zmd_snapsi
+import compile_ensemble
+import query_zmd_files
+import zmd_to_epf
+import calc_climatology
+import nao_calculation
+import nao_projection
+import index_projection
+from anomalies import load_climatology, subtract_climatology
+from output_formats import remove_output
+
+# where baselines are kept, by name
+baseline_dir = pathlib.Path(__file__).resolve().parent / 'baselines'
+
+# memory given to the stages that take a memory budget
+stage_mem = '4G'
+
+# index whose EOF and projection are benchmarked (see index_projection.indices)
+benchmark_index = 'nam'
+
+# window of the lowpass filter, in 6-hourly time steps (30 days, as in nao_calculation.py)
+lowpass_window = int(30 / 0.25) + 1
+
+def runs():
+    return [(start_date, experiment) for start_date in synthetic_data.start_dates for experiment in synthetic_data.experiments]
+
+def zmd_dir(workdir, start_date, experiment):
+    return pathlib.Path(workdir) / 'zmd' / synthetic_data.model / start_date / experiment
+
+def compiled_path(workdir, start_date, experiment):
+    return query_zmd_files.get_compiled_path(synthetic_data.model, start_date, experiment, pathlib.Path(workdir) / 'processed')
+
+def bench_catalog(data, workdir):
+    '''
+        Build the intake-esm catalog of the synthetic archive from scratch
+    '''
+    catalog_dir = pathlib.Path(workdir) / 'catalog'
+    shutil.rmtree(catalog_dir, ignore_errors = True)
+    build_intake_esm_catalog.ROOT_PATH = pathlib.Path(data['archive'])
+
+    shard_path = catalog_dir / 'benchmark_shards'
+    for shard_dir in build_intake_esm_catalog.find_shard_dirs(data['archive']):
+        build_intake_esm_catalog.update_shard(shard_dir, shard_path, njobs = 4, rescan = True)
+    build_intake_esm_catalog.merge_shards(shard_path, catalog_dir, 'benchmark')
+
+def bench_zonal_means(data, workdir):
+    '''
+        Zonal mean datasets of every member, from the catalog, in one pass per run
+    '''
+    import intake
+    catalog = intake.open_esm_datastore(str(pathlib.Path(workdir) / 'catalog' / 'benchmark.json'))
+    mem_bytes = zmd_snapsi.parse_memsize(stage_mem)
+    num_workers = zmd_snapsi.default_num_workers()
+
+    for start_date, experiment in runs():
+        output_dir = zmd_dir(workdir, start_date, experiment)
+        shutil.rmtree(output_dir, ignore_errors = True)
+        output_dir.mkdir(parents = True)
+
+        ds = zmd_snapsi.open_snapsi_dataset(synthetic_data.model, start_date, experiment, catalog = catalog)
+        chunks = zmd_snapsi.choose_ensemble_chunks(ds, mem_bytes, num_workers)
+        ds = zmd_snapsi.open_snapsi_dataset(synthetic_data.model, start_date, experiment, chunks = chunks, catalog = catalog)
+        zmd_snapsi.process_ensemble(ds, output_dir, synthetic_data.model, start_date, experiment, num_workers)
+
+        if len(list(output_dir.glob('*_zmd.nc'))) != ds.sizes['member_id']:
+            raise RuntimeError('Zonal means of %s %s are incomplete' % (start_date, experiment))
+
+def bench_compile(data, workdir):
+    '''
+        Compile the member zonal mean files of each run into one file
+    '''
+    mem_bytes = zmd_snapsi.parse_memsize(stage_mem)
+    for start_date, experiment in runs():
+        output_file = compiled_path(workdir, start_date, experiment)
+        remove_output(output_file)
+        member_files = sorted(zmd_dir(workdir, start_date, experiment).glob('*_zmd.nc'))
+        compile_ensemble.compile_ensemble(member_files, output_file, mem_bytes)
+
+def bench_ep_flux(data, workdir):
+    '''
+        EP fluxes of the compiled zonal mean files
+    '''
+    for start_date, experiment in runs():
+        zmd_file = compiled_path(workdir, start_date, experiment)
+        output_file = zmd_to_epf.get_epf_path(zmd_file)
+        remove_output(output_file)
+        if not zmd_to_epf.convert_to_epf(zmd_file, output_file, synthetic_data.model):
+            raise RuntimeError('EP fluxes of %s failed' % zmd_file)
+
+def bench_climatology(data, workdir):
+    '''
+        Smoothed daily climatology of the reanalysis, one yearly file at a time
+    '''
+    clim = calc_climatology.calc_daily_climatology_files(data['reanalysis_files'], 'Z')
+    clim = calc_climatology.smooth_climatology(clim)
+    output_file = pathlib.Path(workdir) / 'reanalysis_climatology.nc'
+    output_file.unlink(missing_ok = True)
+    xr.Dataset(dict(Z = clim)).to_netcdf(output_file)
+
+def bench_lowpass(data, workdir):
+    '''
+        Anomalies of the reanalysis from its climatology, lowpass filtered, for winter
+    '''
+    da = xr.open_mfdataset(data['reanalysis_files'], chunks = {}, combine = 'nested', concat_dim = 'time')['Z']
+    clim = load_climatology(pathlib.Path(workdir) / 'reanalysis_climatology.nc', 'Z')
+
+    anomalies = nao_calculation.lowpass(subtract_climatology(da, clim), dim = 'time', n = lowpass_window)
+    anomalies = anomalies.where(anomalies['time.month'].isin([12, 1, 2]), drop = True)
+
+    output_file = pathlib.Path(workdir) / 'reanalysis_anomalies.nc'
+    output_file.unlink(missing_ok = True)
+    anomalies.rename('Z').to_netcdf(output_file)
+
+def bench_eof(data, workdir):
+    '''
+        Leading EOF of the winter anomalies over the area of the index
+    '''
+    anomalies = xr.open_dataset(pathlib.Path(workdir) / 'reanalysis_anomalies.nc', chunks = dict(time = 400))['Z']
+    anomalies = nao_projection.area_selection(anomalies, index_projection.indices[benchmark_index]['area'])
+
+    eof = nao_calculation.pca(anomalies, ('lat', 'lon'), n_modes = 1, method = 'gram').isel(number = 0).compute()
+    output_file = pathlib.Path(workdir) / 'reanalysis_Z_winter.nc'
+    output_file.unlink(missing_ok = True)
+    eof.to_netcdf(output_file)
+
+def bench_projection(data, workdir):
+    '''
+        Index of every run and member of the synthetic archive, with a cold pattern cache
+    '''
+    paths.archive = data['archive'].rstrip('/') + '/'
+    paths.list_archive_dir.cache_clear()
+    cache_dir = pathlib.Path(workdir) / 'pattern_cache'
+    shutil.rmtree(cache_dir, ignore_errors = True)
+
+    area = index_projection.indices[benchmark_index]['area']
+    eof = nao_projection.area_selection(xr.open_dataset(pathlib.Path(workdir) / 'reanalysis_Z_winter.nc')['eof'] / 9.81, area)
+    lat1, lat2 = index_projection.indices[benchmark_index]['sign_lats']
+    eof = eof * np.sign(eof.sel(lat = lat1, method = 'nearest').mean('lon') - eof.sel(lat = lat2, method = 'nearest').mean('lon'))
+
+    clim = load_climatology(pathlib.Path(workdir) / 'reanalysis_climatology.nc', 'Z') / 9.81
+    clim = nao_calculation.projection(nao_projection.area_selection(clim, area), eof).compute()
+
+    files = index_projection.resolve_samples([synthetic_data.model], synthetic_data.experiments, synthetic_data.start_dates)
+    index = index_projection.batch_projection(files, eof, clim, area, directory = cache_dir)
+
+    output_file = pathlib.Path(workdir) / 'synthetic_index.nc'
+    output_file.unlink(missing_ok = True)
+    xr.Dataset({benchmark_index : index}).to_netcdf(output_file)
+
+# the stages, in the order they run, and the stages whose outputs each needs
+stages = {
+    'catalog'     : (bench_catalog,     []),
+    'zonal_means' : (bench_zonal_means, ['catalog']),
+    'compile'     : (bench_compile,     ['zonal_means']),
+    'ep_flux'     : (bench_ep_flux,     ['compile']),
+    'climatology' : (bench_climatology, []),
+    'lowpass'     : (bench_lowpass,     ['climatology']),
+    'eof'         : (bench_eof,         ['lowpass']),
+    'projection'  : (bench_projection,  ['climatology', 'eof']),
+}
+
+def required_stages(names):
+    '''
+        names and all the stages they need, in the order they run
+    '''
+    needed = set()
+    def add(name):
+        if name not in needed:
+            needed.add(name)
+            for requirement in stages[name][1]: add(requirement)
+    for name in names: add(name)
+
+    return [name for name in stages if name in needed]
+
+def reset_peak_rss():
+    '''
+        Reset the peak resident set size of this process to its current size (linux only),
+        since ru_maxrss is inherited from the parent process
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f: f.write('5')
+        return True
+    except OSError:
+        return False
+
+def read_rss_mb(field):
+    '''
+        VmRSS (current) or VmHWM (peak) resident set size of this process, in MB
+    '''
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'): return int(line.split()[1]) / 1024
+
+def _run_stage(name, data, workdir):
+    '''
+        Run a stage (in a fresh process), returning its wall time and memory use
+    '''
+    if reset_peak_rss():
+        rss_before = read_rss_mb('VmRSS')
+    else:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    start = time.perf_counter()
+    stages[name][0](data, workdir)
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kB on linux, and is only a fallback there
+    peak_rss = read_rss_mb('VmHWM') if os.path.exists('/proc/self/status') else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return dict(seconds = seconds, peak_rss_mb = peak_rss, stage_rss_mb = peak_rss - rss_before)
+
+def run_stage(name, data, workdir):
+    '''
+        Run a stage in a fresh (spawned) process, so that its memory is not mixed up with
+        that of other stages, and the imports of the pipeline are not part of its time
+    '''
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+        return executor.submit(_run_stage, name, data, str(workdir)).result()
+
+def run_benchmarks(workdir, names, size = 'small', seed = 0, repeat = 1):
+    '''
+        Time and memory-profile the stages names on synthetic data of size in workdir
+
+        - stages that the benchmarked ones need are run first (but not reported)
+        - each stage is run repeat times, keeping the fastest time and the largest memory use
+        - returns the results, with the environment they were measured in
+    '''
+    workdir = pathlib.Path(workdir).resolve()
+    os.environ['SNAPSI_OUTPUT_INDEX'] = str(workdir / 'output_index')
+    data = synthetic_data.build_synthetic_data(workdir, size, seed)
+
+    results = {}
+    for name in required_stages(names):
+        for _ in range(repeat if name in names else 1):
+            result = run_stage(name, data, workdir)
+            if name not in names: break
+            if name in results:
+                result = dict(seconds = min(result['seconds'], results[name]['seconds']), \
+                              peak_rss_mb = max(result['peak_rss_mb'], results[name]['peak_rss_mb']), \
+                              stage_rss_mb = max(result['stage_rss_mb'], results[name]['stage_rss_mb']))
+            results[name] = result
+        if name in names:
+            print('%-12s %8.2f s %9.1f MB peak RSS (%.1f MB in stage)' % (name, results[name]['seconds'], \
+                  results[name]['peak_rss_mb'], results[name]['stage_rss_mb']))
+
+    return dict(meta = environment(size, seed, repeat), stages = results)
+
+def environment(size, seed, repeat):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = scripts, capture_output = True, text = True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return dict(size = size, seed = seed, repeat = repeat, commit = commit, \
+                date = datetime.datetime.now().isoformat(timespec = 'seconds'), \
+                host = platform.node(), cpus = os.cpu_count(), python = platform.python_version(), \
+                versions = dict(numpy = np.__version__, xarray = xr.__version__, dask = dask.__version__, \
+                                pyzome = getattr(pyzome, '__version__', '')))
+
+def baseline_path(name):
+    path = pathlib.Path(name)
+    return path if path.suffix == '.json' else baseline_dir / ('%s.json' % name)
+
+def compare(results, baseline):
+    '''
+        Print the time and memory of each stage relative to a baseline
+    '''
+    if baseline['meta']['size'] != results['meta']['size']:
+        print('(WARNING) baseline is for size %s, not %s' % (baseline['meta']['size'], results['meta']['size']))
+
+    print('%-12s %10s %10s %7s %12s %12s %7s' % ('stage', 'time (s)', 'baseline', 'ratio', 'peak (MB)', 'baseline', 'ratio'))
+    for name, result in results['stages'].items():
+        if name not in baseline['stages']:
+            print('%-12s %10.2f %10s' % (name, result['seconds'], '-'))
+            continue
+        base = baseline['stages'][name]
+        print('%-12s %10.2f %10.2f %7.2f %12.1f %12.1f %7.2f' % (name, result['seconds'], base['seconds'], \
+              result['seconds'] / base['seconds'], result['peak_rss_mb'], base['peak_rss_mb'], \
+              result['peak_rss_mb'] / base['peak_rss_mb']))
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', type = str, nargs = '*', default = list(stages), choices = stages)
+    parser.add_argument('--size', type = str, default = 'small', choices = synthetic_data.sizes)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = 1, help = 'runs of each stage (the fastest is kept)')
+    parser.add_argument('--workdir', type = str, default = './benchmark_data', help = 'where the synthetic data and outputs go')
+    parser.add_argument('--save', type = str, default = None, help = 'save the results as a baseline (name or .json path)')
+    parser.add_argument('--compare', type = str, default = None, help = 'compare the results to a baseline (name or .json path)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_commandline_args()
+
+    results = run_benchmarks(args.workdir, args.stages, args.size, args.seed, args.repeat)
+
+    if args.compare is not None:
+        compare(results, json.loads(baseline_path(args.compare).read_text()))
+
+    if args.save is not None:
+        path = baseline_path(args.save)
+        path.parent.mkdir(parents = True, exist_ok = True)
+        path.write_text(json.dumps(results, indent = 2))
+        print('Saved baseline to %s' % path)
@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import argparse
+import pathlib
+import json
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import paths
+
+# pressure levels (Pa) of the synthetic 6hrPt fields, from the surface to 1 hPa
+snapsi_plev = np.array([100000., 92500., 85000., 70000., 60000., 50000., 40000., 30000., 25000., 20000., 15000., \
+                        10000., 7000., 5000., 3000., 2000., 1000., 700., 500., 300., 100.])
+
+# pressure levels (Pa) of the synthetic reanalysis, for the climatology and EOF stages
+reanalysis_plev = np.array([50000., 10000., 1000.])
+
+archive_variables = ['ua', 'va', 'ta', 'zg', 'wap']
+
+# sizes of the synthetic data: members and 6-hourly time steps of each forecast,
+# grid spacing (degrees) of the forecasts and the reanalysis, and years of reanalysis
+sizes = {
+    'tiny'   : dict(members = 2,  time_steps = 16,  grid = 10.,  reanalysis_grid = 10., years = 2),
+    'small'  : dict(members = 4,  time_steps = 60,  grid = 5.,   reanalysis_grid = 5.,  years = 4),
+    'medium' : dict(members = 10, time_steps = 180, grid = 2.5,  reanalysis_grid = 5.,  years = 10),
+}
+
+model = 'CNRM-CM61'
+experiments = ['control', 'free']
+start_dates = ['s20180125']
+
+units = dict(ua = 'm s-1', va = 'm s-1', ta = 'K', zg = 'm', wap = 'Pa s-1')
+
+def grid(spacing):
+    lat = np.arange(-90, 90 + spacing / 2, spacing)
+    lon = np.arange(0, 360, spacing)
+    return lat, lon
+
+def synthetic_field(variable, time, plev, lat, lon, rng):
+    '''
+        A float32 (time, plev, lat, lon) field with a plausible mean state, travelling
+        planetary waves (zonal wavenumbers 1-3) and noise, so that zonal means, eddy
+        fluxes and EOFs are not degenerate
+    '''
+    t = ((time - time[0]) / np.timedelta64(1, 'D')).values[:, None, None, None]
+    z = np.log(100000. / plev)[None, :, None, None]
+    phi = np.radians(lat)[None, None, :, None]
+    lam = np.radians(lon)[None, None, None, :]
+
+    waves = sum(np.cos(k * lam - 2 * np.pi * t / (10. * k) + rng.uniform(0, 2 * np.pi)) / k for k in (1, 2, 3)) * \
+            np.cos(phi) ** 2 * np.exp(z / 4)
+    noise = rng.standard_normal((len(time), len(plev), len(lat), len(lon)), dtype = np.float32)
+
+    if variable == 'ta':
+        field = 200. + 80. * np.exp(-z / 2) * np.cos(phi) ** 2 + 5. * waves + noise
+    elif variable == 'zg':
+        field = 7000. * z + 300. * np.cos(2 * phi) * z + 200. * waves + 10. * noise
+    elif variable == 'ua':
+        field = 40. * np.sin(2 * phi) ** 2 * np.exp(-(z - 2.5) ** 2) + 10. * waves + noise
+    elif variable == 'va':
+        field = 10. * np.roll(waves, 1, axis = -1) + noise
+    elif variable == 'wap':
+        field = 0.05 * np.roll(waves, 2, axis = -1) + 0.01 * noise
+    else:
+        raise ValueError('No synthetic field for %s' % variable)
+
+    return field.astype(np.float32)
+
+def cmor_dataset(variable, field, time, plev, lat, lon, attrs):
+    '''
+        A CMOR-shaped dataset of a single 6hrPt variable
+    '''
+    ds = xr.Dataset({variable : (('time', 'plev', 'lat', 'lon'), field, dict(units = units[variable]))}, \
+                    coords = dict(time = time, plev = plev, lat = lat, lon = lon))
+    ds['time'].attrs = dict(standard_name = 'time', axis = 'T')
+    ds['time'].encoding = dict(units = 'days since 1850-01-01', calendar = 'gregorian', dtype = 'float64')
+    ds['plev'].attrs = dict(standard_name = 'air_pressure', units = 'Pa', axis = 'Z', positive = 'down')
+    ds['lat'].attrs = dict(standard_name = 'latitude', units = 'degrees_north', axis = 'Y')
+    ds['lon'].attrs = dict(standard_name = 'longitude', units = 'degrees_east', axis = 'X')
+    ds.attrs = attrs
+    return ds
+
+def write_archive(root, size = 'small', seed = 0):
+    '''
+        Write synthetic forecasts of every experiment, start date and member to an
+        archive at root, in the directory layout and file names of paths.py
+
+        - root must end in SNAPSI, which the catalog takes the activity_id from
+        - the files carry the CMOR global attributes that the catalog spot-checks
+        - returns the list of files written
+    '''
+    rng = np.random.default_rng(seed)
+    config = sizes[size]
+    lat, lon = grid(config['grid'])
+    paths.archive = str(root).rstrip('/') + '/'
+
+    files = []
+    for experiment in experiments:
+        for start_date in start_dates:
+            time = pd.date_range(pd.Timestamp(start_date[1:]) + pd.Timedelta(hours = 6), periods = config['time_steps'], freq = '6h')
+            time_range = '%s-%s' % (time[0].strftime('%Y%m%d%H%M'), time[-1].strftime('%Y%m%d%H%M'))
+            for member in range(1, config['members'] + 1):
+                variant_id = paths.variant_id_templates[model].format(member = member)
+                for variable in archive_variables:
+                    directory = pathlib.Path(paths.get_archive_base_path(model, experiment, start_date, variable, member))
+                    directory.mkdir(parents = True, exist_ok = True)
+                    grid_label = paths.default_grids[model]
+                    path = directory / ('%s_6hrPt_%s_%s_%s-%s_%s_%s.nc' % (variable, model, experiment, start_date, variant_id, grid_label, time_range))
+
+                    attrs = dict(activity_id = 'SNAPSI', institution_id = paths.centers[model], source_id = model, \
+                                 experiment_id = experiment, sub_experiment_id = start_date, variant_label = variant_id, \
+                                 member_id = variant_id, table_id = '6hrPt', variable_id = variable, grid_label = grid_label, \
+                                 frequency = '6hrPt')
+                    field = synthetic_field(variable, time, snapsi_plev, lat, lon, rng)
+                    cmor_dataset(variable, field, time, snapsi_plev, lat, lon, attrs).to_netcdf(path)
+                    files.append(path)
+
+    return files
+
+def write_reanalysis(directory, size = 'small', seed = 0):
+    '''
+        Write a synthetic 6-hourly geopotential (Z, m2 s-2) reanalysis, one file per year,
+        with latitudes running north to south as in ERA5
+
+        - returns the list of files written
+    '''
+    rng = np.random.default_rng(seed + 1)
+    config = sizes[size]
+    lat, lon = grid(config['reanalysis_grid'])
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents = True, exist_ok = True)
+
+    files = []
+    for year in range(1980, 1980 + config['years']):
+        time = pd.date_range('%d-01-01' % year, '%d-12-31 18:00' % year, freq = '6h')
+        field = 9.81 * synthetic_field('zg', time, reanalysis_plev, lat, lon, rng)
+        ds = xr.Dataset(dict(Z = (('time', 'plev', 'lat', 'lon'), field)), \
+                        coords = dict(time = time, plev = reanalysis_plev, lat = lat, lon = lon))
+        path = directory / ('reanalysis_Z_%d.nc' % year)
+        ds.isel(lat = slice(None, None, -1)).to_netcdf(path)
+        files.append(path)
+
+    return files
+
+def build_synthetic_data(workdir, size = 'small', seed = 0):
+    '''
+        The synthetic archive and reanalysis in workdir, written unless they are already
+        there for the same size and seed
+
+        - returns a dict with the archive root and the reanalysis files
+    '''
+    workdir = pathlib.Path(workdir)
+    stamp_path = workdir / 'synthetic_data.json'
+    stamp = dict(size = size, seed = seed, config = sizes[size])
+    data = dict(archive = str(workdir / 'SNAPSI'), reanalysis = str(workdir / 'reanalysis'))
+
+    if stamp_path.exists() and json.loads(stamp_path.read_text()).get('stamp') == stamp:
+        data['reanalysis_files'] = sorted(str(f) for f in pathlib.Path(data['reanalysis']).glob('*.nc'))
+        return data
+
+    workdir.mkdir(parents = True, exist_ok = True)
+    stamp_path.unlink(missing_ok = True)
+    write_archive(data['archive'], size, seed)
+    data['reanalysis_files'] = [str(f) for f in write_reanalysis(data['reanalysis'], size, seed)]
+    stamp_path.write_text(json.dumps(dict(stamp = stamp)))
+
+    return data
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('workdir', type = str, help = 'where to write the synthetic data')
+    parser.add_argument('--size', type = str, default = 'small', choices = sizes)
+    parser.add_argument('--seed', type = int, default = 0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_commandline_args()
+    data = build_synthetic_data(args.workdir, args.size, args.seed)
+    print('Synthetic archive in %s, reanalysis in %s' % (data['archive'], data['reanalysis']))
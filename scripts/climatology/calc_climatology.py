@@ -2,66 +2,203 @@ import xarray as xr
 import dask
 import numpy as np
 import scipy.signal
-import matplotlib.pyplot as plt
 
+# Climatology period defined in SNAPSI protocol paper
+CLIM_PERIOD = ('1980-01-01', '2019-12-31')
 
-def smooth_climatology(climatology, window_len=30):
+# The day removed from leap years, as its (0-based) day of year in a leap year
+DROP_DAYS = {'jun30': 181, 'feb29': 59}
+
+# Time steps read at once when accumulating a climatology (a month of 6-hourly data)
+TIME_BLOCK = 124
+
+
+def smooth_climatology(climatology, window_len=30, dim='dayofyear'):
     """
-    Smooth an xarray DataArray representing climatology data using a triangular filter.
+    Smooth an xarray DataArray representing climatology data using a periodic triangular filter along dim.
+
+    The filter is applied as a multiplication in frequency space, so the cost does not depend on window_len,
+    and lazily to dask arrays (chunked along any dimension but dim), so that all cores are used.
 
     Parameters:
-    climatology (xarray.DataArray): The climatology data - has shape (365 days, lats, lons)
+    climatology (xarray.DataArray): The climatology data - has a dimension dim (365 days) and any others,
+        e.g. (dayofyear, lat, lon) or (dayofyear, plev, lat, lon)
     window_len (int, optional): The length of the filter window. Default is 30.
+    dim (str, optional): The (periodic) dimension to smooth along. Default is 'dayofyear'.
 
     Returns:
-    xarray.DataArray: The smoothed climatology data.
+    xarray.DataArray: The smoothed climatology data, with the dimensions and coordinates of climatology.
     """
     # Define a 30-day triangular window
     window = scipy.signal.windows.triang(window_len)
 
-    # Pad your time series data at the beginning and end to deal with the 
-    # edge effects during convolution.
-    pad = np.pad(climatology.values, ((window_len//2, window_len//2 - 1), (0, 0), (0, 0)), 'wrap')
-
-    # Apply the convolution (filter)
-    filtered = scipy.signal.convolve(pad, window[:, None, None] / window.sum(), mode='valid')
-
-    # Create a new DataArray for the filtered data
-    climatology_smoothed = xr.DataArray(
-        filtered,
-        coords={
-            'dayofyear': climatology.dayofyear,
-            'lat': climatology.lat,
-            'lon': climatology.lon         
-        },
-        dims=['dayofyear', 'lat', 'lon'],
+    # Lay the window out as a kernel of one period, wrapped around its start
+    # so that it is centered as with the wrap-padded convolution
+    n_days = climatology.sizes[dim]
+    kernel = np.zeros(n_days)
+    np.add.at(kernel, (window_len // 2 - np.arange(window_len)) % n_days, window / window.sum())
+    kernel_fft = np.fft.rfft(kernel)
+
+    def _filter(x):
+        return np.fft.irfft(np.fft.rfft(x, axis=-1) * kernel_fft, n=n_days, axis=-1).astype(x.dtype)
+
+    if climatology.chunks is not None:
+        climatology = climatology.chunk({dim: -1})
+
+    climatology_smoothed = xr.apply_ufunc(
+        _filter,
+        climatology,
+        input_core_dims=[[dim]],
+        output_core_dims=[[dim]],
+        dask='parallelized',
+        output_dtypes=[climatology.dtype],
+        keep_attrs=True,
     )
 
-    return climatology_smoothed
+    return climatology_smoothed.transpose(*climatology.dims)
+
+
+def noleap_day_index(time, drop='jun30', steps_per_day=1):
+    """
+    Map timestamps onto the days (or time-of-day slots) of a 365-day (noleap) year, once for all time steps.
+
+    Parameters:
+    time (xarray.DataArray): The timestamps (numpy datetime64 or cftime).
+    drop (str, optional): The day removed from leap years, 'jun30' (SNAPSI protocol) or 'feb29'. Default is 'jun30'.
+    steps_per_day (int, optional): The number of time-of-day slots per day, e.g. 4 for a 6-hourly climatology. Default is 1.
+
+    Returns:
+    numpy.ndarray: The index (day * steps_per_day + slot) of each timestamp, or -1 for timestamps on the removed day.
+    """
+    doy = time.dt.dayofyear.values - 1
+    leap = time.dt.is_leap_year.values
+    drop_day = DROP_DAYS[drop]
+
+    day = doy - (leap & (doy > drop_day))
+    slot = (time.dt.hour.values * 60 + time.dt.minute.values) * steps_per_day // (24 * 60)
+    index = day * steps_per_day + slot
+    index[leap & (doy == drop_day)] = -1
+
+    return index
+
+
+def accumulate_days(sums, counts, values, index):
+    """
+    Add time steps to running sums and counts of valid (non-NaN) values for each day of the year, in place.
+
+    Parameters:
+    sums (numpy.ndarray): The running sums - has shape (365 * steps_per_day, ...).
+    counts (numpy.ndarray): The running counts - has the same shape as sums.
+    values (numpy.ndarray): The time steps - has shape (time, ...).
+    index (numpy.ndarray): The day index of each time step (see noleap_day_index); steps with -1 are skipped.
+    """
+    keep = index >= 0
+    values, index = values[keep], index[keep]
+    if len(index) == 0:
+        return
+    # Each day must be one contiguous run of time steps, which only needs
+    # sorting for data that is not already in time order
+    if np.any(index[1:] < index[:-1]):
+        order = np.argsort(index, kind='stable')
+        values, index = values[order], index[order]
+
+    # Sum every run with one reduceat, instead of one reduction per day
+    starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+    valid = np.isfinite(values)
+    sums[index[starts]] += np.add.reduceat(np.where(valid, values, 0), starts, axis=0, dtype=sums.dtype)
+    counts[index[starts]] += np.add.reduceat(valid, starts, axis=0, dtype=counts.dtype)
+
+
+def add_to_climatology(sums, counts, da, drop='jun30', steps_per_day=1, period=CLIM_PERIOD, time_block=TIME_BLOCK):
+    """
+    Add the time steps of a (lazy) DataArray within the climatology period to running sums and counts,
+    reading time_block time steps at a time so that da never has to be in memory all at once.
+
+    Parameters:
+    sums, counts (numpy.ndarray): The running sums and counts (see init_climatology_sums).
+    da (xarray.DataArray): with a time dimension, e.g. one yearly file.
+    """
+    da = da.sel(time=slice(*period)).transpose('time', ...)
+    index = noleap_day_index(da.time, drop, steps_per_day)
+
+    for start in range(0, da.sizes['time'], time_block):
+        block = slice(start, start + time_block)
+        accumulate_days(sums, counts, da.isel(time=block).values, index[block])
 
 
-def calc_daily_climatology(da):
-   """
+def init_climatology_sums(da, steps_per_day=1):
+    """
+    Create zeroed running sums and counts for the climatology of da (float64 sums, so long records do not lose precision).
+    """
+    shape = (365 * steps_per_day,) + tuple(size for dim, size in da.sizes.items() if dim != 'time')
+    return np.zeros(shape, dtype=np.float64), np.zeros(shape, dtype=np.int32)
+
+
+def finish_climatology(sums, counts, da, steps_per_day=1):
+    """
+    Turn running sums and counts into the climatology, with the coordinates of (a DataArray like) da.
+
+    Returns:
+    xarray.DataArray: The climatology with dimensions (dayofyear, ...), or (dayofyear, hour, ...) if steps_per_day > 1.
+    Days without any valid values are NaN.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums / counts).astype(da.dtype)
+
+    dims = [dim for dim in da.dims if dim != 'time']
+    coords = {dim: da[dim] for dim in dims if dim in da.coords}
+    coords['dayofyear'] = np.arange(1, 366)
+    if steps_per_day == 1:
+        return xr.DataArray(mean, coords=coords, dims=['dayofyear'] + dims, name=da.name)
+
+    coords['hour'] = np.arange(steps_per_day) * 24 / steps_per_day
+    mean = mean.reshape((365, steps_per_day) + mean.shape[1:])
+    return xr.DataArray(mean, coords=coords, dims=['dayofyear', 'hour'] + dims, name=da.name)
+
+
+def calc_daily_climatology(da, drop='jun30', steps_per_day=1, period=CLIM_PERIOD, time_block=TIME_BLOCK):
+    """
     Calculate daily mean climatology following SNAPSI protocol (remove 30 June on leap years)
 
     Parameters:
-    da (xarray.DataArray): with dimensions (time, lat, lon)
+    da (xarray.DataArray): with dimensions (time, ...), e.g. (time, lat, lon); may be dask-backed.
+    drop (str, optional): The day removed from leap years, 'jun30' or 'feb29'. Default is 'jun30'.
+    steps_per_day (int, optional): Time-of-day slots per day, e.g. 4 for a 6-hourly climatology. Default is 1.
+    period (tuple, optional): The climatology period. Default is 1980-2019, as defined in the SNAPSI protocol paper.
+    time_block (int, optional): The number of time steps read at once. Default is 124.
+
+    Returns:
+    xarray.DataArray: The daily climatology data with dimensions (365 days, ...).
+    """
+    sums, counts = init_climatology_sums(da, steps_per_day)
+    add_to_climatology(sums, counts, da, drop, steps_per_day, period, time_block)
+
+    return finish_climatology(sums, counts, da, steps_per_day)
+
+
+def calc_daily_climatology_files(files, variable, drop='jun30', steps_per_day=1, period=CLIM_PERIOD, time_block=TIME_BLOCK):
+    """
+    Calculate daily mean climatology from a record split into (e.g. yearly) files, one file at a time,
+    so that the full record never has to be in memory.
+
+    Parameters:
+    files (list): The paths of the files, each holding variable on the same grid.
+    variable (str): The name of the variable.
+    See calc_daily_climatology for the other parameters.
+
     Returns:
-    xarray.DataArray: The daily climatology data with dimensions (365 days, lat, lon).
+    xarray.DataArray: The daily climatology data with dimensions (365 days, ...).
     """
- 
-    # Climatology period defined in SNAPSI protocol paper
-    da = da.sel(time=slice('1980-01-01', '2019-12-31'))
-    # Remover 30 June on leap years
-    da_noleap = da.sel(time=~((da.time.dt.month == 6) & (da.time.dt.day == 30) & (da.time.dt.year % 4 == 0)))
-    # Make a noleap calendar
-    noleap_cal = xr.cftime_range(start='1980-01-01',periods=len(da_noleap.time),freq='D',calendar='noleap')
-    # Make new DataArray with the noleap calendar
-    da_noleap = xr.DataArray(data=da_noleap.data, coords={"time":noleap_cal,"lat":da_noleap.lat,"lon":da_noleap.lon})
-    # Average by day of year
-    daily_clim = da_noleap.groupby('time.dayofyear').mean('time')
+    sums = counts = template = None
+    for fname in files:
+        with xr.open_dataset(fname) as ds:
+            da = ds[variable]
+            if sums is None:
+                sums, counts = init_climatology_sums(da, steps_per_day)
+                template = da.isel(time=0, drop=True)
+            add_to_climatology(sums, counts, da, drop, steps_per_day, period, time_block)
 
-    return daily_clim
+    return finish_climatology(sums, counts, template, steps_per_day)
 
 
 if __name__ == '__main__':
@@ -75,3 +212,6 @@ if __name__ == '__main__':
 
     daily_clim_smoothed = smooth_climatology(daily_clim)
 
+    # Store to disk, to be loaded (and memory-mapped) by anomalies.load_climatology
+    xr.Dataset({variable: daily_clim_smoothed}).to_netcdf('./%s_climatology.nc' % variable)
+
@@ -1,5 +1,8 @@
 import numpy as np
 import os
+import functools
+import pandas as pd
+import xarray as xr
 
 gws = '/gws/nopw/j04/snapsi/processed/'
 archive = '/badc/snap/data/post-cmip6/SNAPSI/'
@@ -24,11 +27,21 @@ tables = {
     '6hrPtZ' : [ 'o3', 'epfy', 'epfz', 'vtem', 'wtem' ]
 }
 
+archive_template = '{root}{center}/{model}/{experiment}/{start_date}/{variant_id}/{table}/{variable}/{grid}/{version}/'
+archive_dir_keys = ('center', 'model', 'experiment', 'start_date', 'variant_id', 'table', 'variable', 'grid', 'version')
+archive_grid_keys = ('model', 'experiment', 'start_date', 'variable', 'member')
+
+# dask chunks of datasets opened from the archive; one chunk per
+# file along everything but time, which is split into blocks
+default_chunks = {'time': 40}
+
+variable_tables = {variable : table for table, variables in tables.items() for variable in variables}
+
 def get_variable_table(variable):
-    for key, table in tables.items():
-        if variable in table: return key
+    if variable not in variable_tables:
+        raise ValueError('Unrecognized variable name %s' % variable)
 
-    raise ValueError('Unrecognized variable name %s' % variable)
+    return variable_tables[variable]
     
 def get_processed_base_path(model, experiment, start_date):
     keys = dict(root = gws, \
@@ -58,11 +71,174 @@ def get_archive_base_path(model, experiment, start_date, variable, member, grid
     keys['variant_id'] = variant_id_templates[model].format(member = member)    
     keys['table']      = get_variable_table(variable)
     
-    template = '{root}{center}/{model}/{experiment}/{start_date}/{variant_id}/{table}/{variable}/{grid}/{version}/'
-    return template.format(**keys)
+    return archive_template.format(**keys)
 
-def open_archive_var(model, experiment, start_date, variable, member, grid = None, version = None):
-    root = get_archive_base_path(model, experiment, start_date, variable, member, grid, version)
+def parse_archive_path(path):
+    '''
+        Recover the DRS components of an archive file from its path alone,
+        i.e., the inverse of get_archive_base_path (plus the file name)
 
-    
+        - the file is never opened, so this only costs string operations
+        - the directory tree and the file name must agree, otherwise the
+          path does not follow the CMOR conventions and ValueError is raised
+        - time_range is None for files without one in their name
+    '''
+    parts = str(path).split('/')
+    if len(parts) < 10 or not parts[-1].endswith('.nc'):
+        raise ValueError('Not a SNAPSI archive file path %s' % path)
+
+    keys = dict(zip(archive_dir_keys, parts[-10:-1]))
+
+    fields = parts[-1][:-len('.nc')].split('_')
+    if len(fields) not in (6, 7):
+        raise ValueError('Unrecognized archive file name %s' % parts[-1])
+    if len(fields) == 6: fields.append(None)
+
+    variable, table, model, experiment, member_str, grid, time_range = fields
+    expected = dict(variable = variable, table = table, model = model, experiment = experiment, \
+                    start_date = member_str.split('-')[0], variant_id = member_str.split('-')[-1], grid = grid)
+    for key, value in expected.items():
+        if keys[key] != value:
+            raise ValueError('Directory and file name disagree on %s for %s' % (key, path))
+
+    keys['time_range'] = time_range
+    return keys
+
+@functools.lru_cache(maxsize = None)
+def list_archive_dir(path):
+    '''
+        Sorted names of the entries of an archive directory, or () if it does not exist
+
+        - memoized, since the archive is read-only: every directory is only
+          listed once per process, however many paths are resolved through it
+        - call list_archive_dir.cache_clear() to pick up newly published data
+    '''
+    try:
+        return tuple(sorted(os.listdir(path)))
+    except (FileNotFoundError, NotADirectoryError):
+        return ()
+
+def get_latest_version(grid_path):
+    '''
+        The most recent version directory (vYYYYMMDD) under a grid directory, or None
+    '''
+    versions = [name for name in list_archive_dir(grid_path) if name.startswith('v')]
+    return versions[-1] if len(versions) > 0 else None
+
+def get_archive_base_paths(models, experiments, start_dates, variables, members, grid = None, version = None):
+    '''
+        get_archive_base_path for every combination of the given models,
+        experiments, start dates, variables and members at once
+
+        - returns a DataFrame with one row per combination, holding its keys
+          (see archive_grid_keys) and its base path in 'path'
+        - the paths are built with vectorized string operations, so
+          resolving thousands of combinations costs about as much as one
+        - version = 'latest' picks the most recent version directory of each
+          combination; combinations without any have a path of NaN
+    '''
+    df = pd.MultiIndex.from_product([models, experiments, start_dates, variables, members], \
+                                    names = archive_grid_keys).to_frame(index = False)
+
+    unknown = sorted(set(variables) - set(variable_tables))
+    if len(unknown) > 0:
+        raise ValueError('Unrecognized variable names %s' % ', '.join(unknown))
+
+    df['variant_id'] = [variant_id_templates[model].format(member = member) for model, member in zip(df.model, df.member)]
+    df['table']      = df.variable.map(variable_tables)
+    df['grid']       = df.model.map(default_grids) if grid is None else grid
+
+    grid_paths = archive + df.model.map(centers) + '/' + df.model + '/' + df.experiment + '/' + df.start_date + '/' + \
+                 df.variant_id + '/' + df.table + '/' + df.variable + '/' + df.grid + '/'
+
+    if version == 'latest':
+        df['version'] = [get_latest_version(path) for path in grid_paths]
+    else:
+        df['version'] = df.model.map(default_versions) if version is None else version
+
+    df['path'] = grid_paths + df.version + '/'
+    return df
+
+def find_archive_files(base_paths):
+    '''
+        Expand a DataFrame of base paths (from get_archive_base_paths) into one
+        row per netcdf file found in each directory, with its full path in 'path'
+
+        - every directory is listed once (see list_archive_dir)
+        - combinations without any files are dropped
+    '''
+    files = base_paths.dropna(subset = ['path']).copy()
+    files['file'] = [[name for name in list_archive_dir(path) if name.endswith('.nc')] for path in files.path]
+
+    files = files.explode('file').dropna(subset = ['file'])
+    files['path'] = files.path + files.file
+    return files.drop(columns = 'file').reset_index(drop = True)
+
+def _select_archive_member(variable, ds):
+    '''
+        Preprocess an archive file for open_mfdataset: keep only its variable, and
+        give it a member_id dimension from the variant_id in its path
+    '''
+    variant_id = parse_archive_path(ds.encoding['source'])['variant_id']
+    return ds[[variable]].expand_dims(member_id = [variant_id])
+
+def open_archive(model, experiment, start_date, variables, members, grid = None, version = None, chunks = None):
+    '''
+        Lazily open variables of members of one model/experiment/start date
+        straight from the archive, as a single dask-backed dataset
+
+        - a fast, uniform alternative to opening the data through the intake catalog
+        - members are combined along a member_id dimension (with variant ids as
+          coordinates), and the files of each member along time
+        - chunks defaults to default_chunks; the files are opened in parallel
+        - all variables must share their coordinates (e.g., be from the same table),
+          and be available for the same members
+        - raises FileNotFoundError if the archive has none of the requested data
+    '''
+    if chunks is None: chunks = default_chunks
+
+    base_paths = get_archive_base_paths([model], [experiment], [start_date], variables, members, grid, version)
+    files = find_archive_files(base_paths)
+    if len(files) == 0:
+        raise FileNotFoundError('No archive files for %s %s %s %s' % (model, experiment, start_date, ', '.join(variables)))
+
+    datasets = []
+    for variable, var_files in files.groupby('variable', sort = False):
+        datasets.append(xr.open_mfdataset(list(var_files.path), \
+                                          preprocess = functools.partial(_select_archive_member, variable), \
+                                          combine = 'by_coords', \
+                                          chunks = chunks, \
+                                          data_vars = 'minimal', \
+                                          coords = 'minimal', \
+                                          compat = 'override', \
+                                          parallel = True))
+
+    # open_mfdataset orders the members lexically (r10 before r2), so put
+    # them back in the order they were asked for
+    ds = xr.merge(datasets, join = 'exact', combine_attrs = 'drop_conflicts')
+    return ds.sel(member_id = list(pd.unique(files.variant_id)))
+
+def open_archive_var(model, experiment, start_date, variable, member, grid = None, version = None, chunks = None):
+    '''
+        Lazily open one variable of one member from the archive as a DataArray
+    '''
+    ds = open_archive(model, experiment, start_date, [variable], [member], grid, version, chunks)
+
+    return ds[variable].isel(member_id = 0)
+
+
+
+def lead_times(time, start_date):
+    '''
+        Lead time (timedelta64) of each time step of the time coordinate time from the
+        initialization of start_date (e.g., 's20180125')
+
+        - the initialization is built in the calendar of time, so that model time axes
+          decoded as cftime (e.g., 360_day or noleap calendars) work as well
+    '''
+    index = time.to_index()
+    init = '%s-%s-%s' % (start_date[1:5], start_date[5:7], start_date[7:9])
+    init = xr.date_range(init, periods = 1, calendar = time.dt.calendar, \
+                         use_cftime = isinstance(index, xr.CFTimeIndex))[0]
 
+    return np.asarray(index - init).astype('timedelta64[ns]')
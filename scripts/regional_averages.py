@@ -0,0 +1,187 @@
+import numpy as np
+import xarray as xr
+import scipy.sparse
+import hashlib
+import argparse
+
+import paths
+from vertical_interpolation import get_plev_dim
+from anomalies import load_climatology, subtract_climatology
+
+# regions, as a latitude band (lo, hi) averaged with cos(lat) weights, or a single
+# latitude (interpolated linearly between the neighbouring rows), optionally
+# narrowed down to a longitude range (lo, hi), which may cross the dateline
+regions = {
+    'polar_cap_60N' : dict(lat = (60, 90)),
+    'polar_cap_60S' : dict(lat = (-90, -60)),
+    '60N'           : dict(lat = 60),
+    '60S'           : dict(lat = -60),
+    'tropics'       : dict(lat = (-20, 20)),
+    'north_atlantic': dict(lat = (20, 80), lon = (-90, 40)),
+}
+
+# standard time series: (variable, pressure level in Pa, region)
+standard_series = {
+    'U60N_10hPa'     : ('ua', 1000.,  '60N'),
+    'U60S_10hPa'     : ('ua', 1000.,  '60S'),
+    'T_polar_cap_60N_100hPa' : ('ta', 10000., 'polar_cap_60N'),
+    'T_polar_cap_60S_100hPa' : ('ta', 10000., 'polar_cap_60S'),
+}
+
+# pressure levels (Pa) are matched within this, as files store them in float32 or in hPa * 100
+plev_tolerance = 1.
+
+# weight masks already built, by grid hash and region names
+_masks = {}
+
+def grid_hash(lat, lon):
+    sha = hashlib.sha1()
+    for values in (lat, lon):
+        sha.update(np.ascontiguousarray(values, dtype = np.double).tobytes())
+        sha.update(b'|')
+    return sha.hexdigest()[:16]
+
+def region_weights(lat, lon, region):
+    '''
+        Weights (nlat x nlon, summing to 1) of the average over a region on a (lat, lon) grid
+
+        - bands are weighted with cos(lat), single latitudes are interpolated
+          linearly between the neighbouring rows and averaged zonally
+    '''
+    lat = np.asarray(lat, dtype = np.double)
+    lon = np.asarray(lon, dtype = np.double)
+
+    if np.isscalar(region['lat']):
+        order = np.argsort(lat)
+        j = np.clip(np.searchsorted(lat[order], region['lat']) - 1, 0, len(lat) - 2)
+        lo, hi = lat[order][j], lat[order][j + 1]
+        if not lo <= region['lat'] <= hi:
+            raise ValueError('Latitude %s is outside of the grid' % region['lat'])
+        lat_weights = np.zeros(len(lat))
+        lat_weights[order[j]]     = (hi - region['lat']) / (hi - lo)
+        lat_weights[order[j + 1]] = (region['lat'] - lo) / (hi - lo)
+    else:
+        lo, hi = region['lat']
+        lat_weights = np.where((lat >= lo) & (lat <= hi), np.cos(np.radians(lat)), 0.)
+
+    lon_weights = np.ones(len(lon))
+    if 'lon' in region:
+        lo, hi = region['lon']
+        lon_weights = (((lon - lo) % 360) <= ((hi - lo) % 360)).astype(np.double)
+
+    weights = lat_weights[:, None] * lon_weights[None, :]
+    if weights.sum() == 0:
+        raise ValueError('Region %s has no grid points' % region)
+
+    return weights / weights.sum()
+
+def region_masks(lat, lon, names):
+    '''
+        Sparse matrix (regions x grid points) of the region weights on a (lat, lon) grid
+
+        - built once per grid and set of regions, and memoized
+    '''
+    key = (grid_hash(lat, lon), tuple(names))
+    if key not in _masks:
+        _masks[key] = scipy.sparse.csr_matrix(np.stack([region_weights(lat, lon, regions[name]).ravel() for name in names]))
+
+    return _masks[key]
+
+def _apply_masks(x, masks):
+    '''
+        Averages over the regions of masks of x (..., lat, lon) -> (..., region)
+    '''
+    shape = x.shape[:-2]
+    averages = masks @ x.reshape(-1, x.shape[-2] * x.shape[-1]).T
+    return np.asarray(averages).T.reshape(shape + (masks.shape[0],)).astype(x.dtype)
+
+def regional_averages(da, names = None):
+    '''
+        Averages of da over the regions names (all regions by default), along a new region dimension
+
+        - all regions are computed from the same pass over the data, as one sparse
+          matrix product per block (lazily for dask arrays, which must not be chunked in lat/lon)
+        - no longitude rotation, sorting or selection of the data is needed
+    '''
+    if names is None: names = list(regions)
+
+    masks = region_masks(da['lat'].values, da['lon'].values, tuple(names))
+    averages = xr.apply_ufunc(_apply_masks, da, \
+                              kwargs = dict(masks = masks), \
+                              input_core_dims = [['lat', 'lon']], \
+                              output_core_dims = [['region']], \
+                              dask = 'parallelized', \
+                              output_dtypes = [da.dtype], \
+                              dask_gufunc_kwargs = dict(output_sizes = dict(region = len(names))))
+
+    return averages.assign_coords(region = list(names))
+
+def select_levels(da, levels):
+    '''
+        The pressure levels (Pa) of da nearest to levels (within plev_tolerance), with
+        the level dimension (plev or snap34) renamed to plev and labelled with levels
+    '''
+    dim = get_plev_dim(da)
+    da = da.sel({dim : levels}, method = 'nearest', tolerance = plev_tolerance)
+
+    return da.rename({dim : 'plev'}).assign_coords(plev = levels)
+
+def standard_time_series(model, experiment, start_date, members, series = standard_series, climatologies = None):
+    '''
+        The standard regional time series of all members of a model/experiment/start date
+
+        - each variable is read once (only at the levels needed), for all of its series
+        - anomalies, for the variables with a climatology file in climatologies (see
+          anomalies.load_climatology), from the same regional averages of the climatology
+        - returns a Dataset with one (member_id, lead_time) variable per series, with
+          the valid time of each lead time as a coordinate
+    '''
+    if climatologies is None: climatologies = {}
+
+    ds = xr.Dataset()
+    for variable in sorted(set(var for var, _, _ in series.values())):
+        var_series = {name: (plev, region) for name, (var, plev, region) in series.items() if var == variable}
+        levels = sorted(set(plev for plev, _ in var_series.values()))
+        names = sorted(set(region for _, region in var_series.values()))
+
+        da = paths.open_archive(model, experiment, start_date, [variable], members, version = 'latest')[variable]
+        da = select_levels(da, levels)
+        averages = regional_averages(da, names).compute()
+        if variable in climatologies:
+            clim = load_climatology(climatologies[variable], variable)
+            clim = select_levels(clim, levels)
+            averages = subtract_climatology(averages, regional_averages(clim, names))
+        for name, (plev, region) in var_series.items():
+            ds[name] = averages.sel(plev = plev, region = region, drop = True)
+
+    ds = ds.assign_coords(lead_time = ('time', paths.lead_times(ds['time'], start_date)))
+    return ds.swap_dims(time = 'lead_time').rename(time = 'valid_time')
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type = str, nargs = '*', default = paths.models)
+    parser.add_argument('--experiments', type = str, nargs = '*', default = paths.experiments)
+    parser.add_argument('--start_dates', type = str, nargs = '*', default = paths.start_dates)
+    parser.add_argument('--members', type = int, nargs = '*', default = list(range(1, 51)))
+    parser.add_argument('--climatologies', type = str, nargs = '*', default = [], \
+                        help = 'climatology files (from calc_climatology.py) as variable=path, for anomalies')
+    parser.add_argument('--output', type = str, default = './snapsi_regional_time_series.nc')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_commandline_args()
+
+    variables = sorted(set(var for var, _, _ in standard_series.values()))
+    climatologies = dict(item.split('=', 1) for item in args.climatologies)
+    files = paths.find_archive_files(paths.get_archive_base_paths(args.models, args.experiments, args.start_dates, \
+                                                                  variables, args.members, version = 'latest'))
+
+    targets = []
+    for (model, experiment, start_date), target in files.groupby(['model', 'experiment', 'start_date'], sort = False):
+        print('%s %s %s (%d members)' % (model, experiment, start_date, target.member.nunique()))
+        ds = standard_time_series(model, experiment, start_date, sorted(target.member.unique()), climatologies = climatologies)
+        targets.append(ds.expand_dims('target').assign_coords(model = ('target', [model]), \
+                                                              experiment = ('target', [experiment]), \
+                                                              init = ('target', [start_date])))
+
+    xr.concat(targets, dim = 'target', join = 'outer').to_netcdf(args.output)
@@ -0,0 +1,73 @@
+import numpy as np
+import xarray as xr
+import functools
+
+# reference pressure of the log-pressure coordinate -log(p/ps)
+ps = 100000.
+
+# names of the pressure level dimension in the archive (some models used 'snap34')
+plev_dims = ('plev', 'snap34')
+
+def get_plev_dim(da):
+    for dim in plev_dims:
+        if dim in da.dims: return dim
+
+    raise ValueError('No pressure level dimension (%s) in %s' % (', '.join(plev_dims), da.name))
+
+@functools.lru_cache(maxsize = 256)
+def log_pressure_weights(source, target, ps = ps):
+    '''
+        Weights of linear interpolation in log-pressure from the source onto the target
+        pressure levels (tuples, in the same units as ps)
+
+        - sparse: every target level is a weighted sum of (at most) two neighbouring
+          source levels, given as index and weight arrays (lower, upper, w_lower, w_upper)
+        - target levels outside the range of the source levels are flagged in valid
+          (False), and become NaN, as with xarray.interp
+        - the neighbours are chosen as by xarray.interp (scipy's interp1d), so that
+          missing values spread the same way: a target level on a source level also
+          uses the source level below it in log-pressure (with a zero weight), and
+          is NaN if that level is
+        - memoized, since diagnostics interpolate between a handful of level sets
+    '''
+    x  = -np.log(np.asarray(source, dtype = np.double) / ps)
+    xt = -np.log(np.asarray(target, dtype = np.double) / ps)
+
+    order = np.argsort(x)
+    xs = x[order]
+    valid = (xt >= xs[0]) & (xt <= xs[-1])
+    if len(xs) == 1:
+        zeros = np.zeros(len(xt), dtype = int)
+        return zeros, zeros, np.ones(len(xt)), np.zeros(len(xt)), valid
+
+    j = np.clip(np.searchsorted(xs, xt, side = 'left') - 1, 0, len(xs) - 2)
+    w_upper = (xt - xs[j]) / (xs[j + 1] - xs[j])
+
+    return order[j], order[j + 1], 1 - w_upper, w_upper, valid
+
+def log_pressure_interpolation(da, plev, ps = ps):
+    '''
+        Interpolate da linearly in log-pressure onto the pressure levels plev
+
+        - a reusable replacement for rewriting the plev coordinate and calling
+          xarray.interp: the weights are computed once per pair of level sets
+          (see log_pressure_weights) and applied as a two-point gather and sum
+        - works lazily on dask arrays, and without copying the data beforehand
+        - the level dimension of da may be named plev or snap34; the result has plev
+    '''
+    dim = get_plev_dim(da)
+    target = np.asarray(plev, dtype = np.double)
+
+    lower, upper, w_lower, w_upper, valid = log_pressure_weights(tuple(da[dim].values.tolist()), tuple(target.tolist()), ps)
+
+    w_lower = xr.DataArray(np.where(valid, w_lower, np.nan).astype(da.dtype), dims = 'plev')
+    w_upper = xr.DataArray(np.where(valid, w_upper, 0).astype(da.dtype), dims = 'plev')
+
+    levels = da.drop_vars(dim)
+    interpolated = levels.isel({dim : xr.DataArray(lower, dims = 'plev')}) * w_lower + \
+                   levels.isel({dim : xr.DataArray(upper, dims = 'plev')}) * w_upper
+    interpolated = interpolated.assign_coords(plev = target).transpose(*[d if d != dim else 'plev' for d in da.dims])
+    interpolated.attrs = da.attrs
+    interpolated.name = da.name
+
+    return interpolated
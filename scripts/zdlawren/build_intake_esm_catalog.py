@@ -1,92 +1,458 @@
-""" This python script tries to generate an intake catalog 
-of the SNAPSI data archive. Since the SNAPSI output data are 
-all CMORized, we can simply make use of ecgtools to parse 
-the files. 
-
-Running this script on sci3 took over 13 hours to generate 
-the intake catalog containing only 5 models. Not sure if it 
-would complete faster on the LOTUS cluster, but it's clear 
-that as more models get added, it would be more efficient 
-to make "sub-catalogs" of individual models and try to 
-combine/merge them into the overall "master" catalog. 
-As of this moment, not 100% sure how to accomplish this!
+""" This python script tries to generate an intake catalog
+of the SNAPSI data archive. Since the SNAPSI output data are
+all CMORized, we can simply make use of ecgtools to parse
+the files.
+
+Running the original version of this script on sci3 took over
+13 hours to generate the intake catalog containing only 5 models,
+since every file in the archive was re-parsed on every run, and
+ecgtools.parsers.parse_cmip6 opens every file to read its global
+attributes. By default, entries are now built from the CMOR
+directory structure and file names (see parse_archive_path in
+scripts/paths.py), with the units and names of each variable read
+from one file per model, and only a few randomly chosen files per
+run are opened to spot-check that the DRS agrees with their
+attributes (use --parser cmip6 to parse all the headers). The
+catalog is now built incrementally as a set of "sub-catalogs"
+(shards), one per institution_id/source_id directory of the
+archive. Each shard keeps a manifest of the path, mtime, and size
+of every file it has parsed, so that re-running the script only
+parses files that are new or have changed since the last run. The
+shards are then merged into the overall "master" catalog that the
+other scripts (e.g., zmd_snapsi.py) open with intake. The merged
+entries are also written as a Parquet dataset partitioned by
+source_id and sub_experiment_id, which catalog_query.py can search
+without reading the whole catalog.
+
+Adding a new model to the catalog thus only requires parsing the
+files of that model:
+
+    python build_intake_esm_catalog.py --sources GloSea6
+
+and re-merging the shards is cheap enough to do on every run
+(or on its own with --merge_only).
 
 Original Author: Z. D. Lawrence
-Last modified: 2023-04-25
+Last modified: 2026-10-17
 """
 
-import pickle
+import os
+import sys
+import shutil
+import json
+import random
+import argparse
+import pathlib
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
+import pandas as pd
+import xarray as xr
+import pyarrow as pa
+import pyarrow.parquet as pq
 from ecgtools import Builder
 from ecgtools.parsers import parse_cmip6
 
-# Location of SNAPSI data
-root_path = "/badc/snap/data/post-cmip6/SNAPSI/"
-
-# Set up the ecgtools builder; have to go to a depth of 9
-# to get all of the available models. Theoretically, the 
-# above root path could be modified to a specific model center
-# directory (in which case a depth of 8 would be necessary).
-# May need to do this when more SNAPSI data comes in but
-# TODO: figure out how to combine catalogs (so that we do not
-# have to repeat work)
-print(f"Initializing builder object with {root_path}")
-builder = Builder(paths=[root_path], extension=".nc", depth=9, njobs=12)
-
-# As far as I can tell, the get_assets method stores all the 
-# potential files that will be iterated over to check and assign
-# attributes (e.g., variable ids, experiment ids, etc)
-assets_start = datetime.now()
-print(f"Getting target assets, starting {assets_start}")
-builder.get_assets()
-assets_end = datetime.now()
-print(f"Finished obtaining assets at {assets_end}; duration {assets_end-assets_start}")
-
-# Build the catalog. This part takes a long time!
-build_start = datetime.now()
-print(f"Building the catalog, starting {build_start}")
-builder.build(parsing_func=parse_cmip6)
-build_end = datetime.now()
-print(f"Finished building catalog at {build_end}; duration {build_end-build_start}")
-
-# If we successfully build the catalog, pickle it so we
-# can come back to the generated object without having to 
-# redo all the work ...
-print(f"Trying to pickle the finished build object")
-with open("snapsi_built_catalog.pkl", "wb") as cat_pkl:
+# paths.py lives one directory up, with the rest of the common code
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import paths
+from catalog_query import PARTITION_COLS, get_parquet_path
+
+# Location of SNAPSI data, and where the catalog lives
+ROOT_PATH = pathlib.Path("/badc/snap/data/post-cmip6/SNAPSI/")
+CATALOG_DIR = pathlib.Path("/gws/nopw/j04/snapsi/")
+CATALOG_NAME = "test-snapsi-catalog-fast"
+
+# How intake-esm should aggregate query results into datasets
+GROUPBY_ATTRS = [
+    'activity_id',
+    'institution_id',
+    'source_id',
+    'experiment_id',
+    'table_id',
+    'grid_label',
+]
+AGGREGATIONS = [
+    {'type': 'union', 'attribute_name': 'variable_id'},
+    {
+        'type': 'join_existing',
+        'attribute_name': 'time_range',
+        'options': {'dim': 'time', 'coords': 'minimal', 'compat': 'override'},
+    },
+    {
+        'type': 'join_new',
+        'attribute_name': 'member_id',
+        'options': {'coords': 'minimal', 'compat': 'override'},
+    },
+]
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default=str(ROOT_PATH), help="root of the SNAPSI archive")
+    parser.add_argument("--catalog_dir", type=str, default=str(CATALOG_DIR), help="where to put the master catalog")
+    parser.add_argument("--name", type=str, default=CATALOG_NAME, help="name of the master catalog (no extension)")
+    parser.add_argument("--sources", type=str, nargs="*", default=None, help="only update shards of these source_ids")
+    parser.add_argument("--njobs", type=int, default=12, help="number of parallel parsing jobs")
+    parser.add_argument("--parser", type=str, default="drs", choices=["drs", "cmip6"], help="build entries from paths (drs) or file headers (cmip6)")
+    parser.add_argument("--spot_check", type=int, default=3, help="number of files per shard update to check against their headers")
+    parser.add_argument("--rescan", action="store_true", help="ignore the manifests and re-parse every file")
+    parser.add_argument("--merge_only", action="store_true", help="only merge existing shards into the master catalog")
+    return parser.parse_args()
+
+
+def find_shard_dirs(root, sources=None):
+    """ Find the {institution_id}/{source_id} directories
+    of the archive, each of which becomes its own shard. If
+    sources is given, only directories of those source_ids
+    are returned.
+    """
+    shard_dirs = []
+    for center in sorted(os.scandir(root), key=lambda entry: entry.name):
+        if not center.is_dir():
+            continue
+        for model in sorted(os.scandir(center.path), key=lambda entry: entry.name):
+            if not model.is_dir():
+                continue
+            if (sources is not None) and (model.name not in sources):
+                continue
+            shard_dirs.append(pathlib.Path(model.path))
+    return shard_dirs
+
+
+def scan_dir(top, extension=".nc"):
+    """ Recursively scan a directory with os.scandir and return a
+    dict mapping each file path to its (mtime, size). This only
+    touches file metadata, and never opens the files themselves.
+    """
+    found = {}
+    stack = [top]
+    while len(stack) != 0:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(extension):
+                    stat = entry.stat()
+                    found[entry.path] = [stat.st_mtime, stat.st_size]
+    return found
+
+
+def scan_files(shard_dir, extension=".nc", njobs=12):
+    """ Scan all the files of a shard, fanning the scan out over
+    its {experiment}/{start_date} directories with a thread pool
+    (the work is dominated by waiting on filesystem metadata).
+    """
+    subdirs = [
+        init.path
+        for exp in os.scandir(shard_dir) if exp.is_dir()
+        for init in os.scandir(exp.path) if init.is_dir()
+    ]
+    found = {}
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        for result in pool.map(lambda subdir: scan_dir(subdir, extension), subdirs):
+            found.update(result)
+    return found
+
+
+# Catalog columns that parse_drs can fill in, and that should
+# agree with the global attributes of the files
+DRS_COLUMNS = [
+    'activity_id',
+    'institution_id',
+    'source_id',
+    'experiment_id',
+    'sub_experiment_id',
+    'variant_label',
+    'table_id',
+    'variable_id',
+    'grid_label',
+    'frequency',
+]
+
+# Frequency (global attribute) of the files of each CMOR table
+TABLE_FREQUENCIES = {
+    '6hr': '6hr',
+    '6hrZ': '6hr',
+    '6hrPt': '6hrPt',
+    '6hrPtZ': '6hrPt',
+}
+
+# Formats of the times in CMOR file names, by their length
+DRS_TIME_FORMATS = {
+    4: "%Y",
+    6: "%Y%m",
+    8: "%Y%m%d",
+    10: "%Y%m%d%H",
+    12: "%Y%m%d%H%M",
+    14: "%Y%m%d%H%M%S",
+}
+
+
+def parse_drs_time(time_str):
+    """ Convert a time from a CMOR file name (e.g., 201801250600) to
+    the format parse_cmip6 gives start_time and end_time in (that of
+    the cftime dates it reads, e.g., 2018-01-25 06:00:00)
+    """
+    if len(time_str) not in DRS_TIME_FORMATS:
+        raise ValueError(f"Unrecognized time {time_str}")
+    return datetime.strptime(time_str, DRS_TIME_FORMATS[len(time_str)]).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Attributes of each (source_id, table_id, variable_id), read from the
+# first of its files that parse_drs comes across
+_variable_attrs = {}
+
+
+def read_variable_attrs(file, model, table, variable):
+    """ The attributes of a variable that parse_cmip6 reads from each
+    file header (standard_name, long_name, units and vertical_levels),
+    read from the header of file once per model, table and variable
+    """
+    key = (model, table, variable)
+    if key not in _variable_attrs:
+        try:
+            with xr.open_dataset(file, decode_times=False) as ds:
+                attrs = {attr: ds[variable].attrs.get(attr) for attr in ['standard_name', 'long_name', 'units']}
+                attrs['vertical_levels'] = next(
+                    (ds[coord].size for coord in ds[variable].coords if ds[coord].attrs.get('axis') == 'Z'), 1
+                )
+        except (OSError, ValueError, KeyError):
+            return {attr: None for attr in ['standard_name', 'long_name', 'units', 'vertical_levels']}
+        _variable_attrs[key] = attrs
+    return _variable_attrs[key]
+
+
+def parse_drs(file):
+    """ Build a catalog entry from the DRS path of a file alone,
+    opening at most one file per model, table and variable (for the
+    attributes of the variable). Files whose paths don't follow the
+    CMOR conventions, or that have no time range in their names, are
+    opened and parsed with parse_cmip6 instead. The entries have the
+    same columns and time_range format as those of parse_cmip6, so
+    that the two can be mixed in a catalog. The activity_id is the
+    name of the directory the institution_id directories are in,
+    i.e., of the root of the archive being scanned.
+    """
     try:
-        pickle.dump(builder, cat_pkl)
-    except Exception:
-        print("Unable to pickle the build object!")
-
-# Actually save the catalog in a form that intake
-# will accept for reading
-print(f"Trying to save the catalog to csv")
-builder.save(
-    name='test-snapsi-catalog.csv',
-    path_column_name='path',
-    variable_column_name='variable_id',
-    data_format='netcdf',
-    groupby_attrs=[
-        'activity_id',
-        'institution_id',
-        'source_id',
-        'experiment_id',
-        'table_id',
-        'grid_label',
-    ],
-    aggregations=[
-        {'type': 'union', 'attribute_name': 'variable_id'},
-        {
-            'type': 'join_existing',
-            'attribute_name': 'time_range',
-            'options': {'dim': 'time', 'coords': 'minimal', 'compat': 'override'},
-        },
-        {
-            'type': 'join_new',
-            'attribute_name': 'member_id',
-            'options': {'coords': 'minimal', 'compat': 'override'},
-        },
-    ],
-)
+        keys = paths.parse_archive_path(file)
+        start_time, end_time = [parse_drs_time(t) for t in keys['time_range'].split('-')]
+        activity_id = pathlib.Path(file).parents[9].name
+    except (ValueError, AttributeError, IndexError):
+        return parse_cmip6(file)
+
+    info = {
+        'activity_id': activity_id,
+        'institution_id': keys['center'],
+        'source_id': keys['model'],
+        'experiment_id': keys['experiment'],
+        'sub_experiment_id': keys['start_date'],
+        'variant_label': keys['variant_id'],
+        'member_id': keys['variant_id'],
+        'table_id': keys['table'],
+        'variable_id': keys['variable'],
+        'grid_label': keys['grid'],
+        'frequency': TABLE_FREQUENCIES.get(keys['table']),
+        **read_variable_attrs(file, keys['model'], keys['table'], keys['variable']),
+        'init_year': int(keys['start_date'][1:5]),
+        'start_time': start_time,
+        'end_time': end_time,
+        'time_range': f"{start_time}-{end_time}",
+        'path': str(file),
+        'version': keys['version'],
+    }
+    return info
+
+
+def spot_check(df, num_files):
+    """ Open a few randomly chosen files and compare their global
+    attributes to the entries built by parse_drs. Entries that
+    disagree are replaced by what the headers say.
+    """
+    checked = random.sample(list(df.index), min(num_files, len(df)))
+    for ix in checked:
+        info = parse_cmip6(df.at[ix, 'path'])
+        if "INVALID_ASSET" in info:
+            print(f"\t(WARNING) Unable to open {df.at[ix, 'path']} for spot check")
+            continue
+        mismatched = [col for col in DRS_COLUMNS if info.get(col) != df.at[ix, col]]
+        if len(mismatched) != 0:
+            print(f"\t(WARNING) DRS and attributes of {df.at[ix, 'path']} disagree on {mismatched}; consider --parser cmip6")
+            for col in mismatched:
+                df.at[ix, col] = info.get(col)
+    return df
+
+
+def load_manifest(manifest_file):
+    """ Load a shard manifest, or an empty one if it does not exist """
+    if not manifest_file.exists():
+        return {}
+    with open(manifest_file, "r") as fi:
+        return json.load(fi)
+
+
+def write_atomically(write_func, output_file):
+    """ Write output_file via a temporary file in the same directory
+    so that readers (e.g., running SLURM jobs opening the catalog)
+    never see a partially written file.
+    """
+    tmp_file = output_file.with_name(f".{output_file.name}.tmp")
+    write_func(tmp_file)
+    os.replace(tmp_file, output_file)
+
+
+def parse_files(files, njobs, parser="drs", num_spot_checks=3):
+    """ Parse a list of files with ecgtools, returning the
+    cleaned dataframe of catalog entries.
+    """
+    # parse_drs is cheap enough that spawning workers would only slow it down
+    if parser == "drs":
+        njobs, parsing_func = 1, parse_drs
+    else:
+        parsing_func = parse_cmip6
+
+    builder = Builder(paths=[str(ROOT_PATH)], joblib_parallel_kwargs={"n_jobs": njobs})
+    builder.assets = sorted(files)
+    builder.parse(parsing_func=parsing_func).clean_dataframe()
+    if (parser == "drs") and (num_spot_checks > 0):
+        builder.df = spot_check(builder.df, num_spot_checks)
+    if not builder.invalid_assets.empty:
+        print(f"\tUnable to parse {len(builder.invalid_assets)} files; these will be retried on the next run")
+    return builder.df, set(builder.invalid_assets.get("INVALID_ASSET", []))
+
+
+def update_shard(shard_dir, shard_path, njobs=12, rescan=False, parser="drs", num_spot_checks=3):
+    """ Bring the shard of one institution_id/source_id up to date.
+    Only files that are new, or whose mtime or size differs from
+    what the manifest recorded, are parsed. Entries of files that
+    have been removed from the archive are dropped.
+    """
+    shard_name = f"{shard_dir.parent.name}_{shard_dir.name}"
+    shard_file = shard_path / f"{shard_name}.csv"
+    manifest_file = shard_path / f"{shard_name}_manifest.json"
+
+    manifest = {} if rescan else load_manifest(manifest_file)
+    if shard_file.exists() and not rescan:
+        shard_df = pd.read_csv(shard_file)
+    else:
+        shard_df = pd.DataFrame(columns=["path"])
+        manifest = {}
+
+    scan_start = datetime.now()
+    found = scan_files(shard_dir, njobs=njobs)
+    changed = [path for path, stats in found.items() if manifest.get(path) != stats]
+    removed = set(manifest) - set(found)
+    print(f"{shard_name}: {len(found)} files, {len(changed)} new/changed, {len(removed)} removed (scan took {datetime.now()-scan_start})")
+
+    if (len(changed) == 0) and (len(removed) == 0) and shard_file.exists():
+        return shard_file
+
+    shard_df = shard_df[~shard_df.path.isin(removed.union(changed))]
+    if len(changed) != 0:
+        parse_start = datetime.now()
+        new_df, invalid = parse_files(changed, njobs, parser, num_spot_checks)
+        print(f"{shard_name}: parsed {len(new_df)} files in {datetime.now()-parse_start}")
+        shard_df = pd.concat([shard_df, new_df], ignore_index=True)
+        for path in invalid:
+            found.pop(str(path), None)
+
+    cataloged = set(shard_df.path)
+    manifest = {path: stats for path, stats in found.items() if path in cataloged}
+
+    shard_path.mkdir(parents=True, exist_ok=True)
+    shard_df = shard_df.sort_values("path").reset_index(drop=True)
+    write_atomically(lambda fi: shard_df.to_csv(fi, index=False), shard_file)
+    write_atomically(lambda fi: fi.write_text(json.dumps(manifest)), manifest_file)
+    return shard_file
+
+
+def write_parquet_catalog(df, catalog_dir, name):
+    """ Write the catalog entries as a Parquet dataset partitioned
+    by source_id and sub_experiment_id. The dataset is written to a
+    temporary directory first and then swapped into place.
+    """
+    parquet_path = get_parquet_path(catalog_dir / f"{name}.json")
+    tmp_path = parquet_path.with_name(f".{parquet_path.name}.tmp")
+    old_path = parquet_path.with_name(f".{parquet_path.name}.old")
+    for path in [tmp_path, old_path]:
+        if path.exists():
+            shutil.rmtree(path)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(table, root_path=str(tmp_path), partition_cols=PARTITION_COLS)
+
+    if parquet_path.exists():
+        os.replace(parquet_path, old_path)
+    os.replace(tmp_path, parquet_path)
+    if old_path.exists():
+        shutil.rmtree(old_path)
+
+
+def merge_shards(shard_path, catalog_dir, name):
+    """ Concatenate all shards into the master catalog (csv + json)
+    that can be opened with intake.open_esm_datastore
+    """
+    shard_files = sorted(shard_path.glob("*.csv"))
+    if len(shard_files) == 0:
+        print(f"(ERROR) No catalog shards found in {shard_path}")
+        return
+
+    df = pd.concat([pd.read_csv(fi) for fi in shard_files], ignore_index=True)
+    print(f"Merging {len(shard_files)} shards with {len(df)} total entries into {catalog_dir}/{name}.json")
+
+    # ecgtools takes care of writing the ESM collection spec that
+    # intake-esm needs alongside the csv of all the entries; the
+    # catalog is first saved under a temporary name, so the files
+    # can be swapped in atomically
+    tmp_name = f".{name}.tmp"
+    builder = Builder(paths=[str(ROOT_PATH)])
+    builder.df = df
+    builder.save(
+        name=tmp_name,
+        path_column_name='path',
+        variable_column_name='variable_id',
+        data_format='netcdf',
+        groupby_attrs=GROUPBY_ATTRS,
+        aggregations=AGGREGATIONS,
+        directory=str(catalog_dir),
+    )
+
+    tmp_json = catalog_dir / f"{tmp_name}.json"
+    catalog_spec = json.loads(tmp_json.read_text())
+    catalog_spec["id"] = name
+    catalog_spec["catalog_file"] = str(catalog_dir / f"{name}.csv")
+    tmp_json.write_text(json.dumps(catalog_spec, indent=2))
+
+    os.replace(catalog_dir / f"{tmp_name}.csv", catalog_dir / f"{name}.csv")
+    os.replace(tmp_json, catalog_dir / f"{name}.json")
+
+    print(f"Writing partitioned Parquet catalog for {name}")
+    write_parquet_catalog(df, catalog_dir, name)
+
+
+def main():
+    args = parse_commandline_args()
+    root = pathlib.Path(args.root)
+    catalog_dir = pathlib.Path(args.catalog_dir)
+    shard_path = catalog_dir / f"{args.name}_shards"
+
+    if args.merge_only is False:
+        shard_dirs = find_shard_dirs(root, args.sources)
+        if len(shard_dirs) == 0:
+            print(f"(ERROR) No institution_id/source_id directories found in {root}")
+            return
+        for shard_dir in shard_dirs:
+            update_shard(
+                shard_dir,
+                shard_path,
+                njobs=args.njobs,
+                rescan=args.rescan,
+                parser=args.parser,
+                num_spot_checks=args.spot_check,
+            )
+
+    merge_shards(shard_path, catalog_dir, args.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+""" Helpers for querying the SNAPSI intake catalog without
+loading the whole thing.
+
+intake.open_esm_datastore reads the entire csv behind the catalog
+json before any search can be done, which is slow and memory hungry
+when hundreds of SLURM jobs all start at once just to pull out a
+handful of files each. build_intake_esm_catalog.py also writes the
+catalog entries as a Parquet dataset partitioned by source_id and
+sub_experiment_id, alongside the json/csv. search_catalog filters
+that dataset with predicate pushdown, so only the partitions (and
+row groups) matching the query are ever read, and hands back an
+ordinary intake-esm datastore of the matching entries, e.g.,
+
+    subset = search_catalog(
+        CATALOG_FILE,
+        variable_id=["ua", "va", "ta", "zg", "wap"],
+        source_id="GloSea6",
+        sub_experiment_id="s20180125",
+    )
+    ds = subset.to_dask()
+
+If the Parquet dataset doesn't exist, this falls back to opening
+the full catalog with intake and searching it the usual way.
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import json
+import pathlib
+
+import intake
+import pandas as pd
+
+CATALOG_FILE = pathlib.Path("/gws/nopw/j04/snapsi/test-snapsi-catalog-fast.json")
+
+# The columns the Parquet catalog is partitioned on
+PARTITION_COLS = ["source_id", "sub_experiment_id"]
+
+
+def get_parquet_path(catalog_file):
+    """ Location of the Parquet dataset belonging to a catalog json """
+    catalog_file = pathlib.Path(catalog_file)
+    return catalog_file.with_name(f"{catalog_file.stem}.parquet")
+
+
+def build_filters(query):
+    """ Convert intake-style search keyword args into
+    pyarrow filters (a list of and-ed predicates)
+    """
+    filters = []
+    for key, value in query.items():
+        if isinstance(value, (list, tuple, set)):
+            filters.append((key, "in", list(value)))
+        else:
+            filters.append((key, "==", value))
+    return filters
+
+
+def search_catalog(catalog_file=CATALOG_FILE, **query):
+    """ Search the catalog for entries matching the given query
+    (e.g., source_id="GloSea6", variable_id=["ua", "va"]), and
+    return the result as an intake-esm datastore. Only exact
+    matches are supported, unlike the regexes intake allows.
+    """
+    catalog_file = pathlib.Path(catalog_file)
+    parquet_path = get_parquet_path(catalog_file)
+    if parquet_path.exists() is False:
+        return intake.open_esm_datastore(str(catalog_file)).search(**query)
+
+    esmcat = json.loads(catalog_file.read_text())
+    esmcat.pop("catalog_file", None)
+    columns = [attr["column_name"] for attr in esmcat["attributes"]]
+
+    df = pd.read_parquet(parquet_path, engine="pyarrow", filters=build_filters(query))
+
+    # Partition columns come back as categoricals, and at the end of the table
+    for col in PARTITION_COLS:
+        df[col] = df[col].astype(str)
+    df = df[[col for col in columns if col in df.columns]]
+
+    return intake.open_esm_datastore({"esmcat": esmcat, "df": df})
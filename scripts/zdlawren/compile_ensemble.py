@@ -0,0 +1,388 @@
+""" Helpers for compiling the per-member zonal mean files of an
+ensemble into a single file along member_id, out of core.
+
+The compiled file is created up front with its full member_id
+dimension, with every variable chunked as one member by TIME_CHUNK
+time steps by the full cross-section, and zlib compressed. The
+member files are then copied into it one at a time, in slabs of
+as many time steps as fit within the given memory ceiling, so that
+the memory used does not depend on the number of members.
+
+After each member is copied, its source file (with its size and
+mtime) is recorded in the global attributes of the compiled file,
+along with the NaN counts and checksums of each of its chunks,
+taken from the slabs as they are copied. A compile that is
+interrupted thus carries on from the members it has not recorded
+yet, and members whose source file changed since are copied again.
+Once all members are in, their chunk checksums are merged into
+the completion record of the file (see output_validation.py),
+without reading back the members that were not copied again.
+
+Member zarr stores are compiled into a zarr store (see
+output_formats.py) with compile_zarr instead. Since the members
+occupy separate chunks of the compiled store, they are written
+by several threads at once, and recorded in the same way.
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import os
+import json
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from output_formats import (
+    ZARR_TIME_CHUNK, open_output, read_zarr_attrs, set_zarr_attrs, init_zarr_store, write_region, commit_zarr_store
+)
+from output_validation import (
+    RECORD_ATTR, COMMITTED_ATTR, TOTAL_ATTR, check_file, new_record, write_record, get_data_vars,
+    array_summary, merge_summaries
+)
+
+PROGRESS_ATTR = "compiled_members"
+SUMMARIES_ATTR = "compiled_member_summaries"
+
+# Time steps per chunk of the compiled variables; long enough
+# for reading time series of single members to be efficient
+TIME_CHUNK = 120
+COMPLEVEL = 3
+
+
+def read_member_id(path):
+    """ The (scalar) member_id coordinate of a member file """
+    with netCDF4.Dataset(path) as nc:
+        return str(nc.variables["member_id"][...])
+
+
+def source_stamp(path):
+    path = pathlib.Path(path).resolve()
+    if path.is_dir():
+        # The metadata files at the top of a zarr store
+        # are rewritten whenever a block is committed
+        with os.scandir(path) as entries:
+            stats = [entry.stat() for entry in entries if entry.is_file()]
+        return {"path": str(path), "size": sum(stat.st_size for stat in stats), "mtime": max(stat.st_mtime for stat in stats)}
+    stat = path.stat()
+    return {"path": str(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def read_compile_progress(path):
+    """ The members recorded as compiled into path (mapping
+    member_id to the stamp of its source file), or None if path
+    does not exist, cannot be read, or was not written this way
+    """
+    if pathlib.Path(path).exists() is False:
+        return None
+    try:
+        with netCDF4.Dataset(path) as nc:
+            return json.loads(nc.getncattr(PROGRESS_ATTR))
+    except (OSError, AttributeError):
+        return None
+
+
+def read_file_members(path):
+    with netCDF4.Dataset(path) as nc:
+        return [str(member) for member in nc.variables["member_id"][:]]
+
+
+def create_compiled_file(template_file, output_file, members, time_chunk=TIME_CHUNK, complevel=COMPLEVEL):
+    """ Create the compiled file for members, with the coordinates,
+    variables and attributes of (the member file) template_file
+    """
+    with netCDF4.Dataset(template_file) as src, netCDF4.Dataset(output_file, mode="w") as dst:
+        skip_attrs = {RECORD_ATTR, COMMITTED_ATTR, TOTAL_ATTR}
+        dst.setncatts({attr: src.getncattr(attr) for attr in src.ncattrs() if attr not in skip_attrs})
+        dst.createDimension("member_id", len(members))
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, len(dim))
+
+        member_var = dst.createVariable("member_id", str, ("member_id",))
+        member_var[:] = np.array(members, dtype=object)
+
+        for name, src_var in src.variables.items():
+            if name == "member_id":
+                continue
+            attrs = {attr: src_var.getncattr(attr) for attr in src_var.ncattrs()}
+            fill_value = attrs.pop("_FillValue", None)
+            attrs.pop("coordinates", None)
+            src_var.set_auto_maskandscale(False)
+
+            if name in src.dimensions:
+                dst_var = dst.createVariable(name, src_var.dtype, src_var.dimensions, fill_value=fill_value)
+                dst_var.set_auto_maskandscale(False)
+                dst_var[:] = src_var[:]
+            else:
+                dims = ("member_id",) + src_var.dimensions
+                chunks = [1] + [
+                    min(time_chunk, len(src.dimensions[dim])) if dim == "time" else len(src.dimensions[dim])
+                    for dim in src_var.dimensions
+                ]
+                dst_var = dst.createVariable(
+                    name, src_var.dtype, dims, fill_value=fill_value,
+                    zlib=True, complevel=complevel, shuffle=True, chunksizes=chunks,
+                )
+            dst_var.setncatts(attrs)
+
+        # Nothing is committed until all members have been copied and
+        # the file is stamped with its full completion record, so that
+        # a partially compiled file never passes validation
+        total = len(src.dimensions["time"])
+        write_record(dst, new_record(dst, total))
+        dst.setncattr(PROGRESS_ATTR, json.dumps({}))
+        dst.setncattr(SUMMARIES_ATTR, json.dumps({}))
+        dst.setncattr(COMMITTED_ATTR, 0)
+        dst.setncattr(TOTAL_ATTR, total)
+
+
+def time_step_sizes(path):
+    """ The number of time steps of a file, and the size
+    of one time step of its largest variable in bytes
+    """
+    with netCDF4.Dataset(path) as nc:
+        step_bytes = max(
+            int(np.prod([len(nc.dimensions[dim]) for dim in var.dimensions if dim != "time"])) * var.dtype.itemsize
+            for name, var in nc.variables.items()
+            if "time" in var.dimensions and name != "time"
+        )
+        return len(nc.dimensions["time"]), step_bytes
+
+
+def compiled_time_chunk(nc):
+    """ The number of time steps per chunk of an open compiled file """
+    for name in get_data_vars(nc):
+        nc_var = nc.variables[name]
+        if "time" in nc_var.dimensions:
+            return nc_var.chunking()[nc_var.dimensions.index("time")]
+    return len(nc.dimensions["time"])
+
+
+def chunk_summaries(data, time_axis, time_chunk):
+    """ The (NaN count, checksum, size in bytes) summaries of each chunk
+    of time steps in a slab of member data (whole chunks but the last)
+    """
+    summaries = []
+    for offset in range(0, data.shape[time_axis], time_chunk):
+        index = [slice(None)] * data.ndim
+        index[time_axis] = slice(offset, offset + time_chunk)
+        summaries.append(array_summary(data[tuple(index)]))
+    return summaries
+
+
+def copy_member(member_file, nc, member_ix, time_block):
+    """ Copy the variables of a member file into slot member_ix
+    of the (open) compiled file, time_block time steps at a time
+    (a multiple of its chunks), and return the summaries of each
+    chunk of each variable that was copied
+    """
+    time_chunk = compiled_time_chunk(nc)
+    summaries = {}
+    with netCDF4.Dataset(member_file) as src:
+        if not np.array_equal(src.variables["time"][:], nc.variables["time"][:]):
+            raise ValueError(f"{member_file} has different time steps than the compiled file")
+
+        for name, src_var in src.variables.items():
+            if (name in src.dimensions) or (name == "member_id"):
+                continue
+            src_var.set_auto_maskandscale(False)
+            dst_var = nc.variables[name]
+            dst_var.set_auto_maskandscale(False)
+
+            if "time" not in src_var.dimensions:
+                data = src_var[...]
+                dst_var[member_ix] = data
+                summaries[name] = [array_summary(data)]
+                continue
+            total = len(src.dimensions["time"])
+            time_axis = src_var.dimensions.index("time")
+            summaries[name] = []
+            for start in range(0, total, time_block):
+                index = tuple(
+                    slice(start, start + time_block) if dim == "time" else slice(None)
+                    for dim in src_var.dimensions
+                )
+                data = src_var[index]
+                dst_var[(member_ix,) + index] = data
+                summaries[name] += chunk_summaries(data, time_axis, time_chunk)
+    return summaries
+
+
+def read_member_summaries(nc, member_ix):
+    """ The summaries of each chunk of each variable of the member in
+    slot member_ix of an open compiled file, read back from the file
+    (for members compiled before their summaries were recorded)
+    """
+    time_chunk = compiled_time_chunk(nc)
+    total = len(nc.dimensions["time"])
+    summaries = {}
+    for name in get_data_vars(nc):
+        nc_var = nc.variables[name]
+        if "member_id" not in nc_var.dimensions:
+            continue
+        nc_var.set_auto_maskandscale(False)
+        if "time" not in nc_var.dimensions:
+            summaries[name] = [array_summary(nc_var[member_ix])]
+            continue
+        summaries[name] = []
+        for start in range(0, total, time_chunk):
+            index = tuple(
+                slice(start, start + time_chunk) if dim == "time" else slice(None)
+                for dim in nc_var.dimensions[1:]
+            )
+            summaries[name].append(array_summary(nc_var[(member_ix,) + index]))
+    return summaries
+
+
+def merge_member_records(nc, member_summaries):
+    """ Stamp an open compiled file with its completion record, with a
+    block per chunk of time steps, merging the summaries of its members
+    (in order) into the NaN counts and checksums of each block
+    """
+    total = len(nc.dimensions["time"])
+    time_chunk = compiled_time_chunk(nc)
+    record = new_record(nc, total)
+    record["blocks"] = [[start, min(start + time_chunk, total)] for start in range(0, total, time_chunk)]
+    for name, entry in record["variables"].items():
+        if name not in member_summaries[0]:
+            continue
+        merged = [
+            merge_summaries(pieces)
+            for pieces in zip(*[summaries[name] for summaries in member_summaries])
+        ]
+        entry["checksums"] = [checksum for _, checksum, _ in merged]
+        if "time" in nc.variables[name].dimensions:
+            entry["nan_counts"] = [nan_count for nan_count, _, _ in merged]
+        entry["nan_count"] = sum(nan_count for nan_count, _, _ in merged)
+    write_record(nc, record)
+    nc.setncattr(COMMITTED_ATTR, total)
+    nc.setncattr(TOTAL_ATTR, total)
+
+
+def compile_ensemble(member_files, output_file, mem_bytes, time_chunk=TIME_CHUNK, complevel=COMPLEVEL):
+    """ Compile member_files into output_file, using about mem_bytes
+    of memory at most, and resuming a previously interrupted compile.
+    Returns the number of members that were (re)copied.
+    """
+    output_file = pathlib.Path(output_file)
+    members = {read_member_id(path): path for path in member_files}
+    stamps = {member: source_stamp(path) for member, path in members.items()}
+
+    # Copy whole chunks of time steps at once, allowing for both the slab
+    # being read and the one being written; chunks are shortened to fit
+    total, step_bytes = time_step_sizes(member_files[0])
+    fit_steps = mem_bytes // (2 * step_bytes)
+    if fit_steps == 0:
+        raise ValueError(
+            f"copying a time step of {member_files[0]} needs {2 * step_bytes} bytes, more than the {mem_bytes} allowed"
+        )
+
+    progress = read_compile_progress(output_file)
+    if (progress is not None) and (read_file_members(output_file) != list(members)):
+        print(f"\t{output_file} was compiled from a different set of members; starting over")
+        progress = None
+    if progress is None:
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        create_compiled_file(member_files[0], output_file, list(members), min(time_chunk, fit_steps), complevel)
+        progress = {}
+
+    todo = [member for member in members if progress.get(member) != stamps[member]]
+    if (len(todo) == 0) and (len(check_file(output_file)) == 0):
+        print(f"\t{output_file} is already compiled from these members; skipping!")
+        return 0
+
+    with netCDF4.Dataset(output_file) as nc:
+        file_chunk = compiled_time_chunk(nc)
+    if file_chunk > fit_steps:
+        raise ValueError(
+            f"the chunks of {output_file} ({file_chunk} time steps) do not fit in {mem_bytes} bytes; "
+            "allow more memory, or remove the file to compile it with shorter chunks"
+        )
+    time_block = min(fit_steps // file_chunk * file_chunk, total)
+    if len(todo) != 0:
+        print(f"\tCompiling {len(todo)} of {len(members)} members into {output_file}, {time_block} time steps at a time")
+
+    member_ixs = {member: ix for ix, member in enumerate(members)}
+    with netCDF4.Dataset(output_file, mode="a") as nc:
+        attrs = nc.ncattrs()
+        summaries = json.loads(nc.getncattr(SUMMARIES_ATTR)) if SUMMARIES_ATTR in attrs else {}
+        nc.setncattr(COMMITTED_ATTR, 0)
+        for member in todo:
+            progress.pop(member, None)
+            summaries.pop(member, None)
+            nc.setncattr(PROGRESS_ATTR, json.dumps(progress))
+            nc.setncattr(SUMMARIES_ATTR, json.dumps(summaries))
+            nc.sync()
+
+            summaries[member] = copy_member(members[member], nc, member_ixs[member], time_block)
+            nc.sync()
+            progress[member] = stamps[member]
+            nc.setncattr(PROGRESS_ATTR, json.dumps(progress))
+            nc.setncattr(SUMMARIES_ATTR, json.dumps(summaries))
+            nc.sync()
+
+        # Files compiled before summaries were recorded are read back once
+        for member in members:
+            if member not in summaries:
+                summaries[member] = read_member_summaries(nc, member_ixs[member])
+        nc.setncattr(SUMMARIES_ATTR, json.dumps(summaries))
+        merge_member_records(nc, [summaries[member] for member in members])
+    return len(todo)
+
+
+def compile_zarr(member_stores, output_store, workers=None, time_chunk=ZARR_TIME_CHUNK):
+    """ Compile member_stores (zarr) into output_store, with workers
+    threads each writing a member into its own chunks of the store,
+    and resuming a previously interrupted compile.
+    Returns the number of members that were (re)written.
+    """
+    output_store = pathlib.Path(output_store)
+    datasets = {}
+    for path in member_stores:
+        ds = open_output(path)
+        datasets[str(ds.member_id.values)] = ds
+    members = list(datasets)
+    stamps = {member: source_stamp(path) for member, path in zip(members, member_stores)}
+
+    attrs = read_zarr_attrs(output_store)
+    progress = None if attrs is None else attrs.get(PROGRESS_ATTR)
+    if (progress is not None) and (list(open_output(output_store).member_id.values) != members):
+        print(f"\t{output_store} was compiled from a different set of members; starting over")
+        progress = None
+    if progress is None:
+        output_store.parent.mkdir(parents=True, exist_ok=True)
+        template = xr.concat(list(datasets.values()), dim="member_id", join="exact")
+        init_zarr_store(template, output_store, time_chunk)
+        set_zarr_attrs(output_store, **{PROGRESS_ATTR: {}})
+        progress = {}
+
+    todo = [member for member in members if progress.get(member) != stamps[member]]
+    if (len(todo) == 0) and (len(check_file(output_store)) == 0):
+        print(f"\t{output_store} is already compiled from these members; skipping!")
+        return 0
+    print(f"\tCompiling {len(todo)} of {len(members)} members into {output_store}")
+
+    total = datasets[members[0]].sizes["time"]
+    commit_zarr_store(output_store, 0, total)
+    lock = threading.Lock()
+
+    def write_member(member):
+        with lock:
+            progress.pop(member, None)
+            set_zarr_attrs(output_store, **{PROGRESS_ATTR: progress})
+        ix = members.index(member)
+        block = datasets[member].expand_dims("member_id").chunk({"time": time_chunk})
+        write_region(block, output_store, {"member_id": slice(ix, ix + 1)})
+        with lock:
+            progress[member] = stamps[member]
+            set_zarr_attrs(output_store, **{PROGRESS_ATTR: progress})
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(write_member, todo))
+
+    commit_zarr_store(output_store, total, total)
+    return len(todo)
@@ -0,0 +1,223 @@
+""" This python script computes ensemble statistics (mean, spread and
+quantiles) of the per-member zonal mean datasets of each model/init/
+experiment, in a single streaming pass over the member files.
+
+The member files are never combined into one dataset. Instead, each
+block of --time_block time steps is read from one member file after
+another. Each block goes into Welford updates of the running mean
+and variance, and is kept for the quantiles. Once every member has
+been read, the quantiles are computed exactly from the stacked
+blocks. Memory thus grows with the number of members times the size
+of a block, so --time_block should be lowered for large ensembles.
+The statistics of each block are then written out (see
+output_formats.py), so an interrupted run resumes from the last
+block written, e.g.,
+
+    python ensemble_stats.py GloSea6 IFS --quantiles 0.1 0.5 0.9
+
+Grid points where any member is NaN have NaN quantiles (the mean and
+spread skip NaNs).
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import sys
+import json
+import argparse
+import pathlib
+from collections import defaultdict
+
+import numpy as np
+
+from output_formats import (
+    FORMATS, remove_output, open_output, get_output_resume_step, init_output, write_output_block
+)
+from output_index import ZMD_ROOT, PROCESSED_ROOT, parse_output_path, find_product_files, record_output
+from output_validation import check_file
+from streaming_writer import iter_blocks
+
+QUANTILES = [0.1, 0.5, 0.9]
+TIME_BLOCK = 40
+MEMBERS_ATTR = "ensemble_members"
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", type=str, nargs="+", help="source_ids")
+    parser.add_argument("--subexperiments", type=str, nargs="*", default=None, help="only these sub_experiment_ids")
+    parser.add_argument("--experiments", type=str, nargs="*", default=None, help="only these experiment_ids")
+    parser.add_argument("--quantiles", type=float, nargs="*", default=QUANTILES, help="quantiles to compute")
+    parser.add_argument("--time_block", type=int, default=TIME_BLOCK, help="number of time steps to read at once")
+    parser.add_argument("--min_members", type=int, default=2, help="min number of member files for statistics")
+    parser.add_argument("--format", type=str, default="netcdf", choices=FORMATS, help="format of the member and statistics files")
+    parser.add_argument("--zmd_root", type=str, default=str(ZMD_ROOT), help="where the member zonal mean files are")
+    parser.add_argument("--processed_root", type=str, default=str(PROCESSED_ROOT), help="where to put the statistics files")
+    parser.add_argument("--rescan", action="store_true", help="glob for the member files instead of using the output index")
+    parser.add_argument("--clobber", action="store_true", help="recompute complete statistics files")
+    return parser.parse_args()
+
+
+def get_stats_path(model, init, experiment, processed_root=PROCESSED_ROOT, fmt="netcdf"):
+    """ Location of the ensemble statistics of a model/init/experiment """
+    return pathlib.Path(processed_root) / f"{model}/{experiment}/{init}/ensemble_stats/{model}_{experiment}_{init}_ensemble_stats{FORMATS[fmt]}"
+
+
+def get_stat_names(quantiles):
+    return ["mean", "spread"] + [f"q{p:g}" for p in quantiles]
+
+
+def new_accumulator(shape):
+    return {
+        "count": np.zeros(shape, dtype=np.int32),
+        "mean": np.zeros(shape, dtype=np.float64),
+        "m2": np.zeros(shape, dtype=np.float64),
+        "members": [],
+    }
+
+
+def update_accumulator(acc, x):
+    """ Welford update of the running mean and sum of squared deviations
+    with a new member (skipping NaNs), keeping the member for quantiles
+    """
+    acc["members"].append(x)
+    x = x.astype(np.float64)
+    valid = ~np.isnan(x)
+    acc["count"] += valid
+    delta = np.where(valid, x - acc["mean"], 0)
+    acc["mean"] += delta / np.maximum(acc["count"], 1)
+    acc["m2"] += np.where(valid, delta * (x - acc["mean"]), 0)
+
+
+def finish_accumulator(acc, quantiles):
+    """ The mean, spread (standard deviation) and quantiles stacked """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(acc["count"] > 0, acc["mean"], np.nan)
+        spread = np.sqrt(acc["m2"] / (acc["count"] - 1))
+    members = np.stack(acc["members"])
+    acc["members"] = []
+    return np.concatenate([np.stack([mean, spread]), np.quantile(members, quantiles, axis=0)])
+
+
+def block_stats(blocks, quantiles):
+    """ Ensemble statistics of the same block of every member, given
+    as an iterable of datasets read one at a time, along a new
+    statistic dimension
+    """
+    accumulators = None
+    for block in blocks:
+        if accumulators is None:
+            template = block
+            accumulators = {var: new_accumulator(block[var].shape) for var in block.data_vars}
+        elif not np.array_equal(block["time"].values, template["time"].values):
+            raise ValueError("Members have different time steps")
+        for var, acc in accumulators.items():
+            update_accumulator(acc, block[var].values)
+
+    stats = template.copy()
+    for var, acc in accumulators.items():
+        dims = ("statistic",) + template[var].dims
+        stats[var] = (dims, finish_accumulator(acc, quantiles).astype(template[var].dtype), template[var].attrs)
+    return stats.assign_coords(statistic=get_stat_names(quantiles))
+
+
+def stats_template(ds, quantiles):
+    """ A lazy dataset shaped like the ensemble statistics of (a member) ds """
+    names = get_stat_names(quantiles)
+    template = ds.copy()
+    for var in ds.data_vars:
+        template[var] = ds[var].expand_dims(statistic=len(names)).chunk({"statistic": -1})
+    return template.assign_coords(statistic=names)
+
+
+def read_stats_members(path):
+    """ The members the statistics in path were computed from, or None """
+    try:
+        with open_output(path) as ds:
+            return json.loads(ds.attrs[MEMBERS_ATTR])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def ensemble_stats(member_files, output_file, quantiles=QUANTILES, time_block=TIME_BLOCK):
+    """ Compute the ensemble statistics of member_files, writing them to
+    output_file one block of time steps at a time, and resuming a run
+    over the same members that was interrupted
+    """
+    output_file = pathlib.Path(output_file)
+    member_files = sorted(member_files)
+    members = [parse_output_path(path)["member"] for path in member_files]
+    datasets = [open_output(path).drop_vars("member_id", errors="ignore") for path in member_files]
+    try:
+        total = datasets[0].sizes["time"]
+        start = get_output_resume_step(output_file, total)
+        if (start != 0) and (read_stats_members(output_file) != members):
+            print(f"\t{output_file} was computed from a different set of members; starting over")
+            start = 0
+        if start == 0:
+            remove_output(output_file)
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            template = stats_template(datasets[0], quantiles)
+            template.attrs[MEMBERS_ATTR] = json.dumps(members)
+            init_output(template, output_file, time_block)
+        else:
+            print(f"\tResuming {output_file} from time step {start} of {total}")
+
+        for time_slice in iter_blocks(total, time_block, start):
+            stats = block_stats((ds.isel(time=time_slice).load() for ds in datasets), quantiles)
+            stats.attrs[MEMBERS_ATTR] = json.dumps(members)
+            write_output_block(stats, output_file, time_slice.start, total)
+    finally:
+        for ds in datasets:
+            ds.close()
+
+
+def find_member_files(model, zmd_root, fmt, rescan=False):
+    """ The member files of a model, by (init, experiment), from the
+    output index (see find_product_files)
+    """
+    groups = defaultdict(list)
+    for fi in find_product_files("zmd", model, zmd_root, FORMATS[fmt], rescan):
+        keys = parse_output_path(fi)
+        groups[(keys["init"], keys["experiment"])].append(fi)
+    return groups
+
+
+def main():
+    args = parse_commandline_args()
+
+    failed = []
+    for model in args.models:
+        groups = find_member_files(model, args.zmd_root, args.format, args.rescan)
+        for (init, experiment), member_files in sorted(groups.items()):
+            if (args.subexperiments is not None) and (init not in args.subexperiments):
+                continue
+            if (args.experiments is not None) and (experiment not in args.experiments):
+                continue
+            if len(member_files) < args.min_members:
+                print(f"Only {len(member_files)} members for {model} {init} {experiment}; skipping")
+                continue
+
+            output_file = get_stats_path(model, init, experiment, args.processed_root, args.format)
+            if (args.clobber is False) and (len(check_file(output_file)) == 0) and (read_stats_members(output_file) == sorted(
+                parse_output_path(fi)["member"] for fi in member_files
+            )):
+                print(f"{output_file} is complete; skipping")
+                continue
+
+            print(f"Computing statistics of {len(member_files)} members of {model} {init} {experiment}")
+            try:
+                ensemble_stats(member_files, output_file, args.quantiles, args.time_block)
+                record_output(output_file)
+            except Exception as e:
+                print(f"(ERROR) Unable to compute statistics for {model} {init} {experiment}")
+                print(f"(ERROR) Exception: {e}")
+                failed.append(output_file)
+
+    if len(failed) != 0:
+        print(f"(ERROR) Unable to compute {len(failed)} statistics files")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+""" The output formats of the zonal mean and EP flux products, so that
+the scripts writing and reading them do not need to care which one
+a file is in. The format of a file is given by its suffix:
+
+    netcdf (.nc): written as before, by streaming_writer.py for the
+        zonal means and all at once for the EP fluxes, and stamped
+        with completion records (see output_validation.py)
+    zarr (.zarr): chunked, compressed (blosc/zstd) zarr stores
+
+Zarr stores are chunked as one member by a block of time steps by the
+full cross-section, so that a time series of one member, or a single
+member, can be read without reading the rest. Since every chunk is a
+separate object, the writers of different members or blocks of time
+steps never touch the same chunk, and so can all write at once:
+write_dataset computes and writes all chunks in parallel with dask,
+and write_region lets separate threads or processes each fill in
+their own part of a store created with init_zarr_store.
+
+Like the netcdf files, zarr stores record the number of committed
+time steps in their attributes, so streamed writes can be resumed.
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import shutil
+import pathlib
+
+import numcodecs
+import xarray as xr
+import zarr
+
+from output_validation import COMMITTED_ATTR, TOTAL_ATTR, stamp_completion_record
+from streaming_writer import read_progress, get_resume_step, append_block, iter_blocks
+
+FORMATS = {"netcdf": ".nc", "zarr": ".zarr"}
+
+# Time steps per chunk of the zarr stores of compiled products
+ZARR_TIME_CHUNK = 120
+ZARR_CLEVEL = 3
+
+
+def get_format(path):
+    """ The format of a file (or store) from its suffix """
+    return "zarr" if pathlib.Path(path).suffix == ".zarr" else "netcdf"
+
+
+def with_format(path, fmt):
+    """ path with the suffix of format fmt """
+    return pathlib.Path(path).with_suffix(FORMATS[fmt])
+
+
+def remove_output(path):
+    """ Remove a product file or store """
+    if get_format(path) == "zarr":
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        pathlib.Path(path).unlink(missing_ok=True)
+
+
+def open_output(path, **kwargs):
+    """ Lazily open a product file or store, whatever its format """
+    if get_format(path) == "zarr":
+        return xr.open_zarr(path, consolidated=False, **kwargs)
+    return xr.open_dataset(path, chunks={}, **kwargs)
+
+
+def get_zarr_chunks(ds, time_chunk=ZARR_TIME_CHUNK):
+    """ Chunks of one member by time_chunk time steps by everything else """
+    return {
+        dim: 1 if dim == "member_id" else min(time_chunk, size) if dim == "time" else size
+        for dim, size in ds.sizes.items()
+    }
+
+
+def get_zarr_encoding(ds, chunks, clevel=ZARR_CLEVEL):
+    """ Chunking and compression of the data variables of a zarr store """
+    # zarr-python 3 takes a tuple of "compressors" instead of one "compressor"
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        compression = {"compressors": (zarr.codecs.BloscCodec(cname="zstd", clevel=clevel, shuffle="bitshuffle"),)}
+    else:
+        compression = {"compressor": numcodecs.Blosc(cname="zstd", clevel=clevel, shuffle=numcodecs.Blosc.BITSHUFFLE)}
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = dict(chunks=tuple(chunks[dim] for dim in var.dims), **compression)
+        # Keep any dtype the variable is meant to be written as
+        if "dtype" in var.encoding:
+            encoding[name]["dtype"] = var.encoding["dtype"]
+    return encoding
+
+
+def set_zarr_attrs(path, **attrs):
+    group = zarr.open_group(str(path), mode="a")
+    for attr, value in attrs.items():
+        group.attrs[attr] = value
+
+
+def read_zarr_attrs(path):
+    """ The attributes of a zarr store, or None if it cannot be read """
+    if pathlib.Path(path).exists() is False:
+        return None
+    try:
+        return dict(zarr.open_group(str(path), mode="r").attrs)
+    except (ValueError, OSError):
+        return None
+
+
+def read_zarr_progress(path):
+    """ The (committed, total) number of time steps of a zarr store,
+    or None if it does not exist or has no such record
+    """
+    attrs = read_zarr_attrs(path)
+    if (attrs is None) or (COMMITTED_ATTR not in attrs):
+        return None
+    return int(attrs[COMMITTED_ATTR]), int(attrs[TOTAL_ATTR])
+
+
+def init_zarr_store(ds, path, time_chunk=ZARR_TIME_CHUNK):
+    """ Create a zarr store for the (lazy) dataset ds, writing only its
+    metadata and coordinates; the data variables are then filled in
+    with write_region. No time steps are committed yet.
+    """
+    chunks = get_zarr_chunks(ds, time_chunk)
+    template = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+    template.to_zarr(path, mode="w", compute=False, encoding=get_zarr_encoding(ds, chunks))
+    set_zarr_attrs(path, **{COMMITTED_ATTR: 0, TOTAL_ATTR: ds.sizes.get("time", 0)})
+
+
+def write_region(block, path, region):
+    """ Write block (a part of the dataset a store was initialized
+    with) into the region of the store given by a dict mapping dims
+    to slices. Regions aligned with the chunks of the store can be
+    written by many threads or processes at once.
+    """
+    block = block.drop_vars([name for name, var in block.variables.items() if not set(region) & set(var.dims)])
+    block.to_zarr(path, region=region)
+
+
+def commit_zarr_store(path, committed, total):
+    """ Record committed time steps in a store, consolidating its
+    metadata once it is complete so that it opens quickly
+    """
+    set_zarr_attrs(path, **{COMMITTED_ATTR: committed, TOTAL_ATTR: total})
+    if committed == total:
+        zarr.consolidate_metadata(str(path))
+
+
+def read_output_progress(path):
+    """ The (committed, total) number of time steps of a product """
+    if get_format(path) == "zarr":
+        return read_zarr_progress(path)
+    return read_progress(path)
+
+
+def get_output_resume_step(path, total):
+    if get_format(path) == "zarr":
+        progress = read_zarr_progress(path)
+        return 0 if (progress is None) or (progress[1] != total) else progress[0]
+    return get_resume_step(path, total)
+
+
+def init_output(ds, path, time_chunk):
+    """ Set up the output for streaming ds into; only zarr stores
+    need creating beforehand (with chunks of time_chunk time steps)
+    """
+    if get_format(path) == "zarr":
+        init_zarr_store(ds, path, time_chunk)
+
+
+def write_output_block(block, path, start, total):
+    """ Write the (computed) block of time steps beginning at start,
+    and then mark them (and all before them) as committed
+    """
+    if get_format(path) == "netcdf":
+        return append_block(block, path, start, total)
+    stop = start + block.sizes["time"]
+    write_region(block, path, {"time": slice(start, stop)})
+    commit_zarr_store(path, stop, total)
+    return stop
+
+
+def stream_to_output(ds, path, time_block, **compute_kwargs):
+    """ Compute ds one block of time_block time steps at a time, and
+    write each block to path (in either format), resuming from the last
+    committed block if path holds a partially written version of ds.
+    compute_kwargs are passed on to the compute of each block.
+    """
+    total = ds.sizes["time"]
+    start = get_output_resume_step(path, total)
+    if start == 0:
+        init_output(ds, path, time_block)
+    else:
+        print(f"\tResuming {path} from time step {start} of {total}")
+
+    for time_slice in iter_blocks(total, time_block, start):
+        block = ds.isel(time=time_slice).compute(**compute_kwargs)
+        write_output_block(block, path, time_slice.start, total)
+
+
+def write_dataset(ds, path, netcdf_encoding=None, time_chunk=ZARR_TIME_CHUNK):
+    """ Write a whole (lazy) dataset at once. Zarr stores are written
+    chunk by chunk, with dask computing and writing chunks in parallel;
+    netcdf files are written with netcdf_encoding, and then stamped
+    with a completion record.
+    """
+    if get_format(path) == "netcdf":
+        ds.to_netcdf(path, encoding=netcdf_encoding)
+        stamp_completion_record(path)
+        return
+
+    chunks = get_zarr_chunks(ds, time_chunk)
+    ds = ds.chunk({dim: size for dim, size in chunks.items() if dim in ds.dims})
+    ds.to_zarr(path, mode="w", encoding=get_zarr_encoding(ds, chunks))
+    total = ds.sizes.get("time", 0)
+    commit_zarr_store(path, total, total)
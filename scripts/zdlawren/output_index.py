@@ -0,0 +1,371 @@
+""" This python script maintains an index of the processed outputs
+(member zonal means, compiled zonal means, EP fluxes, and ensemble
+statistics), so that scripts can find their inputs without recursively
+globbing the GWS or the scratch space, which is slow on a shared
+parallel filesystem.
+
+The index has one row per output file, keyed by model, experiment,
+init, product ("zmd", "zonal_means", "ep_fluxes" or "ensemble_stats")
+and member (empty for compiled products), with the file's size, mtime,
+and whether it validates (see output_validation.py); zarr stores (see
+output_formats.py) are indexed like files. It lives in INDEX_DIR (or the
+directory given by the SNAPSI_OUTPUT_INDEX environment variable) as
+
+    index.csv: the index as of the last rebuild/compaction
+    journal/: one small json file per output written since then
+
+Writers call record_output when they finish a file, which only adds
+a file to the journal, so that many jobs can do so at once. Reading
+the index merges the journal into index.csv, with the most recent
+entry for each path winning; each process only reads a journal file
+once, and index.csv again only when it changes. Once the journal has
+more than JOURNAL_MAX_FILES files, the writer that notices compacts
+it back into index.csv. The whole index can be rebuilt (in parallel)
+from the files on disk, and the journal can be compacted by hand,
+e.g.,
+
+    python output_index.py rebuild --workers 16
+    python output_index.py compact
+    python output_index.py query --product ep_fluxes --model GloSea6
+
+Rebuilds and compactions take a lock file in the index directory, so
+only one process does either at a time.
+
+Scripts look for their inputs with find_product_files, which uses the
+index for each (model, init, experiment) it has entries for, and lists
+the directories of the others, so that outputs written before the index
+existed are still found. An index started on a tree of older outputs
+should nevertheless be rebuilt once, since groups with some outputs
+journaled are taken from the index alone.
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import pathlib
+import argparse
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from output_validation import check_file, validate_files
+
+ZMD_ROOT = pathlib.Path("/work/scratch-nopw2/zdlawren/zmd")
+PROCESSED_ROOT = pathlib.Path("/gws/nopw/j04/snapsi/processed")
+INDEX_DIR = pathlib.Path(os.environ.get("SNAPSI_OUTPUT_INDEX", "/gws/nopw/j04/snapsi/processed/.output_index"))
+
+INDEX_COLUMNS = ["model", "experiment", "init", "product", "member", "path", "size", "mtime", "valid", "problems"]
+PRODUCTS = ["zmd", "zonal_means", "ep_fluxes", "ensemble_stats"]
+SUFFIXES = [".nc", ".zarr"]
+
+# Minimum number of variables a valid file of each product has
+MIN_VARS = {"zmd": 17, "zonal_means": 17, "ep_fluxes": 0, "ensemble_stats": 0}
+
+# Journal size at which writers compact it, and age (seconds) after
+# which a lock is taken to be left over from a killed process
+JOURNAL_MAX_FILES = 2000
+LOCK_FILE = "index.lock"
+LOCK_TIMEOUT = 3600
+
+# Entries of the journal files read so far by this process, by journal
+# directory and file name (journal files never change once written)
+_journal_entries = {}
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("action", type=str, choices=["rebuild", "compact", "query"])
+    parser.add_argument("--roots", type=str, nargs="*", default=[str(ZMD_ROOT), str(PROCESSED_ROOT)], help="directories to index with rebuild")
+    parser.add_argument("--index_dir", type=str, default=str(INDEX_DIR), help="where the index is kept")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of parallel scans/validations")
+    parser.add_argument("--product", type=str, default=None, choices=PRODUCTS, help="only query this product")
+    parser.add_argument("--model", type=str, default=None, help="only query this source_id")
+    parser.add_argument("--all", action="store_true", help="also list invalid files with query")
+    return parser.parse_args()
+
+
+def parse_output_path(path):
+    """ Get the index keys of an output file from its path, which is
+    either {model}/{init}/{experiment}/{model}_{init}_{experiment}_{member}_zmd.nc
+    or {model}/{experiment}/{init}/{product}/{model}_{experiment}_{init}_{product}.nc
+    (or .zarr). Returns None for files that are not outputs.
+    """
+    path = pathlib.Path(path)
+    parts = path.parts
+    if path.suffix not in SUFFIXES:
+        return None
+    if path.stem.endswith("_zmd") and len(parts) >= 4:
+        model, init, experiment = parts[-4:-1]
+        member = path.stem[:-len("_zmd")].split("_")[-1]
+        return dict(model=model, experiment=experiment, init=init, product="zmd", member=member)
+    if (len(parts) >= 5) and (parts[-2] in PRODUCTS):
+        model, experiment, init, product = parts[-5:-1]
+        return dict(model=model, experiment=experiment, init=init, product=product, member="")
+    return None
+
+
+def make_entry(path, size, mtime, problems):
+    keys = parse_output_path(path)
+    return dict(
+        keys,
+        path=str(path),
+        size=size,
+        mtime=mtime,
+        valid=len(problems) == 0,
+        problems="; ".join(problems),
+    )
+
+
+def record_output(path, index_dir=INDEX_DIR):
+    """ Add a just written output file to the index journal. Failing
+    to do so (e.g., without access to the index) is not fatal to the
+    writer, since a rebuild will pick the file up anyway.
+    """
+    path = pathlib.Path(path).resolve()
+    keys = parse_output_path(path)
+    if keys is None:
+        return
+    try:
+        stat = path.stat()
+        entry = make_entry(path, stat.st_size, stat.st_mtime, check_file(path, min_vars=MIN_VARS[keys["product"]]))
+
+        journal_dir = pathlib.Path(index_dir) / "journal"
+        journal_dir.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns()}_{uuid.uuid4().hex}.json"
+        tmp_file = journal_dir / f".{name}.tmp"
+        tmp_file.write_text(json.dumps(entry))
+        os.replace(tmp_file, journal_dir / name)
+
+        if len(os.listdir(journal_dir)) > JOURNAL_MAX_FILES:
+            with index_lock(index_dir) as locked:
+                if locked is True:
+                    compact_index(index_dir)
+    except OSError as e:
+        print(f"(WARNING) Unable to add {path} to the output index: {e}")
+
+
+@contextlib.contextmanager
+def index_lock(index_dir=INDEX_DIR):
+    """ Take the lock for rebuilding or compacting the index, yielding
+    whether it was taken (False if another process holds it)
+    """
+    lock_file = pathlib.Path(index_dir) / LOCK_FILE
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if time.time() - lock_file.stat().st_mtime > LOCK_TIMEOUT:
+            lock_file.unlink(missing_ok=True)
+    except FileNotFoundError:
+        pass
+
+    try:
+        fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        yield False
+        return
+    try:
+        os.close(fd)
+        yield True
+    finally:
+        lock_file.unlink(missing_ok=True)
+
+
+def read_journal(index_dir):
+    """ The journal files, and their entries in the order written.
+    Files that were read before are not read again, and files removed
+    (by a compaction) since they were listed are left out.
+    """
+    journal_dir = pathlib.Path(index_dir) / "journal"
+    if journal_dir.is_dir() is False:
+        return [], []
+    with os.scandir(journal_dir) as entries:
+        names = sorted(entry.name for entry in entries if entry.name.endswith(".json"))
+
+    cached = _journal_entries.get(str(journal_dir), {})
+    loaded = {}
+    for name in names:
+        if name in cached:
+            loaded[name] = cached[name]
+            continue
+        try:
+            loaded[name] = json.loads((journal_dir / name).read_text())
+        except FileNotFoundError:
+            continue
+    _journal_entries[str(journal_dir)] = loaded
+    return [journal_dir / name for name in loaded], list(loaded.values())
+
+
+@functools.lru_cache(maxsize=4)
+def _read_index_file(path, mtime):
+    return pd.read_csv(path, dtype={"member": str, "problems": str}, keep_default_na=False)
+
+
+def load_index(index_dir=INDEX_DIR):
+    """ The index as a DataFrame, including the journaled entries """
+    # The journal is read first: a compaction writes index.csv before
+    # removing the journal files it merged, so no entry is missed
+    _, journal = read_journal(index_dir)
+
+    index_file = pathlib.Path(index_dir) / "index.csv"
+    try:
+        df = _read_index_file(str(index_file), index_file.stat().st_mtime).copy()
+    except FileNotFoundError:
+        df = pd.DataFrame(columns=INDEX_COLUMNS)
+
+    if len(journal) != 0:
+        df = pd.concat([df, pd.DataFrame(journal, columns=INDEX_COLUMNS)], ignore_index=True)
+        df = df.drop_duplicates(subset="path", keep="last")
+    return df.sort_values(["model", "experiment", "init", "product", "member"], ignore_index=True)
+
+
+def write_index(df, index_dir):
+    index_dir = pathlib.Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = index_dir / ".index.csv.tmp"
+    df[INDEX_COLUMNS].to_csv(tmp_file, index=False)
+    os.replace(tmp_file, index_dir / "index.csv")
+
+
+def compact_index(index_dir=INDEX_DIR):
+    """ Merge the journal into index.csv. Only the journal files that
+    were merged are removed, so outputs recorded meanwhile are kept.
+    """
+    files, _ = read_journal(index_dir)
+    df = load_index(index_dir)
+    write_index(df, index_dir)
+    for fi in files:
+        fi.unlink(missing_ok=True)
+    return df
+
+
+def scan_outputs(top):
+    """ Recursively find all output files (and zarr stores, which
+    are not entered) under top, with their stats
+    """
+    found = []
+    stack = [top]
+    while len(stack) != 0:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if parse_output_path(entry.path) is not None:
+                    stat = entry.stat()
+                    found.append((entry.path, stat.st_size, stat.st_mtime))
+                elif entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    return found
+
+
+def rebuild_index(roots, index_dir=INDEX_DIR, workers=None):
+    """ Rebuild the whole index from the files under roots, scanning
+    each model directory and validating the files in parallel
+    """
+    # Only clear the journal files from before the scan, since files
+    # recorded during it may have been written after their directory
+    # was scanned
+    files, _ = read_journal(index_dir)
+
+    tops = []
+    for root in roots:
+        with os.scandir(pathlib.Path(root).resolve()) as entries:
+            tops.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        found = [fi for top_found in pool.map(scan_outputs, tops) for fi in top_found]
+
+    problems = {}
+    for product in PRODUCTS:
+        paths = [path for path, _, _ in found if parse_output_path(path)["product"] == product]
+        problems.update(validate_files(paths, workers=workers, min_vars=MIN_VARS[product]))
+
+    df = pd.DataFrame(
+        [make_entry(path, size, mtime, problems[path]) for path, size, mtime in found],
+        columns=INDEX_COLUMNS,
+    )
+    write_index(df, index_dir)
+    for fi in files:
+        fi.unlink(missing_ok=True)
+    return df
+
+
+def find_outputs(product, model=None, experiment=None, init=None, valid=True, index_dir=INDEX_DIR):
+    """ Paths of the indexed output files of a product, optionally
+    narrowed down by model, experiment and init. With valid=True
+    (the default) only files that validate are returned.
+    """
+    df = load_index(index_dir)
+    df = df[df["product"] == product]
+    for col, value in [("model", model), ("experiment", experiment), ("init", init)]:
+        if value is not None:
+            df = df[df[col] == value]
+    if valid is True:
+        df = df[df["valid"].astype(bool)]
+    return [pathlib.Path(path) for path in df["path"]]
+
+
+def find_product_files(product, model, root, suffix, rescan=False, index_dir=INDEX_DIR):
+    """ Paths of the files of a product of a model with suffix (e.g.,
+    .nc): for each (init, experiment) the index has entries for, those
+    of its files that validate, and for the others (or all of them,
+    with rescan=True) every file in their directory under root
+    """
+    indexed = {}
+    if rescan is False:
+        df = load_index(index_dir)
+        df = df[(df["product"] == product) & (df["model"] == model)]
+        for (init, experiment), group in df.groupby(["init", "experiment"]):
+            indexed[(init, experiment)] = [pathlib.Path(path) for path in group["path"][group["valid"].astype(bool)]]
+    files = [fi for group_files in indexed.values() for fi in group_files]
+
+    # Only the directories of the groups missing from the index are listed;
+    # member files are in {model}/{init}/{experiment}/, the other products
+    # in {model}/{experiment}/{init}/{product}/
+    for group_dir in pathlib.Path(root).glob(f"{model}/*/*"):
+        if product == "zmd":
+            init, experiment = group_dir.parts[-2:]
+        else:
+            experiment, init = group_dir.parts[-2:]
+            group_dir = group_dir / product
+        if ((init, experiment) in indexed) or (group_dir.is_dir() is False):
+            continue
+        for fi in group_dir.glob(f"*{suffix}"):
+            keys = parse_output_path(fi)
+            if (keys is not None) and (keys["product"] == product):
+                files.append(fi)
+    return sorted(fi for fi in files if fi.suffix == suffix)
+
+
+def main():
+    args = parse_commandline_args()
+
+    if args.action in ("rebuild", "compact"):
+        with index_lock(args.index_dir) as locked:
+            if locked is False:
+                print(f"(ERROR) {args.index_dir} is being rebuilt or compacted by another process")
+                sys.exit(1)
+            if args.action == "rebuild":
+                df = rebuild_index([pathlib.Path(root) for root in args.roots], args.index_dir, args.workers)
+                print(f"Indexed {len(df)} files ({(~df['valid']).sum()} invalid) in {args.index_dir}")
+            else:
+                df = compact_index(args.index_dir)
+                print(f"Compacted {args.index_dir} ({len(df)} files)")
+    else:
+        df = load_index(args.index_dir)
+        if args.product is not None:
+            df = df[df["product"] == args.product]
+        if args.model is not None:
+            df = df[df["model"] == args.model]
+        if args.all is False:
+            df = df[df["valid"].astype(bool)]
+        if len(df) == 0:
+            print("No matching files in the index")
+            sys.exit(1)
+        print(df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
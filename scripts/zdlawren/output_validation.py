@@ -0,0 +1,339 @@
+""" This python script checks that processed output files (zonal
+mean datasets, EP fluxes, etc.) are complete, without having to
+scan every field of every file for NaNs or guess from file sizes.
+
+Writers stamp each output file with a "completion record" in its
+global attributes: the expected size of each dimension, and for
+each variable its expected shape, its number of NaNs, and a CRC32
+checksum for every block of time steps it was written in. The
+streaming writer (streaming_writer.py) updates the record as each
+block is committed; files written all at once can be stamped
+afterwards with stamp_completion_record.
+
+Validating a file then only requires reading its metadata: the
+record must exist and cover every time step, every variable must
+have the shape the record expects, and no variable may be more
+than --max_nan_fraction NaN. With --deep, a few randomly chosen
+blocks of each variable are also read back and checked against
+their checksums. Zarr stores (see output_formats.py) have no
+completion record, and are only checked from their metadata.
+
+The script takes one or more directories, and validates all the
+files below them in parallel, e.g.,
+
+    python output_validation.py /work/scratch-nopw2/zdlawren/zmd/GloSea6 --deep
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import os
+import json
+import zlib
+import random
+import functools
+import pathlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import netCDF4
+import numpy as np
+import xarray as xr
+
+RECORD_ATTR = "completion_record"
+COMMITTED_ATTR = "committed_time_steps"
+TOTAL_ATTR = "total_time_steps"
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dirs", type=str, nargs="+", help="directories to validate the files under")
+    parser.add_argument("--pattern", type=str, default=".nc", help="only validate files ending with this")
+    parser.add_argument("--deep", action="store_true", help="also verify checksums of randomly sampled blocks")
+    parser.add_argument("--samples", type=int, default=2, help="number of blocks per variable to verify with --deep")
+    parser.add_argument("--max_nan_fraction", type=float, default=0.5, help="max fraction of NaNs in any variable")
+    parser.add_argument("--min_vars", type=int, default=0, help="min number of variables each file must have")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of parallel processes")
+    parser.add_argument("--clean_bad", action="store_true", help="remove files that fail validation")
+    return parser.parse_args()
+
+
+def get_data_vars(nc):
+    """ Names of the non-coordinate variables of a netCDF4.Dataset """
+    return [name for name in nc.variables if name not in nc.dimensions]
+
+
+def block_index(nc_var, start, stop):
+    """ Index selecting time steps start:stop of a variable """
+    return tuple(slice(start, stop) if dim == "time" else slice(None) for dim in nc_var.dimensions)
+
+
+def block_summary(nc_var, start=None, stop=None):
+    """ Read a block of time steps of a variable (or all of it, if it
+    has no time dimension), and return its NaN count and checksum
+    """
+    nc_var.set_auto_mask(False)
+    if "time" in nc_var.dimensions:
+        data = nc_var[block_index(nc_var, start, stop)]
+    else:
+        data = nc_var[...]
+    return array_summary(data)[:2]
+
+
+def array_summary(data):
+    """ The NaN count, checksum and size in bytes of an array """
+    # Variable-length strings come back as str or object arrays, whose
+    # bytes would be pointers rather than the strings themselves
+    data = np.asarray(data)
+    if data.dtype.kind == "O":
+        data = data.astype(str)
+    data = np.ascontiguousarray(data)
+    nan_count = int(np.isnan(data).sum()) if np.issubdtype(data.dtype, np.floating) else 0
+    return nan_count, zlib.crc32(data.tobytes()), data.nbytes
+
+
+def _gf2_apply(matrix, vector):
+    """ Multiply a 32 bit vector by a GF(2) matrix given as a list of its 32 columns """
+    result, ix = 0, 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[ix]
+        vector >>= 1
+        ix += 1
+    return result
+
+
+@functools.lru_cache(maxsize=64)
+def _crc32_shift(length):
+    """ The GF(2) matrix that advances a CRC-32 over length zero bytes """
+    # Advancing over one zero bit, squared thrice into one zero byte
+    step = [0xEDB88320] + [1 << n for n in range(31)]
+    for _ in range(3):
+        step = [_gf2_apply(step, column) for column in step]
+    shift = [1 << n for n in range(32)]
+    while length:
+        if length & 1:
+            shift = [_gf2_apply(step, column) for column in shift]
+        length >>= 1
+        step = [_gf2_apply(step, column) for column in step]
+    return tuple(shift)
+
+
+def crc32_combine(checksum1, checksum2, length2):
+    """ The CRC-32 of two byte strings one after the other, from their
+    CRC-32s and the length of the second (as zlib's crc32_combine)
+    """
+    return _gf2_apply(_crc32_shift(length2), checksum1) ^ checksum2
+
+
+def merge_summaries(summaries):
+    """ Merge the (NaN count, checksum, size in bytes) summaries of the
+    consecutive pieces of an array into the summary of the whole array
+    """
+    nan_count, checksum, nbytes = 0, 0, 0
+    for piece_nans, piece_checksum, piece_bytes in summaries:
+        nan_count += piece_nans
+        checksum = crc32_combine(checksum, piece_checksum, piece_bytes)
+        nbytes += piece_bytes
+    return nan_count, checksum, nbytes
+
+
+def new_record(nc, total):
+    """ Start a completion record for an open netCDF4.Dataset that
+    will have total time steps once complete. Variables without a
+    time dimension are summarized right away.
+    """
+    sizes = {dim: len(nc.dimensions[dim]) for dim in nc.dimensions}
+    if "time" in sizes:
+        sizes["time"] = total
+
+    record = {"sizes": sizes, "blocks": [], "variables": {}}
+    for name in get_data_vars(nc):
+        nc_var = nc.variables[name]
+        entry = {
+            "shape": [sizes[dim] for dim in nc_var.dimensions],
+            "nan_count": 0,
+            "checksums": [],
+        }
+        if "time" in nc_var.dimensions:
+            entry["nan_counts"] = []
+        else:
+            entry["nan_count"], checksum = block_summary(nc_var)
+            entry["checksums"].append(checksum)
+        record["variables"][name] = entry
+    return record
+
+
+def update_record(record, nc, start, stop):
+    """ Add the (just written) time steps start:stop of an open
+    netCDF4.Dataset to its completion record. Blocks the record has
+    from start onwards (e.g., when a write resumes from an earlier
+    step than was recorded) are dropped, as they have been rewritten.
+    """
+    blocks = record["blocks"]
+    keep = [ix for ix, block in enumerate(blocks) if block[0] < start]
+    record["blocks"] = [blocks[ix] for ix in keep] + [[start, stop]]
+    for name, entry in record["variables"].items():
+        nc_var = nc.variables[name]
+        if "time" not in nc_var.dimensions:
+            continue
+        # Records without per-block NaN counts are recounted from the file
+        if "nan_counts" not in entry:
+            entry["nan_counts"] = [block_summary(nc_var, *block)[0] if ix in keep else 0 for ix, block in enumerate(blocks)]
+        nan_count, checksum = block_summary(nc_var, start, stop)
+        entry["nan_counts"] = [entry["nan_counts"][ix] for ix in keep] + [nan_count]
+        entry["checksums"] = [entry["checksums"][ix] for ix in keep] + [checksum]
+        entry["nan_count"] = sum(entry["nan_counts"])
+    return record
+
+
+def read_record(nc):
+    """ The completion record of an open netCDF4.Dataset, or None """
+    if RECORD_ATTR not in nc.ncattrs():
+        return None
+    return json.loads(nc.getncattr(RECORD_ATTR))
+
+
+def write_record(nc, record):
+    nc.setncattr(RECORD_ATTR, json.dumps(record))
+
+
+def stamp_completion_record(path, time_block=40):
+    """ Stamp a file that was written all at once with a completion
+    record (checksummed in blocks of time_block time steps) that
+    marks all of its time steps as committed.
+    """
+    with netCDF4.Dataset(path, mode="a") as nc:
+        total = len(nc.dimensions["time"]) if "time" in nc.dimensions else 0
+        record = new_record(nc, total)
+        for start in range(0, total, time_block):
+            update_record(record, nc, start, min(start + time_block, total))
+        write_record(nc, record)
+        nc.setncattr(COMMITTED_ATTR, total)
+        nc.setncattr(TOTAL_ATTR, total)
+
+
+def check_zarr_store(path, min_vars=0):
+    """ Validate a zarr store (see output_formats.py) from its metadata.
+    Zarr stores have no completion record, so only their committed
+    time steps and the number and sizes of their variables are checked.
+    """
+    try:
+        ds = xr.open_zarr(path, consolidated=False)
+    except (ValueError, OSError, KeyError) as e:
+        return [f"unable to open ({e})"]
+
+    with ds:
+        committed, total = ds.attrs.get(COMMITTED_ATTR), ds.attrs.get(TOTAL_ATTR)
+        if (committed is None) or (committed != total):
+            return ["not all time steps are committed"]
+
+        problems = []
+        if len(ds.data_vars) < min_vars:
+            problems.append(f"only {len(ds.data_vars)} variables")
+        if ds.sizes.get("time", 0) != total:
+            problems.append(f"has {ds.sizes.get('time', 0)} time steps instead of {total}")
+    return problems
+
+
+def check_file(path, deep=False, samples=2, max_nan_fraction=0.5, min_vars=0):
+    """ Validate a file against its completion record, returning a
+    list of the problems found (an empty list means the file is valid)
+    """
+    if pathlib.Path(path).suffix == ".zarr":
+        return check_zarr_store(path, min_vars)
+    try:
+        nc = netCDF4.Dataset(path)
+    except OSError as e:
+        return [f"unable to open ({e})"]
+
+    with nc:
+        record = read_record(nc)
+        if record is None:
+            return ["no completion record"]
+
+        attrs = nc.ncattrs()
+        if (COMMITTED_ATTR not in attrs) or (nc.getncattr(COMMITTED_ATTR) != nc.getncattr(TOTAL_ATTR)):
+            return ["not all time steps are committed"]
+
+        problems = []
+        if len(record["variables"]) < min_vars:
+            problems.append(f"only {len(record['variables'])} variables")
+
+        for name, entry in record["variables"].items():
+            if name not in nc.variables:
+                problems.append(f"{name} is missing")
+                continue
+            nc_var = nc.variables[name]
+            if list(nc_var.shape) != entry["shape"]:
+                problems.append(f"{name} has shape {list(nc_var.shape)} instead of {entry['shape']}")
+                continue
+            size = int(np.prod(entry["shape"]))
+            if entry["nan_count"] > max_nan_fraction * size:
+                problems.append(f"{name} is {entry['nan_count']/size:.0%} NaN")
+
+            if deep is False:
+                continue
+            if "time" in nc_var.dimensions:
+                blocks = list(zip(record["blocks"], entry["checksums"]))
+            else:
+                blocks = [([None, None], entry["checksums"][0])]
+            for (start, stop), checksum in random.sample(blocks, min(samples, len(blocks))):
+                if block_summary(nc_var, start, stop)[1] != checksum:
+                    problems.append(f"{name} fails checksum for time steps {start}:{stop}")
+
+    return problems
+
+
+def find_files(top, pattern=".nc"):
+    """ Recursively find all files under top ending with pattern
+    (zarr stores, which are directories, are found but not entered)
+    """
+    found = []
+    stack = [top]
+    while len(stack) != 0:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.endswith(pattern):
+                    found.append(entry.path)
+                elif entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    return sorted(found)
+
+
+def validate_files(files, workers=None, **check_kwargs):
+    """ Validate many files in parallel, returning a dict mapping
+    each file path to its list of problems
+    """
+    if workers == 1:
+        return {path: check_file(path, **check_kwargs) for path in files}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {path: pool.submit(check_file, path, **check_kwargs) for path in files}
+        return {path: future.result() for path, future in futures.items()}
+
+
+def main():
+    args = parse_commandline_args()
+
+    files = [path for top in args.dirs for path in find_files(top, args.pattern)]
+    print(f"Validating {len(files)} files")
+    results = validate_files(
+        files,
+        workers=args.workers,
+        deep=args.deep,
+        samples=args.samples,
+        max_nan_fraction=args.max_nan_fraction,
+        min_vars=args.min_vars,
+    )
+
+    bad_files = {path: problems for path, problems in results.items() if len(problems) != 0}
+    for path, problems in bad_files.items():
+        print(f"{path}: {'; '.join(problems)}")
+        if args.clean_bad is True:
+            print(f"\tRemoving {pathlib.Path(path).name}")
+            pathlib.Path(path).unlink()
+    print(f"{len(files) - len(bad_files)} of {len(files)} files are valid")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,60 +2,149 @@ import os
 import argparse
 import pathlib
 import numpy as np
-import xarray as xr
-
-parser = argparse.ArgumentParser()
-parser.add_argument("model", type=str, help="source_id")
-parser.add_argument("--compile_complete", action="store_true", help="compile complete set of files into individual")
-parser.add_argument("--clean_partial", action="store_true", help="cleanup partial files from jobs that died early")
-args = parser.parse_args()
-
-dates = ["s20180125", "s20180208", "s20181213", "s20190108", "s20190829", "s20191001"]
-exps = ["nudged","control","free"]
-if args.model in {"GloSea6", "IFS"}:
-    exps += ["nudged-full","control-full"]
-elif args.model in {"CNRM-CM61"}:
-    exps += ["nudged-full"]
-elif args.model == "SPEAR":
-    exps = ["free", "nudged-full"]
-
-dat_path = pathlib.Path("/work/scratch-nopw2/zdlawren/zmd")
-paths = [dat_path / args.model / f"{date}/{exp}" for date in dates for exp in exps]
-
-for path in paths:
+
+from compile_ensemble import compile_ensemble, compile_zarr
+from output_formats import FORMATS, get_format, remove_output
+from output_index import record_output
+from output_validation import check_file, validate_files
+from zmd_snapsi import parse_memsize
+
+ZMD_ROOT = pathlib.Path("/work/scratch-nopw2/zdlawren/zmd")
+PROCESSED_ROOT = pathlib.Path("/gws/nopw/j04/snapsi/processed")
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="source_id")
+    parser.add_argument("--compile_complete", action="store_true", help="compile complete set of files into individual")
+    parser.add_argument("--clean_partial", action="store_true", help="cleanup partial files from jobs that died early")
+    parser.add_argument("--subexperiments", type=str, nargs="*", default=None, help="only query these sub_experiment_ids")
+    parser.add_argument("--experiments", type=str, nargs="*", default=None, help="only query these experiment_ids")
+    parser.add_argument("--min_members", type=int, default=50, help="number of member files needed to compile")
+    parser.add_argument("--mem", type=str, default="4G", help="memory to use for compiling (e.g., 4G)")
+    parser.add_argument("--format", type=str, default="netcdf", choices=FORMATS, help="format of the member and compiled files")
+    return parser.parse_args()
+
+
+def get_model_experiments(model):
+    """ The experiments that each model ran """
+    exps = ["nudged","control","free"]
+    if model in {"GloSea6", "IFS"}:
+        exps += ["nudged-full","control-full"]
+    elif model in {"CNRM-CM61"}:
+        exps += ["nudged-full"]
+    elif model == "SPEAR":
+        exps = ["free", "nudged-full"]
+    return exps
+
+
+def get_compiled_path(model, init, experiment, processed_root=PROCESSED_ROOT, fmt="netcdf"):
+    """ Location of the compiled (all member) zonal mean dataset """
+    return pathlib.Path(processed_root) / f"{model}/{experiment}/{init}/zonal_means/{model}_{experiment}_{init}_zonalmeans{FORMATS[fmt]}"
+
+
+def find_partial_files(nc_files, workers=None):
+    """ Return the indices of the member files that are incomplete.
+    Files stamped with a completion record are validated from their
+    metadata; older files are judged by comparing their sizes to the
+    largest file in the directory
+    """
+    fi_sizes = [ncfi.stat().st_size/(1024*1024) for ncfi in nc_files]
+    max_fi_size = np.max(fi_sizes)
+
+    problems = validate_files(nc_files, workers=workers, min_vars=17)
+    non_full = []
+    for ix, ncfi in enumerate(nc_files):
+        if problems[ncfi] == ["no completion record"]:
+            if fi_sizes[ix] != max_fi_size:
+                non_full.append(ix)
+                print(f"\t{ncfi.stem} only {fi_sizes[ix]} MiB")
+        elif len(problems[ncfi]) != 0:
+            non_full.append(ix)
+            print(f"\t{ncfi.stem}: {'; '.join(problems[ncfi])}")
+    return non_full
+
+
+def compile_members(nc_files, output_file, mem_bytes=parse_memsize("4G")):
+    """ Compile the member files into one chunked and compressed dataset
+    along member_id (see compile_ensemble.py), using about mem_bytes of
+    memory, unless an up-to-date compiled file already exists. Zarr
+    member stores are compiled into a zarr store.
+    """
+    if get_format(output_file) == "zarr":
+        if compile_zarr(nc_files, output_file) != 0:
+            record_output(output_file)
+        return
+
+    # Files compiled before completion records existed are still
+    # judged by comparing their size to that of the member files
+    if output_file.exists() and (check_file(output_file) == ["no completion record"]):
+        fi_sizes = [ncfi.stat().st_size/(1024*1024) for ncfi in nc_files]
+        if np.abs(output_file.stat().st_size/(1024*1024) - np.sum(fi_sizes)) < 15:
+            print(f"\t(compile_complete=True) {output_file} already exists; skipping!")
+            return
+        output_file.unlink()
+
+    if compile_ensemble(nc_files, output_file, mem_bytes) != 0:
+        record_output(output_file)
+
+
+def query_zmd_dir(
+    path, model, compile_complete=False, clean_partial=False, min_members=50,
+    processed_root=PROCESSED_ROOT, mem_bytes=parse_memsize("4G"), fmt="netcdf",
+):
+    """ Report on the member files of one {model}/{init}/{experiment}
+    directory, and optionally clean up partial files and compile them
+    """
     if path.is_dir() is False:
         print(f"{path} does not exist")
-        continue
-    nc_files = list(path.glob("*.nc"))
+        return
+    nc_files = sorted(path.glob(f"*{FORMATS[fmt]}"))
     num_nc_files = len(nc_files)
-    print(f"{path} -> {num_nc_files} nc files")
-    
+    print(f"{path} -> {num_nc_files} {fmt} files")
+
     if num_nc_files == 0:
-        continue
-    fi_sizes = [ncfi.stat().st_size/(1024*1024) for ncfi in nc_files]
-    max_fi_size = np.max(fi_sizes)
+        return
 
-    non_full = np.where(fi_sizes != max_fi_size)[0]
+    non_full = find_partial_files(nc_files)
     for ix in non_full:
-        print(f"\t{nc_files[ix].stem} only {fi_sizes[ix]} MiB")
-        if args.clean_partial is True: 
+        if clean_partial is True:
             print(f"\tRemoving {nc_files[ix].stem}")
-            nc_files[ix].unlink() 
+            remove_output(nc_files[ix])
             num_nc_files -= 1
 
-    if (args.compile_complete is True) and (num_nc_files >= 50) and (len(non_full) == 0):
-        init = path.parts[6]
-        experiment = path.parts[7]
-
-        output_file = pathlib.Path(f"/gws/nopw/j04/snapsi/processed/{args.model}/{experiment}/{init}/zonal_means/{args.model}_{experiment}_{init}_zonalmeans.nc")
-        
-        print(f"\t(compile_complete=True) Now compiling final dataset for {args.model} {experiment} {init}")
-        if (output_file.exists() is False) or (np.abs(output_file.stat().st_size/(1024*1024) - np.sum(fi_sizes)) >= 15):
-            output_file.parent.mkdir(parents=True, exist_ok=True)
-            mfds = xr.open_mfdataset(nc_files, combine="nested", concat_dim="member_id")
-            print(f"\t(compile_complete=True) Writing compiled dataset to {output_file}")
-            mfds.to_netcdf(output_file)
-            mfds = None
-        else:
-            print(f"\t(compile_complete=True) {output_file} already exists; skipping!")
-       
+    if (compile_complete is True) and (num_nc_files >= min_members) and (len(non_full) == 0):
+        init = path.parent.name
+        experiment = path.name
+        output_file = get_compiled_path(model, init, experiment, processed_root, fmt)
+
+        print(f"\t(compile_complete=True) Now compiling final dataset for {model} {experiment} {init}")
+        compile_members(nc_files, output_file, mem_bytes)
+
+
+def main():
+    args = parse_commandline_args()
+
+    dates = ["s20180125", "s20180208", "s20181213", "s20190108", "s20190829", "s20191001"]
+    exps = get_model_experiments(args.model)
+
+    if args.subexperiments is not None:
+        dates = [date for date in dates if date in args.subexperiments]
+    if args.experiments is not None:
+        exps = args.experiments
+
+    paths = [ZMD_ROOT / args.model / f"{date}/{exp}" for date in dates for exp in exps]
+    for path in paths:
+        query_zmd_dir(
+            path,
+            args.model,
+            compile_complete=args.compile_complete,
+            clean_partial=args.clean_partial,
+            min_members=args.min_members,
+            mem_bytes=parse_memsize(args.mem),
+            fmt=args.format,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+""" This python script runs the zonal mean diagnostics pipeline
+(zonal means per member, compiling the members, and EP fluxes)
+for many model/init/experiment targets from a single long-lived
+driver, instead of one process invocation per target.
+
+The targets are run on a pool of --workers processes. Each worker
+imports the heavy modules (xarray, dask, pyzome, intake) and queries
+the catalog once, when it starts, and then reuses them for every
+target it is given; dask computations within each target use
+--threads_per_worker threads, so that the pool as a whole can
+saturate an analysis node without going through SLURM, e.g.,
+
+    python snapsi_driver.py GloSea6 IFS --workers 16 --threads_per_worker 4
+
+By default all init/experiment combinations of the given models
+in the catalog are run; --subexperiments and --experiments narrow
+these down, and --targets gives them explicitly. The catalog and the
+output locations can be changed, so the driver can also be run on
+a laptop against a catalog of synthetic data.
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import os
+import sys
+import argparse
+import pathlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import dask
+
+from catalog_query import search_catalog
+from output_formats import FORMATS
+from query_zmd_files import ZMD_ROOT, PROCESSED_ROOT, get_compiled_path, find_partial_files, compile_members
+from zmd_snapsi import CATALOG_FILE, open_snapsi_dataset, process_members
+from zmd_to_epf import get_epf_path, is_epf_file_done, convert_to_epf
+
+VARIABLES = ["ua", "va", "ta", "zg", "wap"]
+STAGES = ["zmd", "compile", "epf"]
+
+# The catalog subset for the models being processed; set once in
+# each worker process by init_worker, and reused by every target
+_catalog = None
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", type=str, nargs="+", help="source_ids")
+    parser.add_argument("--subexperiments", type=str, nargs="*", default=None, help="only run these sub_experiment_ids")
+    parser.add_argument("--experiments", type=str, nargs="*", default=None, help="only run these experiment_ids")
+    parser.add_argument("--targets", type=str, nargs="*", default=None, help="explicit targets as model/init/experiment")
+    parser.add_argument("--stages", type=str, nargs="*", default=STAGES, choices=STAGES, help="stages to run")
+    parser.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    parser.add_argument("--threads_per_worker", type=int, default=None, help="dask threads per worker process")
+    parser.add_argument("--time_block", type=int, default=40, help="max number of time steps to compute and write at once")
+    parser.add_argument("--format", type=str, default="netcdf", choices=FORMATS, help="format of the outputs")
+    parser.add_argument("--catalog", type=str, default=CATALOG_FILE, help="catalog json to query")
+    parser.add_argument("--zmd_root", type=str, default=str(ZMD_ROOT), help="where to put member zonal mean files")
+    parser.add_argument("--processed_root", type=str, default=str(PROCESSED_ROOT), help="where to put compiled/EP flux files")
+    return parser.parse_args()
+
+
+def find_targets(catalog, subexperiments=None, experiments=None):
+    """ All (model, init, experiment) combinations in the catalog """
+    df = catalog.df
+    if subexperiments is not None:
+        df = df[df.sub_experiment_id.isin(subexperiments)]
+    if experiments is not None:
+        df = df[df.experiment_id.isin(experiments)]
+    combos = df[["source_id", "sub_experiment_id", "experiment_id"]].drop_duplicates()
+    return sorted(tuple(row) for row in combos.itertuples(index=False))
+
+
+def init_worker(catalog_file, models, threads_per_worker):
+    """ Set up a worker process: query the catalog once, and limit
+    the threads dask uses for the computations of each target
+    """
+    global _catalog
+    dask.config.set(scheduler="threads", num_workers=threads_per_worker)
+    _catalog = search_catalog(catalog_file, variable_id=VARIABLES, source_id=models)
+
+
+def run_target(target, stages, zmd_root, processed_root, time_block, fmt="netcdf"):
+    """ Run the requested stages of the pipeline for one target in the
+    current (worker) process. Raises an exception if a stage fails.
+    """
+    model, init, experiment = target
+    zmd_dir = pathlib.Path(zmd_root) / f"{model}/{init}/{experiment}"
+    compiled_file = get_compiled_path(model, init, experiment, processed_root, fmt)
+
+    if "zmd" in stages:
+        zmd_dir.mkdir(parents=True, exist_ok=True)
+        ds = open_snapsi_dataset(model, init, experiment, catalog=_catalog)
+        process_members(ds, zmd_dir, model, init, experiment, time_block, fmt)
+
+    if "compile" in stages:
+        members = _catalog.search(source_id=model, sub_experiment_id=init, experiment_id=experiment).df.member_id
+        nc_files = sorted(zmd_dir.glob(f"*{FORMATS[fmt]}"))
+        if (len(nc_files) < members.nunique()) or (len(find_partial_files(nc_files, workers=1)) != 0):
+            raise RuntimeError(f"Not all {members.nunique()} member files of {zmd_dir} are complete")
+        compile_members(nc_files, compiled_file)
+
+    if "epf" in stages:
+        epf_file = get_epf_path(compiled_file)
+        if is_epf_file_done(epf_file) is False:
+            if convert_to_epf(compiled_file, epf_file, model) is False:
+                raise RuntimeError(f"Unable to compute EP fluxes from {compiled_file}")
+
+    return target
+
+
+def main():
+    args = parse_commandline_args()
+    threads_per_worker = args.threads_per_worker or max(os.cpu_count() // args.workers, 1)
+
+    if args.targets is not None:
+        targets = [tuple(target.split("/")) for target in args.targets]
+    else:
+        catalog = search_catalog(args.catalog, variable_id=VARIABLES, source_id=args.models)
+        targets = find_targets(catalog, args.subexperiments, args.experiments)
+    print(f"Running {args.stages} for {len(targets)} targets on {args.workers} workers x {threads_per_worker} threads")
+
+    failed = []
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        initializer=init_worker,
+        initargs=(args.catalog, args.models, threads_per_worker),
+    ) as pool:
+        futures = {
+            pool.submit(
+                run_target, target, args.stages, args.zmd_root, args.processed_root, args.time_block, args.format
+            ): target
+            for target in targets
+        }
+        for future in as_completed(futures):
+            target = "/".join(futures[future])
+            try:
+                future.result()
+            except Exception:
+                print(f"(ERROR) {target} failed:\n{traceback.format_exc()}")
+                failed.append(target)
+            else:
+                print(f"Finished {target}")
+
+    print(f"{len(targets) - len(failed)} of {len(targets)} targets completed")
+    if len(failed) != 0:
+        print(f"(ERROR) Failed targets: {' '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+""" This python script schedules the whole zonal mean diagnostics
+pipeline for a SNAPSI model, replacing the one-bash-script-per-
+experiment approach of snapsi_zmd_genner.py.
+
+From the catalog it builds a graph of tasks with their dependencies:
+
+    zmd_snapsi.py (one task per member)
+        -> query_zmd_files.py --compile_complete (one per init/experiment)
+            -> zmd_to_epf.py (one per init/experiment)
+
+Tasks whose outputs already exist and validate (see
+output_validation.py) are dropped from the graph, and the rest are
+run through one of two backends:
+
+    --backend local: a pool of --workers processes on this machine,
+        starting each task as soon as its dependencies have finished
+    --backend slurm: one sbatch job (array) per stage of each
+        init/experiment, e.g., all the member tasks of an experiment
+        go in a single job array, chained with --dependency=afterok
+        so SLURM starts each stage as soon as the previous one is done
+
+For example, to submit everything that still needs doing for the
+GloSea6 s20180125 init:
+
+    python snapsi_pipeline.py GloSea6 --subexperiments s20180125 --backend slurm --submit
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import sys
+import shlex
+import argparse
+import pathlib
+import subprocess
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from catalog_query import search_catalog
+from output_formats import FORMATS
+from output_validation import check_file
+from query_zmd_files import get_compiled_path
+from zmd_snapsi import CATALOG_FILE, OUTPUT_ROOT, get_output_path
+from zmd_to_epf import get_epf_path
+
+SCRIPT_DIR = pathlib.Path(__file__).resolve().parent
+DEFAULT_OUTPUT_DIR = pathlib.Path("~/autoscripts").expanduser()
+
+STAGES = ["zmd", "compile", "epf"]
+
+# Default SLURM resources for each stage
+DEFAULT_MEM = {"zmd": "20G", "compile": "8G", "epf": "16G"}
+DEFAULT_TIME = {"zmd": "06:00:00", "compile": "02:00:00", "epf": "01:00:00"}
+
+
+@dataclass
+class Task:
+    """ A single command to run, the outputs it produces, and the
+    names of the tasks that have to finish before it can start.
+    Tasks with the same group are packed into one SLURM job (array).
+    rerun_args are added to the command when the task has to run
+    again over outputs that already exist (e.g., --clobber).
+    """
+    name: str
+    stage: str
+    group: str
+    command: list
+    outputs: list
+    deps: list = field(default_factory=list)
+    rerun_args: list = field(default_factory=list)
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="source_id")
+    parser.add_argument("--subexperiments", type=str, nargs="*", default=None, help="only schedule these sub_experiment_ids")
+    parser.add_argument("--experiments", type=str, nargs="*", default=None, help="only schedule these experiment_ids")
+    parser.add_argument("--stages", type=str, nargs="*", default=STAGES, choices=STAGES, help="stages to schedule")
+    parser.add_argument("--backend", type=str, default="local", choices=["local", "slurm"])
+    parser.add_argument("--workers", type=int, default=4, help="number of concurrent tasks for the local backend")
+    parser.add_argument("--python", type=str, default=sys.executable, help="python used to run the tasks")
+    parser.add_argument("--outdir", type=str, default=str(DEFAULT_OUTPUT_DIR), help="where to put SLURM scripts and logs")
+    parser.add_argument("--max_parallel", type=int, default=None, help="max number of simultaneously running array tasks")
+    parser.add_argument("--submit", action="store_true", help="submit the SLURM jobs (otherwise only write the scripts)")
+    parser.add_argument("--dry_run", action="store_true", help="only print the tasks that would be run")
+    parser.add_argument("--format", type=str, default="netcdf", choices=FORMATS, help="format of the outputs")
+    for stage in STAGES:
+        parser.add_argument(f"--{stage}_mem", type=str, default=DEFAULT_MEM[stage], help=f"SLURM memory for {stage} jobs")
+        parser.add_argument(f"--{stage}_time", type=str, default=DEFAULT_TIME[stage], help=f"SLURM time limit for {stage} jobs")
+    return parser.parse_args()
+
+
+def build_tasks(model, subexperiments=None, experiments=None, stages=STAGES, python=sys.executable, fmt="netcdf"):
+    """ Build the task graph for a model from the catalog, with
+    one zonal mean task per member, and one compile and one
+    EP flux task per init/experiment
+    """
+    query = dict(variable_id=["ua", "va", "ta", "zg", "wap"], source_id=model)
+    if subexperiments is not None:
+        query["sub_experiment_id"] = subexperiments
+    if experiments is not None:
+        query["experiment_id"] = experiments
+    df = search_catalog(CATALOG_FILE, **query).df
+
+    tasks = []
+    for (init, experiment), entries in df.groupby(["sub_experiment_id", "experiment_id"]):
+        members = sorted(entries.member_id.unique())
+        group = f"{model}_{init}_{experiment}"
+        output_dir = OUTPUT_ROOT / f"{model}/{init}/{experiment}/"
+
+        zmd_names = []
+        if "zmd" in stages:
+            for member in members:
+                tasks.append(Task(
+                    name=f"{group}_{member}_zmd",
+                    stage="zmd",
+                    group=f"{group}_zmd",
+                    command=[
+                        python, "-u", str(SCRIPT_DIR / "zmd_snapsi.py"), model, init, experiment,
+                        "--members", member, "--format", fmt,
+                    ],
+                    outputs=[get_output_path(output_dir, model, init, experiment, member, fmt)],
+                ))
+                zmd_names.append(tasks[-1].name)
+
+        if "compile" in stages:
+            tasks.append(Task(
+                name=f"{group}_compile",
+                stage="compile",
+                group=f"{group}_compile",
+                command=[
+                    python, "-u", str(SCRIPT_DIR / "query_zmd_files.py"), model, "--compile_complete",
+                    "--subexperiments", init, "--experiments", experiment, "--min_members", str(len(members)),
+                    "--format", fmt,
+                ],
+                outputs=[str(get_compiled_path(model, init, experiment, fmt=fmt))],
+                deps=zmd_names,
+            ))
+
+        if "epf" in stages:
+            tasks.append(Task(
+                name=f"{group}_epf",
+                stage="epf",
+                group=f"{group}_epf",
+                command=[
+                    python, "-u", str(SCRIPT_DIR / "zmd_to_epf.py"), model,
+                    "--inputs", str(get_compiled_path(model, init, experiment, fmt=fmt)), "--format", fmt,
+                ],
+                outputs=[str(get_epf_path(get_compiled_path(model, init, experiment, fmt=fmt)))],
+                deps=[f"{group}_compile"] if "compile" in stages else [],
+                rerun_args=["--clobber"],
+            ))
+    return tasks
+
+
+def is_task_done(task):
+    """ A task is done when all its outputs validate. The member zonal
+    mean files must have a completion record; compiled and EP flux files
+    written before completion records existed are trusted as before.
+    """
+    for output in task.outputs:
+        if pathlib.Path(output).exists() is False:
+            return False
+        problems = check_file(output, min_vars=17 if task.stage != "epf" else 0)
+        if task.stage == "zmd" and len(problems) != 0:
+            return False
+        if problems not in ([], ["no completion record"]):
+            return False
+    return True
+
+
+def prune_done_tasks(tasks):
+    """ Drop the tasks whose outputs already validate, along with any
+    dependencies on them. Tasks downstream of a task that still has
+    to run are kept, even if their outputs exist, since they would
+    otherwise be out of date, and are run with their rerun_args so
+    that they replace those outputs. (Compile tasks need none, as
+    compile_ensemble.py recopies members whose files have changed.)
+    """
+    pending = set()
+    for task in tasks:
+        if any(dep in pending for dep in task.deps):
+            pending.add(task.name)
+            task.command = task.command + task.rerun_args
+        elif is_task_done(task) is False:
+            pending.add(task.name)
+
+    remaining = []
+    for task in tasks:
+        if task.name not in pending:
+            continue
+        task.deps = [dep for dep in task.deps if dep in pending]
+        remaining.append(task)
+    return remaining
+
+
+def run_local(tasks, workers):
+    """ Run the tasks as subprocesses, at most workers at a time,
+    starting each one as soon as all its dependencies have succeeded.
+    Tasks depending on a failed task are skipped.
+    """
+    status = {}
+    waiting = list(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while (len(waiting) != 0) or (len(running) != 0):
+            num_started = 0
+            for task in list(waiting):
+                if any(status.get(dep) is False for dep in task.deps):
+                    print(f"(ERROR) Skipping {task.name} since a dependency failed")
+                    status[task.name] = False
+                    waiting.remove(task)
+                elif all(status.get(dep) is True for dep in task.deps):
+                    print(f"Starting {task.name}: {shlex.join(task.command)}")
+                    running[pool.submit(subprocess.run, task.command)] = task
+                    waiting.remove(task)
+                    num_started += 1
+
+            if len(running) == 0:
+                if num_started == 0:
+                    print(f"(ERROR) Unable to schedule {[task.name for task in waiting]}; unknown dependencies")
+                    break
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                status[task.name] = (future.result().returncode == 0) and is_task_done(task)
+                if status[task.name] is False:
+                    print(f"(ERROR) {task.name} did not produce valid outputs")
+                else:
+                    print(f"Finished {task.name}")
+
+    return status
+
+
+def write_slurm_script(group, group_tasks, outdir, mem, timelimit, max_parallel=None):
+    """ Write the sbatch script for a group of tasks. Groups of more than
+    one task become a job array, with one array element per task.
+    """
+    text = "#!/bin/bash\n\n"
+    text += f"#SBATCH --job-name=\"{group}\"\n"
+    text += f"#SBATCH --mem={mem}\n"
+    text += f"#SBATCH --time={timelimit}\n"
+    text += f"#SBATCH --output={outdir}/%x_%A_%a.out\n"
+    if len(group_tasks) > 1:
+        limit = f"%{max_parallel}" if max_parallel is not None else ""
+        text += f"#SBATCH --array=0-{len(group_tasks)-1}{limit}\n"
+    text += "\ncommands=(\n"
+    for task in group_tasks:
+        text += f"  {shlex.quote(shlex.join(task.command))}\n"
+    text += ")\n\n"
+    text += "eval \"${commands[${SLURM_ARRAY_TASK_ID:-0}]}\"\n"
+
+    script = pathlib.Path(outdir) / f"{group}.sh"
+    script.write_text(text)
+    script.chmod(0o744)
+    return script
+
+
+def run_slurm(tasks, outdir, mem, timelimit, max_parallel=None, submit=False):
+    """ Write (and optionally submit) one sbatch script per group of
+    tasks, with SLURM dependencies between the groups mirroring those
+    between their tasks. mem and timelimit map stages to resources.
+    """
+    pathlib.Path(outdir).mkdir(parents=True, exist_ok=True)
+    group_of = {task.name: task.group for task in tasks}
+
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task.group, []).append(task)
+
+    job_ids = {}
+    for group, group_tasks in groups.items():
+        stage = group_tasks[0].stage
+        script = write_slurm_script(group, group_tasks, outdir, mem[stage], timelimit[stage], max_parallel)
+
+        dep_groups = sorted({group_of[dep] for task in group_tasks for dep in task.deps})
+        cmd = ["sbatch", "--parsable"]
+        if len(dep_groups) != 0:
+            cmd.append(f"--dependency=afterok:{':'.join(job_ids[dep] for dep in dep_groups)}")
+        cmd.append(str(script))
+
+        if submit is False:
+            print(f"Wrote {script}")
+            job_ids[group] = f"<{group}>"
+            continue
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        job_ids[group] = result.stdout.strip().split(";")[0]
+        print(f"Submitted {script} as job {job_ids[group]} ({len(group_tasks)} tasks, after {dep_groups})")
+
+    return job_ids
+
+
+def main():
+    args = parse_commandline_args()
+
+    tasks = build_tasks(args.model, args.subexperiments, args.experiments, args.stages, args.python, args.format)
+    num_tasks = len(tasks)
+    tasks = prune_done_tasks(tasks)
+    print(f"{len(tasks)} of {num_tasks} tasks for {args.model} still need to run")
+
+    if args.dry_run is True:
+        for task in tasks:
+            print(f"{task.name} (after {task.deps}): {shlex.join(task.command)}")
+        return
+
+    if args.backend == "local":
+        status = run_local(tasks, args.workers)
+        num_failed = sum(ok is False for ok in status.values())
+        if num_failed != 0:
+            print(f"(ERROR) {num_failed} tasks failed")
+            sys.exit(1)
+    else:
+        mem = {stage: getattr(args, f"{stage}_mem") for stage in STAGES}
+        timelimit = {stage: getattr(args, f"{stage}_time") for stage in STAGES}
+        run_slurm(tasks, args.outdir, mem, timelimit, args.max_parallel, args.submit)
+
+
+if __name__ == "__main__":
+    main()
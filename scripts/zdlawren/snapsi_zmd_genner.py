@@ -21,7 +21,8 @@ import re
 import time
 import pathlib
 import argparse
-import intake
+
+from catalog_query import search_catalog
 
 def is_valid_duration(duration):
     """ Check for a valid job duration string that 
@@ -68,6 +69,7 @@ parser.add_argument("--submit", action="store_true", help="submit with sbatch")
 parser.add_argument("--wait", type=int, default=5)
 parser.add_argument("--mem", type=str, default="20G", help="memory allocation for job in format of [num]G to specify the number of GB")
 parser.add_argument("--timelimit", type=str, default="06:00:00", help="duration of job in format of HH:MM:SS")
+parser.add_argument("--ensemble", action="store_true", help="have each job process all ensemble members in one pass within --mem")
 args = parser.parse_args()
 
 # First make some checks that would stop the script from running
@@ -95,9 +97,9 @@ if args.subexperiment not in valid_subexps:
 if args.outdir == str(DEFAULT_OUTPUT_DIR):
     DEFAULT_OUTPUT_DIR.mkdir(exist_ok=True)
 
-# Open the Intake catalog and subset on the source_id and subexperiment
-catalog = intake.open_esm_datastore("/gws/nopw/j04/snapsi/test-snapsi-catalog-fast.json")
-subset = catalog.search(
+# Query the catalog and subset on the source_id and subexperiment
+subset = search_catalog(
+    "/gws/nopw/j04/snapsi/test-snapsi-catalog-fast.json",
     variable_id=["ua", "va", "ta", "zg", "wap"],
     source_id=args.model,
     sub_experiment_id=args.subexperiment,
@@ -115,7 +117,10 @@ for eid in experiment_ids:
     text_for_script += f"#SBATCH --job-name=\"{args.model}_{args.subexperiment}_{eid}\"\n"
     text_for_script += f"#SBATCH --mem={args.mem}\n"
     text_for_script += f"#SBATCH --time={args.timelimit}\n\n"
-    text_for_script += f"{args.python} -u {args.zmd} {args.model} {args.subexperiment} {eid}\n"
+    zmd_args = f"{args.model} {args.subexperiment} {eid}"
+    if args.ensemble is True:
+        zmd_args += f" --ensemble --mem {args.mem}"
+    text_for_script += f"{args.python} -u {args.zmd} {zmd_args}\n"
 
     # Write string to file and chmod it for use
     with open(f"{args.outdir}/{scripts_fi}", "w") as fi:
@@ -0,0 +1,129 @@
+""" Helpers for writing (lazy) datasets to netCDF one block of
+time steps at a time, with checkpointing.
+
+Each block is computed and appended to the output file along its
+(unlimited) time dimension, after which the number of committed
+time steps is recorded in the global attributes of the file. If a
+job is killed part way through, a restarted job reads that record
+and carries on from the first uncommitted block instead of starting
+over, and telling whether a file is complete only requires reading
+its attributes rather than scanning its fields for NaNs. The time
+axis is encoded as float64 (in the units of the source data, or
+hours since the first time step) when the file is created, since
+the units xarray would infer from the first block alone (e.g., days
+as int64 for a single time step) cannot hold the later ones. Each
+committed block is also added to the completion record of the file
+(see output_validation.py), by reading it back once written.
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import pathlib
+
+import netCDF4
+from xarray.coding.times import encode_cf_datetime
+
+from output_validation import COMMITTED_ATTR, TOTAL_ATTR, new_record, read_record, update_record, write_record
+
+TIME_DTYPE = "float64"
+
+
+def read_progress(path):
+    """ Return the (committed, total) number of time steps recorded
+    in the attributes of a file, or None if the file does not exist,
+    cannot be read, or has no such record.
+    """
+    if pathlib.Path(path).exists() is False:
+        return None
+    try:
+        with netCDF4.Dataset(path) as nc:
+            return int(nc.getncattr(COMMITTED_ATTR)), int(nc.getncattr(TOTAL_ATTR))
+    except (OSError, AttributeError):
+        return None
+
+
+def is_complete(path):
+    """ Whether all time steps of a file have been committed """
+    progress = read_progress(path)
+    return (progress is not None) and (progress[0] == progress[1])
+
+
+def get_resume_step(path, total):
+    """ The time step that writing to path should start from; if the
+    file was written for a different number of time steps, start over
+    """
+    progress = read_progress(path)
+    if (progress is None) or (progress[1] != total):
+        return 0
+    return progress[0]
+
+
+def get_time_encoding(block):
+    """ Encoding of the time axis of a streamed file, which has to
+    hold every time step, not just those of the first block
+    """
+    encoding = {key: block.time.encoding[key] for key in ("units", "calendar") if key in block.time.encoding}
+    if "units" not in encoding:
+        encoding["units"] = f"hours since {block.indexes['time'][0]:%Y-%m-%d %H:%M:%S}"
+    encoding["dtype"] = TIME_DTYPE
+    return encoding
+
+
+def append_block(block, path, start, total):
+    """ Write the (computed) block of time steps beginning at
+    start to path. The first block creates the file, the others
+    are written into its unlimited time dimension in place. The
+    completion record and committed time steps are only updated
+    after the data is written.
+    """
+    stop = start + block.sizes["time"]
+
+    if start == 0:
+        block.to_netcdf(path, mode="w", unlimited_dims=["time"], encoding={"time": get_time_encoding(block)})
+
+    with netCDF4.Dataset(path, mode="a") as nc:
+        if start != 0:
+            times = nc.variables["time"]
+            encoded, _, _ = encode_cf_datetime(block.time.values, times.units, getattr(times, "calendar", None), times.dtype)
+            times[start:stop] = encoded
+
+            for name, var in block.variables.items():
+                if ("time" not in var.dims) or (name == "time"):
+                    continue
+                nc_var = nc.variables[name]
+                var = var.transpose(*nc_var.dimensions)
+                index = tuple(
+                    slice(start, stop) if dim == "time" else slice(None)
+                    for dim in nc_var.dimensions
+                )
+                nc_var[index] = var.values
+            nc.sync()
+
+        record = new_record(nc, total) if start == 0 else read_record(nc)
+        write_record(nc, update_record(record, nc, start, stop))
+        nc.setncattr(COMMITTED_ATTR, stop)
+        nc.setncattr(TOTAL_ATTR, total)
+    return stop
+
+
+def iter_blocks(total, time_block, start=0):
+    """ Yield the time slices of the blocks from start to total """
+    for block_start in range(start, total, time_block):
+        yield slice(block_start, min(block_start + time_block, total))
+
+
+def stream_to_netcdf(ds, path, time_block, **compute_kwargs):
+    """ Compute ds one block of time_block time steps at a time,
+    appending each block to path, and resuming from the last committed
+    block if path holds a partially written version of ds.
+    compute_kwargs are passed on to the compute of each block.
+    """
+    total = ds.sizes["time"]
+    start = get_resume_step(path, total)
+    if start != 0:
+        print(f"\tResuming {path} from time step {start} of {total}")
+
+    for time_slice in iter_blocks(total, time_block, start):
+        block = ds.isel(time=time_slice).compute(**compute_kwargs)
+        append_block(block, path, time_slice.start, total)
@@ -0,0 +1,349 @@
+""" This python script builds (and reads) a "time series major" store
+of the compiled zonal mean datasets of each model, for extracting long
+time series at a few (plev, lat) points of every run and member
+quickly, e.g., for atlas plots and indices.
+
+The compiled zonal mean files are laid out time-major, so that a time
+series at one point needs (parts of) every chunk of a file. The store
+instead holds one contiguous, uncompressed array per model and
+variable in a .npy file, laid out as
+
+    (run, member, [wavenum,] lat, plev, time)
+
+where the runs are the (init, experiment) pairs of the model. Each
+time series is thus a contiguous run of bytes in the file, which is
+read through a memory map, so that extracting, say, U at 60N and 10
+hPa for every run and member of a model reads a few kB per series.
+Runs with fewer members or time steps than others are padded with
+NaN. The runs, members, coordinates and (per run) valid times, as
+ISO strings with the calendar of the run, are kept in an index.json
+next to the arrays, along with the size and
+mtime of the compiled file each run came from, so that stores whose
+sources have not changed are not rebuilt, e.g.,
+
+    python timeseries_store.py GloSea6 IFS --store_root ./timeseries
+
+A store is built in a temporary directory, one member of one variable
+at a time, and then moved into place. The series are read with, e.g.,
+
+    u60 = get_series("GloSea6", "u", plev=1000., lat=60)
+    t6090 = get_series("GloSea6", "T", plev=10000., lat=(60, 90))
+
+with plev in Pa, as in the compiled files.
+
+Original Author: Z. D. Lawrence
+Last modified: 2026-10-17
+"""
+
+import sys
+import json
+import uuid
+import shutil
+import argparse
+import pathlib
+import functools
+
+import cftime
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from output_formats import FORMATS, open_output
+from output_index import PROCESSED_ROOT, parse_output_path, find_product_files
+
+STORE_ROOT = PROCESSED_ROOT / "timeseries"
+INDEX_FILE = "index.json"
+STORE_DTYPE = np.float32
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+STANDARD_CALENDARS = {"standard", "gregorian", "proleptic_gregorian"}
+
+# Stores (and indexes) kept open at once
+CACHE_SIZE = 32
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("models", type=str, nargs="+", help="source_ids")
+    parser.add_argument("--store_root", type=str, default=str(STORE_ROOT), help="where to put the stores")
+    parser.add_argument("--processed_root", type=str, default=str(PROCESSED_ROOT), help="where the compiled zonal mean files are")
+    parser.add_argument("--format", type=str, default="netcdf", choices=FORMATS, help="format of the compiled files")
+    parser.add_argument("--rescan", action="store_true", help="glob for the compiled files instead of using the output index")
+    parser.add_argument("--clobber", action="store_true", help="rebuild stores even if their sources have not changed")
+    return parser.parse_args()
+
+
+def find_compiled_files(model, processed_root, fmt, rescan=False):
+    """ The compiled zonal mean files of a model, from the output index
+    (see find_product_files)
+    """
+    return find_product_files("zonal_means", model, processed_root, FORMATS[fmt], rescan)
+
+
+def source_stamp(path):
+    stat = pathlib.Path(path).stat()
+    return [str(path), stat.st_size, stat.st_mtime]
+
+
+def get_series_dims(da):
+    """ The dims of a variable in the store, without run and member """
+    extra = [dim for dim in da.dims if dim not in ("member_id", "lat", "plev", "time")]
+    return extra + ["lat", "plev", "time"]
+
+
+def read_store_index(store_dir):
+    try:
+        with open(pathlib.Path(store_dir) / INDEX_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def describe_runs(files):
+    """ The layout of the store of a model, from its compiled files """
+    runs = []
+    variables = {}
+    coords = None
+    for path in files:
+        keys = parse_output_path(path)
+        with open_output(path) as ds:
+            if coords is None:
+                coords = {dim: ds[dim].values.tolist() for dim in ds.dims if dim not in ("member_id", "time") and dim in ds.coords}
+            for dim, values in coords.items():
+                if (dim in ds.coords) and not np.array_equal(ds[dim].values, values):
+                    raise ValueError(f"{path} has a different {dim} from the other runs of the model")
+            for var, da in ds.data_vars.items():
+                if {"member_id", "lat", "plev", "time"} <= set(da.dims):
+                    variables.setdefault(var, get_series_dims(da))
+            runs.append(dict(
+                init=keys["init"],
+                experiment=keys["experiment"],
+                members=[str(member) for member in ds["member_id"].values],
+                time=[t.strftime(TIME_FORMAT) for t in ds.indexes["time"]],
+                calendar=ds["time"].dt.calendar,
+                source=source_stamp(path),
+            ))
+    return runs, variables, coords
+
+
+def build_store(model, files, store_root=STORE_ROOT):
+    """ Build the store of a model from its compiled zonal mean files,
+    reading one member of one variable at a time
+    """
+    store_root = pathlib.Path(store_root)
+    store_dir = store_root / model
+    runs, variables, coords = describe_runs(files)
+    n_members = max(len(run["members"]) for run in runs)
+    n_time = max(len(run["time"]) for run in runs)
+
+    tmp_dir = store_root / f".{model}.{uuid.uuid4().hex}.tmp"
+    tmp_dir.mkdir(parents=True)
+    try:
+        for var, dims in variables.items():
+            shape = (len(runs), n_members) + tuple(len(coords[dim]) for dim in dims[:-1]) + (n_time,)
+            array = np.lib.format.open_memmap(tmp_dir / f"{var}.npy", mode="w+", dtype=STORE_DTYPE, shape=shape)
+            array[...] = np.nan
+            for run_ix, (path, run) in enumerate(zip(files, runs)):
+                with open_output(path) as ds:
+                    for member_ix in range(len(run["members"])):
+                        member = ds[var].isel(member_id=member_ix).transpose(*dims).values
+                        array[run_ix, member_ix, ..., :member.shape[-1]] = member
+            array.flush()
+            del array
+
+        with open(tmp_dir / INDEX_FILE, "w") as f:
+            json.dump(dict(model=model, runs=runs, variables=variables, coords=coords, n_members=n_members, n_time=n_time), f)
+
+        # Swap the new store in for the old one
+        old_dir = store_root / f".{model}.{uuid.uuid4().hex}.old"
+        if store_dir.exists():
+            store_dir.rename(old_dir)
+        tmp_dir.rename(store_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def is_current(store_dir, files):
+    """ Whether a store was built from exactly these (unchanged) files """
+    index = read_store_index(store_dir)
+    if index is None:
+        return False
+    return [run["source"] for run in index["runs"]] == [source_stamp(path) for path in files]
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _open_array(path, mtime):
+    return np.load(path, mmap_mode="r")
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _read_index(path, mtime):
+    with open(path) as f:
+        return json.load(f)
+
+
+def open_store(model, store_root=STORE_ROOT):
+    """ The index of the store of a model, and a function returning the
+    memory-mapped array of a variable (both memoized until rebuilt)
+    """
+    store_dir = pathlib.Path(store_root) / model
+    index_path = store_dir / INDEX_FILE
+    index = _read_index(str(index_path), index_path.stat().st_mtime)
+
+    def get_array(var):
+        path = store_dir / f"{var}.npy"
+        return _open_array(str(path), path.stat().st_mtime)
+
+    return index, get_array
+
+
+def lat_weights(lats, lat):
+    """ Indices and weights along lat of a latitude (linear
+    interpolation between the two neighbouring rows), or of a
+    (lo, hi) band (cos(lat) weighted mean of the rows within it)
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    if np.ndim(lat) == 0:
+        order = np.argsort(lats)
+        j = np.clip(np.searchsorted(lats[order], lat) - 1, 0, len(lats) - 2)
+        lo, hi = lats[order][j], lats[order][j + 1]
+        if not lo <= lat <= hi:
+            raise ValueError(f"Latitude {lat} is outside of the grid")
+        return order[[j, j + 1]], np.array([hi - lat, lat - lo]) / (hi - lo)
+
+    ix = np.flatnonzero((lats >= min(lat)) & (lats <= max(lat)))
+    if len(ix) == 0:
+        raise ValueError(f"No latitudes within {lat}")
+    weights = np.cos(np.deg2rad(lats[ix]))
+    return ix, weights / weights.sum()
+
+
+def find_level(plevs, plev):
+    """ Index of the pressure level plev (Pa) in plevs, up to rounding """
+    matches = np.flatnonzero(np.isclose(plevs, plev, rtol=1e-6, atol=0))
+    if len(matches) == 0:
+        raise ValueError(f"No level at {plev} Pa (the levels are {plevs})")
+    return int(matches[0])
+
+
+def find_extra_index(var, dims, coords, sel):
+    """ Indices along the dims of var other than lat, plev and time
+    of the values selected by sel
+    """
+    unknown = set(sel) - set(dims[:-3])
+    if len(unknown) != 0:
+        raise ValueError(f"{var} has no dims {sorted(unknown)} to select (its dims are {dims})")
+    extra = []
+    for dim in dims[:-3]:
+        if dim not in sel:
+            raise ValueError(f"{var} has a {dim} dim; select one of its values with {dim}=...")
+        if sel[dim] not in coords[dim]:
+            raise ValueError(f"No {dim} {sel[dim]} (the values are {coords[dim]})")
+        extra.append(coords[dim].index(sel[dim]))
+    return tuple(extra)
+
+
+def parse_times(runs):
+    """ The times of each run (as written by describe_runs) as datetime64
+    if every run has a standard calendar and dates pandas can hold,
+    or else as cftime datetimes in the calendar of each run
+    """
+    # Indexes written before calendars were recorded hold datetime64 strings
+    calendars = [run.get("calendar", "standard") for run in runs]
+    if set(calendars) <= STANDARD_CALENDARS:
+        try:
+            return [pd.to_datetime(run["time"]).values for run in runs]
+        except (ValueError, pd.errors.OutOfBoundsDatetime):
+            pass
+    return [
+        np.array([cftime.datetime.strptime(t, TIME_FORMAT, calendar=calendar) for t in run["time"]], dtype=object)
+        for run, calendar in zip(runs, calendars)
+    ]
+
+
+def get_series(model, var, plev, lat, store_root=STORE_ROOT, inits=None, experiments=None, **sel):
+    """ Time series of var at plev (Pa) and lat, a latitude (interpolated
+    linearly) or a (lo, hi) band (cos(lat) weighted mean), for every
+    run and member of a model, from its store. Any other dims of var
+    (e.g., wavenum_lon) are selected by value with sel.
+
+    Returns a DataArray (run, member_id, time_step), with init,
+    experiment and (run, time_step) valid_time coordinates (cftime
+    datetimes for runs in non-standard calendars), and a
+    (run, member_id) member coordinate, since members are stored by
+    position in each run (and the same position can be a different
+    member in different runs). Members and time steps a run does not
+    have are NaN (with member "", and no valid_time).
+    """
+    index, get_array = open_store(model, store_root)
+    dims = index["variables"][var]
+    coords = index["coords"]
+
+    run_ix = [ix for ix, run in enumerate(index["runs"])
+              if ((inits is None) or (run["init"] in inits)) and ((experiments is None) or (run["experiment"] in experiments))]
+    lat_ix, weights = lat_weights(coords["lat"], lat)
+    extra = find_extra_index(var, dims, coords, sel)
+    plev_ix = find_level(coords["plev"], plev)
+
+    # Only the (contiguous) series of the selected runs, latitudes and
+    # level are read from the memory map
+    array = get_array(var)
+    series = np.zeros((len(run_ix), index["n_members"], index["n_time"]))
+    for ix, run in enumerate(run_ix):
+        for lat_row, weight in zip(lat_ix, weights):
+            series[ix] += weight * array[(run, slice(None)) + extra + (lat_row, plev_ix)]
+
+    runs = [index["runs"][ix] for ix in run_ix]
+    times = parse_times(runs)
+    if all(t.dtype.kind == "M" for t in times):
+        valid_time = np.full((len(runs), index["n_time"]), np.datetime64("NaT"), dtype="datetime64[ns]")
+    else:
+        valid_time = np.full((len(runs), index["n_time"]), None, dtype=object)
+    members = np.full((len(runs), index["n_members"]), "", dtype=object)
+    for ix, run in enumerate(runs):
+        valid_time[ix, :len(times[ix])] = times[ix]
+        members[ix, :len(run["members"])] = run["members"]
+
+    return xr.DataArray(
+        series.astype(STORE_DTYPE),
+        dims=("run", "member_id", "time_step"),
+        coords=dict(
+            init=("run", [run["init"] for run in runs]),
+            experiment=("run", [run["experiment"] for run in runs]),
+            member=(("run", "member_id"), members.astype(str)),
+            valid_time=(("run", "time_step"), valid_time),
+        ),
+        name=var,
+    )
+
+
+def main():
+    args = parse_commandline_args()
+
+    failed = []
+    for model in args.models:
+        files = find_compiled_files(model, args.processed_root, args.format, args.rescan)
+        if len(files) == 0:
+            print(f"No compiled zonal mean files for {model}; skipping")
+            continue
+
+        store_dir = pathlib.Path(args.store_root) / model
+        if (args.clobber is False) and is_current(store_dir, files):
+            print(f"{store_dir} is up to date; skipping")
+            continue
+
+        print(f"Building {store_dir} from {len(files)} compiled files")
+        try:
+            build_store(model, files, args.store_root)
+        except Exception as e:
+            print(f"(ERROR) Unable to build the store for {model}")
+            print(f"(ERROR) Exception: {e}")
+            failed.append(model)
+
+    if len(failed) != 0:
+        print(f"(ERROR) Unable to build stores for {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
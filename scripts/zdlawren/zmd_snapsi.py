@@ -1,38 +1,92 @@
-""" This python script generates a zonal mean dataset for a 
-specified set of SNAPSI data. It takes required commandline 
-args that specify the source_id (model name), 
-sub_experiment_id (model init), and experiment_id -- in that 
-order -- which are used to query the SNAPSI intake catalog. 
+""" This python script generates a zonal mean dataset for a
+specified set of SNAPSI data. It takes required commandline
+args that specify the source_id (model name),
+sub_experiment_id (model init), and experiment_id -- in that
+order -- which are used to query the SNAPSI intake catalog.
 
 This script uses pyzome (https://github.com/zdlawrence/pyzome)
-to compute the zonal mean datasets. 
+to compute the zonal mean datasets.
 
-Currently the script iterates over ensemble members and 
-outputs files for these individually. In principle, the 
-pyzome operations should work lazily on all ensemble members, but 
-I ran into issues with my SLURM jobs being killed when I tried 
-to keep all ensemble members together.  
+By default the script iterates over ensemble members and
+outputs files for these individually. In principle, the
+pyzome operations should work lazily on all ensemble members, but
+I ran into issues with my SLURM jobs being killed when I tried
+to keep all ensemble members together. With --ensemble, all
+ensemble members are processed in a single pass instead, with
+chunk sizes along member_id/time chosen so that the working set
+stays within the memory given by --mem (which should match the
+memory requested from SLURM). The output is still one file
+per member.
+
+In either mode, the zonal means are computed and appended to the
+output files one block of time steps at a time (see
+streaming_writer.py), with the number of committed time steps
+recorded in the file attributes. A job that times out thus
+leaves behind a valid partial file, which a re-run of the same
+job continues from the last committed block. Each file is also
+stamped with a completion record (see output_validation.py), so
+that finished files can be validated from their metadata alone.
+
+With --format zarr, each member is written to a chunked, compressed
+zarr store instead (see output_formats.py), one chunk per block of
+time steps, which can be resumed in the same way.
 
 Original Author: Z. D. Lawrence
-Last modified: 2023-07-18
-""" 
+Last modified: 2026-10-17
+"""
 
+import os
+import re
 import argparse
 import pathlib
 from datetime import datetime
 
-import intake
 import numpy as np
 import xarray as xr
 
 from pyzome.recipes import create_zonal_mean_dataset
 
+from catalog_query import search_catalog
+from output_formats import (
+    FORMATS, get_format, remove_output, read_output_progress, get_output_resume_step,
+    init_output, write_output_block, stream_to_output,
+)
+from output_index import record_output
+from output_validation import check_file
+from streaming_writer import iter_blocks
+
+CATALOG_FILE = "/gws/nopw/j04/snapsi/test-snapsi-catalog-fast.json"
+OUTPUT_ROOT = pathlib.Path("/work/scratch-nopw2/zdlawren/zmd")
+
+# Rough ratio of the peak memory used while computing a chunk of
+# zonal mean diagnostics to the size of that chunk of input fields
+# (eddies, products of eddies, and complex FFT coefficients are
+# all held at once). Only the fraction MEMORY_HEADROOM of the
+# memory budget is handed out to chunks; the rest is left for
+# the interpreter, netCDF buffers, and output waiting to be written
+WORKING_SET_FACTOR = 12
+MEMORY_HEADROOM = 0.6
+
+
+def parse_commandline_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", type=str, help="source_id")
+    parser.add_argument("subexperiment", type=str, help="sub_experiment_id")
+    parser.add_argument("experiment", type=str, help="experiment_id")
+    parser.add_argument("--ensemble", action="store_true", help="process all ensemble members in one pass")
+    parser.add_argument("--mem", type=str, default="20G", help="memory budget for --ensemble, e.g., 20G or 512M")
+    parser.add_argument("--workers", type=int, default=None, help="number of dask threads for --ensemble")
+    parser.add_argument("--members", type=str, nargs="*", default=None, help="only process these member_ids")
+    parser.add_argument("--time_block", type=int, default=40, help="max number of time steps to compute and write at once")
+    parser.add_argument("--format", type=str, default="netcdf", choices=FORMATS, help="output format")
+    return parser.parse_args()
+
 
 def is_zmd_file_bad(path_to_file):
-    """ A brute force function to tell if a zmd file 
-    is bad. If a SLURM job doesn't complete in time, 
+    """ A brute force function to tell if a zmd file
+    is bad. If a SLURM job doesn't complete in time,
     a zmd file may be written to disk filled with nans.
-    Here we simply check each of the fields, and throw 
+    Here we simply check each of the fields, and throw
     an error if any has more nans than half its full size.
     This is done for the try except in the script below
     so that the file can be remade.
@@ -41,7 +95,7 @@ def is_zmd_file_bad(path_to_file):
     tmp = xr.open_dataset(path_to_file)
     if len(tmp.data_vars) < 17:
         raise ValueError("zmd file does not have enough fields")
-    
+
     for key, field in tmp.data_vars.items():
         nbad = np.isnan(field).sum().data
         total_size = field.nbytes/field.dtype.itemsize
@@ -49,58 +103,144 @@ def is_zmd_file_bad(path_to_file):
             raise ValueError("Field has too many nans")
 
 
-# Set up argument parser
-parser = argparse.ArgumentParser()
-parser.add_argument("model", type=str, help="source_id")
-parser.add_argument("subexperiment", type=str, help="sub_experiment_id")
-parser.add_argument("experiment", type=str, help="experiment_id")
-args = parser.parse_args()
-
-# Pull args into variables for convenience
-source_id = args.model
-experiment_id = args.experiment
-sub_experiment_id = args.subexperiment
-
-# Open the Intake catalog and subset to the specific model, init, and experiment
-catalog = intake.open_esm_datastore("/gws/nopw/j04/snapsi/test-snapsi-catalog-fast.json")
-subset = catalog.search(
-    variable_id=["ua", "va", "ta", "zg", "wap"],
-    source_id=source_id, 
-    sub_experiment_id=sub_experiment_id,
-    experiment_id=experiment_id
-)
+def parse_memsize(memsize):
+    """ Convert a memory size string like those accepted
+    by SLURM (e.g., 20G, 512M) into a number of bytes
+    """
+    match = re.match(r"^([0-9]+)([KMGT]?)$", memsize)
+    if match is None:
+        raise ValueError(f"'{memsize}' is not a valid memsize; needs [num]K/M/G/T")
+    power = " KMGT".index(match.group(2) or " ")
+    return int(match.group(1)) * 1024**power
+
+
+def default_num_workers():
+    """ Number of threads available to this job """
+    return int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count()))
+
+
+def choose_ensemble_chunks(ds, mem_bytes, num_workers, max_time_chunk=None):
+    """ Pick chunk sizes along member_id and time so that
+    num_workers chunks can be worked on at once without the
+    working set exceeding mem_bytes. Chunks grow along time
+    first (up to max_time_chunk), and only span several members
+    once they cover the full time dimension of each member (so
+    never when max_time_chunk is shorter than it). The remaining
+    dimensions are never chunked, since the FFTs need all
+    longitudes at once.
+    """
+    step_bytes = sum(
+        ds[var].dtype.itemsize * np.prod([ds.sizes[dim] for dim in ds[var].dims if dim not in {"member_id", "time"}])
+        for var in ds.data_vars
+    )
+    budget = mem_bytes * MEMORY_HEADROOM / num_workers
+    max_steps = int(budget // (WORKING_SET_FACTOR * step_bytes))
+    if max_steps < 1:
+        msg = f"A single time step needs ~{WORKING_SET_FACTOR*step_bytes/1024**3:.1f} GiB per worker; increase --mem or reduce --workers"
+        raise ValueError(msg)
+
+    num_times = ds.sizes["time"]
+    time_chunk = min(max_steps, num_times, max_time_chunk or num_times)
+    member_chunk = 1
+    if time_chunk == num_times:
+        member_chunk = min(max(max_steps // num_times, 1), ds.sizes["member_id"])
+    return {"member_id": member_chunk, "time": time_chunk}
+
+
+def open_snapsi_dataset(source_id, sub_experiment_id, experiment_id, chunks=None, catalog=None):
+    """ Query the catalog for the fields needed for the zonal
+    mean datasets, and open them as one dask-backed dataset
+    with the variable names that pyzome expects. chunks may
+    give the chunk size along time (or member_id) to open with.
+    An already opened catalog (e.g., one shared by many calls)
+    can be given to search instead of querying CATALOG_FILE.
+    """
+    query = dict(
+        variable_id=["ua", "va", "ta", "zg", "wap"],
+        source_id=source_id,
+        sub_experiment_id=sub_experiment_id,
+        experiment_id=experiment_id
+    )
+    if catalog is not None:
+        subset = catalog.search(**query)
+    else:
+        subset = search_catalog(CATALOG_FILE, **query)
+
+    # Each file holds a single member, so only the time
+    # chunking can be applied when opening the files
+    xarray_open_kwargs = {"engine": "h5netcdf"}
+    if chunks is not None:
+        xarray_open_kwargs["chunks"] = {"time": chunks["time"]}
+
+    ds = subset.to_dask(xarray_open_kwargs=xarray_open_kwargs)
+    ds = ds.rename({"ua":"u", "va":"v", "wap":"w", "ta":"T", "zg": "Z"})
+    if 'lat_bnds' in ds.coords:
+        ds = ds.drop('lat_bnds')
+    if 'lon_bnds' in ds.coords:
+        ds = ds.drop('lon_bnds')
+    if 'sub_experiment_id' in ds.coords:
+        ds = ds.isel(sub_experiment_id=0)
+        ds = ds.drop('sub_experiment_id')
+
+    # some models named their pressure level coordinate "snap34"
+    if ('snap34') in ds.coords:
+        ds = ds.rename({"snap34": "plev"})
+
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+    return ds
+
+
+def compute_zonal_means(ds):
+    """ Set up the (lazy) zonal mean dataset of ds, with every
+    field encoded as float32 for when it is saved. No compression
+    is used for netcdf, to ensure dask chunking can be used on output;
+    zarr stores are both chunked and compressed.
+    """
+    zmd = create_zonal_mean_dataset(
+        ds,
+        verbose=True,
+        include_waves=True,
+        waves=[1,2,3],
+        fftpkg="xrft"
+    )
+
+    if "zonal_wavenum" in zmd.coords:
+        zmd = zmd.rename({"zonal_wavenum": "wavenum_lon"})
+
+    for var in zmd.data_vars:
+        zmd[var].encoding.update(dtype="float32")
+    zmd.attrs['history'] = f'Created by zdlawren using pyzome on {datetime.utcnow()}'
+    return zmd
+
+
+def get_output_path(output_dir, source_id, sub_experiment_id, experiment_id, member, fmt="netcdf"):
+    output_file = f"{source_id}_{sub_experiment_id}_{experiment_id}_{member}_zmd{FORMATS[fmt]}"
+    return f"{str(output_dir)}/{output_file}"
 
-# Setup the output directory
-output_dir = pathlib.Path(f"/work/scratch-nopw2/zdlawren/zmd/{source_id}/{sub_experiment_id}/{experiment_id}/")
-output_dir.mkdir(parents=True, exist_ok=True)
-
-# Convert our query into a dataset and rename data_vars 
-# to names that pyzome expects
-ds = subset.to_dask(xarray_open_kwargs={"engine":"h5netcdf"})
-print(ds)
-ds = ds.rename({"ua":"u", "va":"v", "wap":"w", "ta":"T", "zg": "Z"})
-if 'lat_bnds' in ds.coords:
-    ds = ds.drop('lat_bnds')
-if 'lon_bnds' in ds.coords:
-    ds = ds.drop('lon_bnds')
-if 'sub_experiment_id' in ds.coords:
-    ds = ds.isel(sub_experiment_id=0)
-    ds = ds.drop('sub_experiment_id')
-
-# some models named their pressure level coordinate "snap34"
-if ('snap34') in ds.coords:
-    ds = ds.rename({"snap34": "plev"})
-
-# Iterate over ensemble members
-for member in ds.member_id.values:
-    
-    # Set up the output name/path
-    output_file = f"{source_id}_{sub_experiment_id}_{experiment_id}_{member}_zmd.nc"
-    output_path = f"{str(output_dir)}/{output_file}"
-    
-    # Check if file already exists and if it can be read as a first order
-    # handler for re-running jobs that didn't finish in time before
-    if pathlib.Path(output_path).exists() is True:
+
+def needs_processing(output_path):
+    """ Check if file already exists and if it can be read as a first order
+    handler for re-running jobs that didn't finish in time before. Files
+    written in blocks are checked using their completion records;
+    older files are scanned for NaNs.
+    """
+    progress = read_output_progress(output_path)
+    if progress is not None:
+        committed, total = progress
+        if committed != total:
+            print(f"{output_path} only has {committed} of {total} time steps ... Resuming")
+            return True
+
+        problems = check_file(output_path, min_vars=17)
+        if len(problems) == 0:
+            print(f"{output_path} already exists and is complete! Skipping ...")
+            return False
+        print(f"{output_path} already exists but has issues ({'; '.join(problems)}) ... Remaking")
+        remove_output(output_path)
+        return True
+
+    if (get_format(output_path) == "netcdf") and (pathlib.Path(output_path).exists() is True):
         try:
             is_zmd_file_bad(output_path)
         except Exception:
@@ -108,31 +248,108 @@ for member in ds.member_id.values:
             pass
         else:
             print(f"{output_path} already exists and is complete! Skipping ...")
+            return False
+    return True
+
+
+def process_members(ds, output_dir, source_id, sub_experiment_id, experiment_id, time_block, fmt="netcdf"):
+    """ Compute and save the zonal mean datasets one ensemble member at a time """
+    for member in ds.member_id.values:
+        output_path = get_output_path(output_dir, source_id, sub_experiment_id, experiment_id, member, fmt)
+        if needs_processing(output_path) is False:
             continue
-    
-    print(f"Now working on {member} for {source_id} {experiment_id} {sub_experiment_id}")
-    zmd = create_zonal_mean_dataset(
-        ds.sel(member_id=member),
-        verbose=True, 
-        include_waves=True, 
-        waves=[1,2,3], 
-        fftpkg="xrft"
-    ) 
 
-    if "zonal_wavenum" in zmd.coords:
-        zmd = zmd.rename({"zonal_wavenum": "wavenum_lon"})
-    
-    # Set up encoding dictionary to ensure everything gets saved as
-    # float32 (with no compression to ensure dask chunking can be used on output)
-    comp = dict(dtype="float32")
-    encoding = {var: comp for var in zmd.data_vars}    
-
-    # Since we're using dask for everything, no actual computations 
-    # are done until the to_netcdf method is called
-    print(f"Saving to {output_path}")
-    zmd.attrs['history'] = f'Created by zdlawren using pyzome on {datetime.utcnow()}'
+        print(f"Now working on {member} for {source_id} {experiment_id} {sub_experiment_id}")
+        zmd = compute_zonal_means(ds.sel(member_id=member))
+
+        # Since we're using dask for everything, no actual computations
+        # are done until each block of time steps is written
+        print(f"Saving to {output_path}")
+        try:
+            stream_to_output(zmd, output_path, time_block)
+            record_output(output_path)
+        except Exception as e:
+            print(f"(ERROR) Unable to complete zmd file for {member} of {source_id} {experiment_id} {sub_experiment_id}")
+            print(f"(ERROR) Exception: {e}")
+
+
+def process_ensemble(ds, output_dir, source_id, sub_experiment_id, experiment_id, num_workers, fmt="netcdf"):
+    """ Compute the zonal mean datasets of all ensemble members
+    (that still need it) in one pass, writing one file per member.
+    Each block of time steps (one dask chunk long) is computed for
+    all members at once, and then appended to each member's file.
+    """
+    members = [
+        member for member in ds.member_id.values
+        if needs_processing(get_output_path(output_dir, source_id, sub_experiment_id, experiment_id, member, fmt))
+    ]
+    if len(members) == 0:
+        return
+    ds = ds.sel(member_id=members)
+
+    print(f"Now working on {len(members)} members for {source_id} {experiment_id} {sub_experiment_id}")
+    zmd = compute_zonal_means(ds)
+
+    output_paths = {
+        member: get_output_path(output_dir, source_id, sub_experiment_id, experiment_id, member, fmt)
+        for member in members
+    }
+
+    # Resume from the earliest uncommitted block of any member;
+    # members that are further along just get blocks rewritten
+    total = zmd.sizes["time"]
+    start = min(get_output_resume_step(path, total) for path in output_paths.values())
+    time_block = ds.chunks["time"][0]
+    if start == 0:
+        for member, output_path in output_paths.items():
+            init_output(zmd.sel(member_id=member), output_path, time_block)
+
+    print(f"Saving to {output_dir} with {num_workers} threads, starting at time step {start}")
     try:
-        zmd.to_netcdf(output_path, encoding=encoding)
+        for time_slice in iter_blocks(total, time_block, start):
+            block = zmd.isel(time=time_slice).compute(scheduler="threads", num_workers=num_workers)
+            for member, output_path in output_paths.items():
+                write_output_block(block.sel(member_id=member), output_path, time_slice.start, total)
+        for output_path in output_paths.values():
+            record_output(output_path)
     except Exception as e:
-        print(f"(ERROR) Unable to complete zmd file for {member} of {source_id} {experiment_id} {sub_experiment_id}")
+        print(f"(ERROR) Unable to complete zmd files for {source_id} {experiment_id} {sub_experiment_id}")
         print(f"(ERROR) Exception: {e}")
+
+
+def main():
+    args = parse_commandline_args()
+
+    # Pull args into variables for convenience
+    source_id = args.model
+    experiment_id = args.experiment
+    sub_experiment_id = args.subexperiment
+
+    # Setup the output directory
+    output_dir = OUTPUT_ROOT / f"{source_id}/{sub_experiment_id}/{experiment_id}/"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    ds = open_snapsi_dataset(source_id, sub_experiment_id, experiment_id)
+    if args.members is not None:
+        ds = ds.sel(member_id=args.members)
+    if args.ensemble is False:
+        print(ds)
+        process_members(ds, output_dir, source_id, sub_experiment_id, experiment_id, args.time_block, args.format)
+        return
+
+    # Figure out the chunking from the (lazily opened) dataset,
+    # then re-open it so the files are read in those chunks
+    mem_bytes = parse_memsize(args.mem)
+    num_workers = args.workers or default_num_workers()
+    chunks = choose_ensemble_chunks(ds, mem_bytes, num_workers, args.time_block)
+    print(f"Using chunks {chunks} for a memory budget of {args.mem} with {num_workers} threads")
+
+    ds = open_snapsi_dataset(source_id, sub_experiment_id, experiment_id, chunks=chunks)
+    if args.members is not None:
+        ds = ds.sel(member_id=args.members)
+    print(ds)
+    process_ensemble(ds, output_dir, source_id, sub_experiment_id, experiment_id, num_workers, args.format)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,92 +2,198 @@
 of the SNAPSI output into files containing the Eliassen-Palm
 flux components.
 
+The zonal mean datasets are opened lazily, in chunks of members
+and time steps, so that files are never read into memory whole.
+With --workers, many files are converted at once on a pool of
+processes, each computing with --threads_per_worker dask threads.
+With --format zarr, zarr stores of the zonal means are converted
+into (chunked, compressed) zarr stores of the EP fluxes, whose
+chunks are all computed and written in parallel.
+
 Original Author: Z. D. Lawrence
-Last modified: 2023-08-14
+Last modified: 2026-10-17
 """
 
+import os
 import sys
 import argparse
 import pathlib
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import dask
 import xarray as xr
 from pyzome import tem
 
+from output_formats import FORMATS, remove_output, open_output, write_dataset
+from output_index import find_product_files, record_output
+from output_validation import check_file
+
 DATA_ROOT = pathlib.Path("/gws/nopw/j04/snapsi/processed")
 
+# Chunk sizes for reading the zonal mean datasets; the EP fluxes need
+# the full lat/plev cross-sections, so only members and time are split
+ZMD_CHUNKS = {"member_id": 1, "time": 120}
+
 
 def parse_commandline_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("model", type=str, help="")
     parser.add_argument("--clobber", action="store_true", help="Overwrite old EP-flux files")
+    parser.add_argument("--inputs", type=str, nargs="*", default=None, help="convert only these zonal mean files")
+    parser.add_argument("--rescan", action="store_true", help="glob for the zonal mean files instead of using the output index")
+    parser.add_argument("--workers", type=int, default=1, help="number of files to convert at once")
+    parser.add_argument("--threads_per_worker", type=int, default=None, help="dask threads used for each file")
+    parser.add_argument("--format", type=str, default="netcdf", choices=FORMATS, help="format of the zonal mean and EP flux files")
     return parser.parse_args()
 
 
+def get_epf_path(zmd_file):
+    """ Set up the output file name from the input file name """
+    return pathlib.Path(
+        str(zmd_file).replace("zonal_means", "ep_fluxes").replace("zonalmeans", "epfluxes")
+    )
+
+
+def compute_ep_fluxes(zmd):
+    """ Compute the total and per-wavenumber EP fluxes in one pass.
+    The total covariances are prepended to the wavenumber covariances
+    as wavenumber 0, so the derivatives of u and T are only taken once.
+    """
+    covs = {}
+    for var in ["uv", "vT", "uw"]:
+        total = zmd[var].expand_dims(wavenum_lon=[0])
+        covs[var] = xr.concat([total, zmd[f"{var}_k"]], dim="wavenum_lon")
+    epfy_all, epfz_all = tem.epflux_vector(zmd.u, zmd.T, covs["uv"], covs["vT"], covs["uw"])
+
+    epfy = epfy_all.isel(wavenum_lon=0, drop=True).transpose(*zmd.u.dims)
+    epfz = epfz_all.isel(wavenum_lon=0, drop=True).transpose(*zmd.u.dims)
+    epfy_k = epfy_all.isel(wavenum_lon=slice(1, None)).transpose(*zmd.uv_k.dims)
+    epfz_k = epfz_all.isel(wavenum_lon=slice(1, None)).transpose(*zmd.uv_k.dims)
+    return epfy, epfz, epfy_k, epfz_k
+
+
+def convert_to_epf(fi, output_file, model):
+    """ Compute the EP fluxes from the zonal mean dataset in fi,
+    and save them to output_file
+    """
+    # Setup the output path
+    output_path = output_file.parent
+    output_path.mkdir(exist_ok = True)
+    print(f"Converting {fi} to {output_file}")
+
+    # Open the zonal mean dataset files, and keep only what we need:
+    # zonal winds, temps, and eddy fluxes. Then compute EP fluxes
+    zmd = open_output(fi)[["u", "T", "uv", "vT", "uw", "uv_k", "vT_k", "uw_k"]]
+    if model == "era5":
+        zmd = zmd.rename({"pres":"plev","zonal_wavenum":"wavenum_lon"})
+        zmd["plev"].attrs["units"] = "Pa"
+    zmd = zmd.chunk({dim: size for dim, size in ZMD_CHUNKS.items() if dim in zmd.dims})
+    epfy, epfz, epfy_k, epfz_k = compute_ep_fluxes(zmd)
+
+    # Add attributes for the data being saved to netcdf
+    epfy.name = "epfy"
+    epfy.attrs["long_name"] = "meridional component of EP flux"
+
+    epfz.name = "epfz"
+    epfz.attrs["long_name"] = "vertical component of EP flux"
+
+    epfy_k.name = "epfy_k"
+    epfy_k.attrs["long_name"] = "meridional component of EP flux due to zonal wavenumber k"
+
+    epfz_k.name = "epfz_k"
+    epfz_k.attrs["long_name"] = "vertical component of EP flux due to zonal wavenumber k"
+
+    # Collect the fields into an xarray Dataset
+    epf_ds = xr.merge([epfy, epfz, epfy_k, epfz_k], combine_attrs="drop")
+
+    # Set up encoding dictionary to ensure we use float32 with light compression
+    comp = dict(dtype="float32", zlib=True, complevel=3)
+    encoding = {var: comp for var in epf_ds.data_vars}
+    for var in epf_ds.data_vars:
+        epf_ds[var].encoding.update(dtype="float32")
+
+    print(f"Saving to {output_file}")
+    epf_ds.attrs['history'] = f'Created by zdlawren using pyzome on {datetime.utcnow()}'
+    try:
+        write_dataset(epf_ds, output_file, netcdf_encoding=encoding)
+        record_output(output_file)
+    except Exception as e:
+        print(f"(ERROR) Unable to complete EP-flux file for {fi}")
+        print(f"(ERROR) Exception: {e}")
+
+        # Remove any file that is partially created/written, for whatever reason
+        remove_output(output_file)
+        return False
+    finally:
+        zmd.close()
+    return True
+
+
+def is_epf_file_done(output_file):
+    """ Whether an EP flux file already exists and is complete, according
+    to its completion record (older files without a record are trusted)
+    """
+    if output_file.exists() is False:
+        return False
+    problems = check_file(output_file)
+    if problems in ([], ["no completion record"]):
+        return True
+    print(f"{output_file} already exists but has issues ({'; '.join(problems)}); remaking")
+    return False
+
+
+def init_worker(threads_per_worker):
+    dask.config.set(scheduler="threads", num_workers=threads_per_worker)
+
+
+def convert_files(conversions, model, workers=1, threads_per_worker=None):
+    """ Convert (input, output) file pairs, workers files at a time.
+    Returns the inputs that could not be converted.
+    """
+    if workers == 1:
+        return [fi for fi, output_file in conversions if convert_to_epf(fi, output_file, model) is False]
+
+    threads_per_worker = threads_per_worker or max(os.cpu_count() // workers, 1)
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(threads_per_worker,)) as pool:
+        futures = {pool.submit(convert_to_epf, fi, output_file, model): fi for fi, output_file in conversions}
+        for future in as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"(ERROR) Unable to convert {futures[future]}: {e}")
+                ok = False
+            if ok is False:
+                failed.append(futures[future])
+    return failed
+
+
 def main():
     args = parse_commandline_args()
 
-    zmd_files = sorted(list(DATA_ROOT.glob(f"**/{args.model}*zonalmeans.nc")))
+    if args.inputs is not None:
+        zmd_files = [pathlib.Path(fi) for fi in args.inputs]
+    else:
+        zmd_files = find_product_files("zonal_means", args.model, DATA_ROOT, FORMATS[args.format], args.rescan)
     if len(zmd_files) == 0:
-        print(f"(ERROR) No zonal mean dataset files found for {model}")
+        print(f"(ERROR) No zonal mean dataset files found for {args.model}")
         sys.exit(1)
 
+    conversions = []
     for fi in zmd_files:
-        # Set up the output file name from the input file name
-        output_file = pathlib.Path(
-            str(fi).replace("zonal_means", "ep_fluxes").replace("zonalmeans", "epfluxes")
-        )
+        output_file = get_epf_path(fi)
 
         # Skip if file already exists and we're not clobbering
-        if args.clobber is False and output_file.exists():
+        if args.clobber is False and is_epf_file_done(output_file):
             print(f"{output_file} already exists; skipping")
             continue
+        conversions.append((fi, output_file))
 
-        # Otherwise, setup the output path
-        output_path = output_file.parent
-        output_path.mkdir(exist_ok = True)
-        print(f"Converting {fi} to {output_file}")
-
-        # Open the zonal mean dataset files, and keep only what we need:
-        # zonal winds, temps, and eddy fluxes. Then compute EP fluxes
-        zmd = xr.open_dataset(fi)[["u", "T", "uv", "vT", "uw", "uv_k", "vT_k", "uw_k"]]
-        if args.model == "era5":
-            zmd = zmd.rename({"pres":"plev","zonal_wavenum":"wavenum_lon"})
-            zmd["plev"].attrs["units"] = "Pa"
-        epfy, epfz = tem.epflux_vector(zmd.u, zmd.T, zmd.uv, zmd.vT, zmd.uw)
-        epfy_k, epfz_k = tem.epflux_vector(zmd.u, zmd.T, zmd.uv_k, zmd.vT_k, zmd.uw_k)
-
-        # Add attributes for the data being saved to netcdf
-        epfy.name = "epfy"
-        epfy.attrs["long_name"] = "meridional component of EP flux"
-
-        epfz.name = "epfz"
-        epfz.attrs["long_name"] = "vertical component of EP flux"
-
-        epfy_k.name = "epfy_k"
-        epfy_k.attrs["long_name"] = "meridional component of EP flux due to zonal wavenumber k"
-
-        epfz_k.name = "epfz_k"
-        epfz_k.attrs["long_name"] = "vertical component of EP flux due to zonal wavenumber k"
-
-        # Collect the fields into an xarray Dataset
-        epf_ds = xr.merge([epfy, epfz, epfy_k, epfz_k], combine_attrs="drop")
-
-        # Set up encoding dictionary to ensure we use float32 with light compression
-        comp = dict(dtype="float32", zlib=True, complevel=3)
-        encoding = {var: comp for var in epf_ds.data_vars}
-
-        print(f"Saving to {output_file}")
-        epf_ds.attrs['history'] = f'Created by zdlawren using pyzome on {datetime.utcnow()}'
-        try:
-            epf_ds.to_netcdf(output_file, encoding=encoding)
-        except Exception as e:
-            print(f"(ERROR) Unable to complete EP-flux file for {member} of {source_id} {experiment_id} {sub_experiment_id}")
-            print(f"(ERROR) Exception: {e}")
-
-            # Remove any file that is partially created/written, for whatever reason
-            if output_file.exists():
-                output_file.unlink()
+    failed = convert_files(conversions, args.model, args.workers, args.threads_per_worker)
+    if len(failed) != 0:
+        print(f"(ERROR) Unable to convert {len(failed)} of {len(conversions)} files")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,82 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+from anomalies import climatology_array_path, climatology_positions, load_climatology, subtract_climatology
+
+
+def make_record(start="1999-01-01", end="2001-12-31", freq="D"):
+    time = pd.date_range(start, end, freq=freq)
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((len(time), 2, 3))
+    return xr.DataArray(
+        data, coords={"time": time, "lat": [60.0, 70.0], "lon": [0.0, 120.0, 240.0]},
+        dims=["time", "lat", "lon"], name="Z",
+    )
+
+
+def make_noleap_climatology(hours=None):
+    rng = np.random.default_rng(1)
+    coords = {"dayofyear": np.arange(1, 366), "lat": [60.0, 70.0], "lon": [0.0, 120.0, 240.0]}
+    if hours is not None:
+        coords["hour"] = hours
+    dims = ["dayofyear"] + (["hour"] if hours is not None else []) + ["lat", "lon"]
+    shape = [len(coords[dim]) for dim in dims]
+    return xr.DataArray(rng.standard_normal(shape), coords=coords, dims=dims, name="Z")
+
+
+def noleap_day(timestamp):
+    # Day of a noleap year with 30 June removed from leap years,
+    # which takes the climatology of 29 June
+    day = timestamp.dayofyear
+    if timestamp.is_leap_year and (timestamp.month, timestamp.day) >= (6, 30):
+        day -= 1
+    return day
+
+
+def test_anomalies_match_groupby_arithmetic():
+    da = make_record()
+    clim = da.groupby("time.dayofyear").mean("time")
+    expected = da.groupby("time.dayofyear") - clim
+
+    np.testing.assert_allclose(subtract_climatology(da, clim).values, expected.values)
+    lazy = subtract_climatology(da.chunk({"time": 100}), clim)
+    assert lazy.chunks is not None
+    np.testing.assert_allclose(lazy.values, expected.values)
+
+
+def test_positions_in_a_noleap_climatology():
+    da = make_record("2000-01-01", "2001-12-31 18:00", freq="6h")
+    clim = make_noleap_climatology()
+    days = [noleap_day(timestamp) for timestamp in da.indexes["time"]]
+    np.testing.assert_array_equal(climatology_positions(da["time"].values, clim), np.array(days) - 1)
+
+    hourly = make_noleap_climatology(hours=[0.0, 6.0, 12.0, 18.0])
+    slots = da.indexes["time"].hour // 6
+    np.testing.assert_array_equal(climatology_positions(da["time"].values, hourly), (np.array(days) - 1) * 4 + slots)
+
+    expected = da.values - hourly.stack(step=("dayofyear", "hour")).transpose("step", ...).values[(np.array(days) - 1) * 4 + slots]
+    np.testing.assert_allclose(subtract_climatology(da, hourly).values, expected)
+
+
+def test_climatology_is_cached_or_kept_in_memory(tmp_path):
+    clim = make_noleap_climatology()
+    source = tmp_path / "climatology.nc"
+    clim.to_dataset().to_netcdf(source)
+
+    cached = load_climatology(source, "Z", tmp_path / "cache")
+    assert climatology_array_path(source, "Z", tmp_path / "cache").exists()
+    assert cached.chunks is not None
+    np.testing.assert_array_equal(cached.values, clim.values)
+
+    # A cache directory that cannot be created
+    (tmp_path / "file").write_text("")
+    in_memory = load_climatology(source, "Z", tmp_path / "file" / "cache")
+    assert in_memory.chunks is None
+    np.testing.assert_array_equal(in_memory.values, clim.values)
+    np.testing.assert_allclose(subtract_climatology(clim.rename(dayofyear="time").assign_coords(
+        time=pd.date_range("2001-01-01", periods=365)), in_memory).values, 0)
@@ -0,0 +1,73 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.signal
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "climatology"))
+from calc_climatology import calc_daily_climatology, calc_daily_climatology_files, smooth_climatology
+
+
+def make_daily(start="1979-01-01", end="1984-12-31"):
+    time = pd.date_range(start, end, freq="D")
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((len(time), 3, 4)).astype(np.float32)
+    data[rng.random(data.shape) < 0.01] = np.nan
+    return xr.DataArray(
+        data, coords={"time": time, "lat": [60.0, 70.0, 80.0], "lon": [0.0, 90.0, 180.0, 270.0]},
+        dims=["time", "lat", "lon"], name="t2m",
+    )
+
+
+def reference_climatology(da):
+    # The original groupby formulation: drop 30 June of leap years,
+    # relabel the days onto a noleap calendar and average by day of year
+    da = da.sel(time=slice("1980-01-01", "2019-12-31"))
+    da = da.sel(time=~((da.time.dt.month == 6) & (da.time.dt.day == 30) & (da.time.dt.year % 4 == 0)))
+    noleap = xr.date_range("1980-01-01", periods=len(da.time), freq="D", calendar="noleap", use_cftime=True)
+    da = xr.DataArray(da.data, coords={"time": noleap, "lat": da.lat, "lon": da.lon})
+    return da.groupby("time.dayofyear").mean("time")
+
+
+def test_daily_climatology_matches_groupby():
+    da = make_daily()
+    expected = reference_climatology(da)
+    np.testing.assert_allclose(calc_daily_climatology(da, time_block=50).values, expected.values, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(calc_daily_climatology(da.chunk({"time": 100})).values, expected.values, rtol=1e-5, atol=1e-6)
+
+
+def test_daily_climatology_from_yearly_files(tmp_path):
+    da = make_daily()
+    files = []
+    for year, yearly in da.groupby("time.year"):
+        files.append(tmp_path / f"t2m_{year}.nc")
+        yearly.to_dataset().to_netcdf(files[-1])
+
+    expected = reference_climatology(da)
+    np.testing.assert_allclose(calc_daily_climatology_files(files, "t2m").values, expected.values, rtol=1e-5, atol=1e-6)
+
+
+def reference_smoothing(climatology, window_len):
+    # The original wrap-padded convolution along dayofyear
+    window = scipy.signal.windows.triang(window_len)
+    pad = np.pad(climatology.values, ((window_len//2, window_len//2 - 1), (0, 0), (0, 0)), "wrap")
+    return scipy.signal.convolve(pad, window[:, None, None] / window.sum(), mode="valid")
+
+
+@pytest.mark.parametrize("window_len", [10, 30])
+def test_smoothing_matches_wrapped_convolution(window_len):
+    climatology = calc_daily_climatology(make_daily()).astype(np.float64).fillna(0)
+    expected = reference_smoothing(climatology, window_len)
+
+    smoothed = smooth_climatology(climatology, window_len)
+    assert smoothed.dims == climatology.dims
+    np.testing.assert_allclose(smoothed.values, expected, rtol=1e-10, atol=1e-12)
+
+    # With dayofyear in the middle, and lazily on chunks of the other dimensions
+    moved = climatology.transpose("lat", "dayofyear", "lon").chunk({"lat": 1, "lon": 2})
+    smoothed = smooth_climatology(moved, window_len)
+    assert smoothed.chunks is not None
+    np.testing.assert_allclose(smoothed.transpose("dayofyear", ...).values, expected, rtol=1e-10, atol=1e-12)
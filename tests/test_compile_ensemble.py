@@ -0,0 +1,59 @@
+import pathlib
+import sys
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "zdlawren"))
+import compile_ensemble
+from compile_ensemble import compile_ensemble as compile_members
+from output_validation import check_file, read_record, stamp_completion_record
+
+
+def write_member(path, member, seed, steps=10):
+    rng = np.random.default_rng(seed)
+    time = pd.date_range("2018-01-25 06:00", periods=steps, freq="6h")
+    data = rng.standard_normal((steps, 3, 2)).astype(np.float32)
+    data[seed % steps, 1, 0] = np.nan
+    ds = xr.Dataset(
+        {"u": (("time", "plev", "lat"), data), "member_id": ((), member)},
+        coords={"time": time, "plev": [1000.0, 100.0, 10.0], "lat": [60.0, 70.0]},
+    )
+    ds.to_netcdf(path)
+    return path
+
+
+def test_merged_record_matches_a_full_stamp(tmp_path, monkeypatch):
+    files = [write_member(tmp_path / f"m{ix}.nc", f"r{ix}i1p1f1", ix) for ix in range(3)]
+    output = tmp_path / "compiled.nc"
+    # 4 time steps (2 steps of 24 bytes, for reading and writing) per chunk
+    mem_bytes = 4 * 2 * 24
+    assert compile_members(files, output, mem_bytes) == 3
+    assert check_file(output, deep=True, samples=3) == []
+
+    with netCDF4.Dataset(output) as nc:
+        merged = read_record(nc)
+    copy = tmp_path / "copy.nc"
+    copy.write_bytes(output.read_bytes())
+    stamp_completion_record(copy, time_block=4)
+    with netCDF4.Dataset(copy) as nc:
+        assert read_record(nc) == merged
+
+    # Only the changed member is read again
+    write_member(files[1], "r1i1p1f1", 7)
+    read = []
+    monkeypatch.setattr(compile_ensemble, "read_member_summaries", lambda nc, ix: read.append(ix))
+    assert compile_members(files, output, mem_bytes) == 1
+    assert read == []
+    assert check_file(output, deep=True, samples=3) == []
+    with xr.open_dataset(output) as ds, xr.open_dataset(files[1]) as member:
+        np.testing.assert_array_equal(ds["u"].isel(member_id=1).values, member["u"].values)
+
+
+def test_memory_for_less_than_a_time_step_is_refused(tmp_path):
+    files = [write_member(tmp_path / "m0.nc", "r0i1p1f1", 0)]
+    with pytest.raises(ValueError, match="needs 48 bytes"):
+        compile_members(files, tmp_path / "compiled.nc", 40)
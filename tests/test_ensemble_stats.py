@@ -0,0 +1,44 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "zdlawren"))
+from ensemble_stats import QUANTILES, block_stats
+
+
+def make_members(n_members, nan=False, steps=6):
+    rng = np.random.default_rng(n_members)
+    time = pd.date_range("2018-01-25 06:00", periods=steps, freq="6h")
+    data = rng.standard_normal((n_members, steps, 3, 4)) * [1.0, 10.0, 100.0, 1000.0]
+    if nan:
+        data[0, 2, 1, 3] = np.nan
+    blocks = [
+        xr.Dataset({"u": (("time", "plev", "lat"), member)}, coords={"time": time})
+        for member in data
+    ]
+    return data, blocks
+
+
+@pytest.mark.parametrize("n_members", [3, 6, 10, 50])
+def test_block_stats_match_numpy(n_members):
+    data, blocks = make_members(n_members)
+    stats = block_stats(iter(blocks), QUANTILES)
+
+    assert list(stats["statistic"].values) == ["mean", "spread", "q0.1", "q0.5", "q0.9"]
+    np.testing.assert_allclose(stats["u"].sel(statistic="mean").values, np.mean(data, axis=0), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(stats["u"].sel(statistic="spread").values, np.std(data, axis=0, ddof=1), rtol=1e-10)
+    for p in QUANTILES:
+        np.testing.assert_allclose(stats["u"].sel(statistic=f"q{p:g}").values, np.quantile(data, p, axis=0), rtol=1e-12)
+
+
+def test_block_stats_with_missing_members():
+    data, blocks = make_members(10, nan=True)
+    stats = block_stats(iter(blocks), [0.5])
+
+    np.testing.assert_allclose(stats["u"].sel(statistic="mean").values, np.nanmean(data, axis=0), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(stats["u"].sel(statistic="spread").values, np.nanstd(data, axis=0, ddof=1), rtol=1e-10)
+    np.testing.assert_array_equal(stats["u"].sel(statistic="q0.5").values, np.quantile(data, 0.5, axis=0))
@@ -0,0 +1,86 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.ndimage
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "NAM_NAO_SAM_indices"))
+from nao_calculation import lowpass, pca
+
+
+def make_series(steps=200, nan=False):
+    rng = np.random.default_rng(0)
+    time = pd.date_range("2018-01-01", periods=steps, freq="6h")
+    data = rng.standard_normal((3, steps, 4))
+    if nan:
+        data[1, 50, 2] = np.nan
+    return xr.DataArray(data, coords={"time": time}, dims=["lat", "time", "lon"])
+
+
+def reference_lowpass(da, n):
+    # The original periodic convolution with the triangular kernel
+    kernel = np.hstack([np.arange(1, np.ceil(n/2) + 1), np.arange(np.floor(n/2), 0, -1)])
+    kernel /= kernel.sum()
+    return np.apply_along_axis(scipy.ndimage.convolve, da.get_axis_num("time"), da.values, kernel, mode="wrap")
+
+
+@pytest.mark.parametrize("n", [5, 8, 121])
+def test_lowpass_matches_periodic_convolution(n):
+    da = make_series()
+    expected = reference_lowpass(da, n)
+    np.testing.assert_allclose(lowpass(da, "time", n).values, expected, rtol=1e-9, atol=1e-12)
+
+    chunked = lowpass(da.chunk({"time": 70}), "time", n)
+    assert chunked.chunks is not None
+    np.testing.assert_allclose(chunked.values, expected, rtol=1e-9, atol=1e-12)
+
+    valid = lowpass(da, "time", n, valid=True)
+    np.testing.assert_allclose(valid.values, expected[:, (n - 1) // 2:-(n - 1) // 2], rtol=1e-9, atol=1e-12)
+
+
+def test_lowpass_spreads_missing_values_over_their_windows():
+    da = make_series(nan=True)
+    expected = reference_lowpass(da, 9)
+    np.testing.assert_array_equal(np.isnan(lowpass(da, "time", 9).values), np.isnan(expected))
+    np.testing.assert_allclose(lowpass(da.chunk({"time": 70}), "time", 9).values, expected, rtol=1e-9, atol=1e-12)
+
+
+def make_anomalies(steps=120):
+    # Three well separated modes on top of weak noise
+    rng = np.random.default_rng(1)
+    lat, lon = np.linspace(30, 80, 6), np.linspace(-80, 40, 8)
+    patterns = rng.standard_normal((3, len(lat), len(lon)))
+    series = rng.standard_normal((steps, 3)) * [10.0, 5.0, 2.0]
+    data = np.einsum("tm,mxy->txy", series, patterns) + 0.01 * rng.standard_normal((steps, len(lat), len(lon)))
+    time = pd.date_range("2018-12-01", periods=steps, freq="6h")
+    return xr.DataArray(data, coords={"time": time, "lat": lat, "lon": lon}, dims=["time", "lat", "lon"])
+
+
+def reference_pca(anomalies):
+    # The original full decomposition, with standardized principal components
+    weights = np.sqrt(np.cos(anomalies["lat"] * np.pi/180))
+    stacked = (anomalies * weights).stack(allpoints=("lat", "lon")).transpose("time", "allpoints")
+    u, s, vh = np.linalg.svd(stacked.values, full_matrices=False)
+    u_std = np.std(u, axis=0)
+    eof = xr.DataArray(vh.T * s * u_std, dims=("allpoints", "number"), coords={"allpoints": stacked["allpoints"]})
+    return u / u_std, (eof.unstack("allpoints") / weights).transpose("number", "lat", "lon").values, s**2 / (s**2).sum()
+
+
+@pytest.mark.parametrize("method,chunks", [
+    ("svd", None), ("gram", None), ("gram", 40), ("randomized", None), ("randomized", 40), ("tsqr", 40),
+])
+def test_pca_matches_full_decomposition(method, chunks):
+    anomalies = make_anomalies()
+    pc, eof, expl = reference_pca(anomalies)
+    if chunks is not None:
+        anomalies = anomalies.chunk({"time": chunks})
+
+    ds = pca(anomalies, ("lat", "lon"), n_modes=2, method=method).compute()
+    # Modes are only defined up to their sign
+    signs = np.sign(np.sum(ds["pc"].values * pc[:, :2], axis=0))
+    np.testing.assert_allclose(ds["pc"].values * signs, pc[:, :2], rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(ds["eof"].transpose("number", "lat", "lon").values * signs[:, None, None], eof[:2], rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(ds["expl"].values, expl[:2], rtol=1e-6)
@@ -0,0 +1,43 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "zdlawren"))
+import output_index
+from output_index import find_product_files, load_index, read_journal, record_output
+from streaming_writer import stream_to_netcdf
+
+
+def write_output(root, model, experiment, init):
+    path = root / f"{model}/{experiment}/{init}/ep_fluxes/{model}_{experiment}_{init}_epfluxes.nc"
+    path.parent.mkdir(parents=True)
+    time = pd.date_range("2018-01-25 06:00", periods=4, freq="6h")
+    ds = xr.Dataset({"epfy": (("time", "lat"), np.ones((4, 2)))}, coords={"time": time, "lat": [60.0, 70.0]})
+    stream_to_netcdf(ds, path, 2)
+    return path
+
+
+def test_groups_missing_from_the_index_are_listed(tmp_path):
+    root, index_dir = tmp_path / "processed", tmp_path / "index"
+    # Written before the index existed
+    legacy = write_output(root, "GloSea6", "control", "s20180125")
+    recorded = write_output(root, "GloSea6", "control", "s20190101")
+    record_output(recorded, index_dir)
+
+    assert find_product_files("ep_fluxes", "GloSea6", root, ".nc", index_dir=index_dir) == sorted([legacy, recorded])
+    assert find_product_files("ep_fluxes", "IFS", root, ".nc", index_dir=index_dir) == []
+
+
+def test_journal_is_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(output_index, "JOURNAL_MAX_FILES", 2)
+    root, index_dir = tmp_path / "processed", tmp_path / "index"
+    paths = [write_output(root, "GloSea6", experiment, "s20180125") for experiment in ("control", "free", "nudged")]
+    for path in paths:
+        record_output(path, index_dir)
+
+    assert len(read_journal(index_dir)[0]) == 0
+    assert (index_dir / "index.csv").exists()
+    assert sorted(load_index(index_dir)["path"]) == sorted(str(path.resolve()) for path in paths)
@@ -0,0 +1,37 @@
+import pathlib
+import sys
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "zdlawren"))
+from output_validation import check_file, read_record
+from streaming_writer import append_block
+
+
+def make_dataset(steps=8):
+    time = pd.date_range("2018-01-25 06:00", periods=steps, freq="6h")
+    data = np.arange(steps * 3, dtype=np.float32).reshape(steps, 3)
+    data[5, 1] = np.nan
+    return xr.Dataset(
+        {"u": (("time", "lat"), data), "member_id": ((), "r1i1p1f1")},
+        coords={"time": time, "lat": [60.0, 70.0, 80.0]},
+    )
+
+
+def test_rewritten_blocks_replace_their_records(tmp_path):
+    ds = make_dataset()
+    path = tmp_path / "out.nc"
+    append_block(ds.isel(time=slice(0, 4)), path, 0, 8)
+    append_block(ds.isel(time=slice(4, 8)), path, 4, 8)
+    # A resumed (e.g., rewound) write of the last block
+    append_block(ds.isel(time=slice(4, 8)), path, 4, 8)
+
+    with netCDF4.Dataset(path) as nc:
+        record = read_record(nc)
+    assert record["blocks"] == [[0, 4], [4, 8]]
+    assert len(record["variables"]["u"]["checksums"]) == 2
+    assert record["variables"]["u"]["nan_count"] == 1
+    assert check_file(path, deep=True, samples=2) == []
@@ -0,0 +1,22 @@
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+from paths import lead_times
+
+
+@pytest.mark.parametrize("calendar", ["standard", "noleap", "360_day"])
+def test_lead_times_in_the_calendar_of_the_time_axis(calendar):
+    time = xr.date_range("2018-01-25", periods=5, freq="6h", calendar=calendar, use_cftime=calendar != "standard")
+    leads = lead_times(xr.DataArray(time, dims="time", name="time"), "s20180125")
+    np.testing.assert_array_equal(leads, np.arange(5) * np.timedelta64(6, "h").astype("timedelta64[ns]"))
+
+
+def test_lead_times_cross_the_end_of_a_360_day_month():
+    time = xr.date_range("2018-01-29", periods=3, freq="D", calendar="360_day", use_cftime=True)
+    leads = lead_times(xr.DataArray(time, dims="time", name="time"), "s20180125")
+    assert list(leads // np.timedelta64(1, "D")) == [4, 5, 6]
@@ -0,0 +1,43 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "zdlawren"))
+from streaming_writer import is_complete, stream_to_netcdf
+
+
+def make_dataset(steps=8):
+    time = pd.date_range("2018-01-25 06:00", periods=steps, freq="6h")
+    data = np.arange(steps * 3 * 2, dtype=np.float32).reshape(steps, 3, 2)
+    return xr.Dataset(
+        {"u": (("time", "plev", "lat"), data)},
+        coords={"time": time, "plev": [1000.0, 100.0, 10.0], "lat": [60.0, 70.0]},
+    )
+
+
+@pytest.mark.parametrize("time_block", [1, 3, 8])
+def test_stream_to_netcdf_keeps_times(tmp_path, time_block):
+    ds = make_dataset()
+    path = tmp_path / "out.nc"
+    stream_to_netcdf(ds, path, time_block)
+
+    assert is_complete(path)
+    with xr.open_dataset(path) as out:
+        np.testing.assert_array_equal(out["time"].values, ds["time"].values)
+        np.testing.assert_array_equal(out["u"].values, ds["u"].values)
+
+
+def test_stream_to_netcdf_keeps_times_with_source_units(tmp_path):
+    # Daily units with an integer dtype, as xarray would infer them
+    # from a single time step
+    ds = make_dataset()
+    ds["time"].encoding = {"units": "days since 2018-01-25", "dtype": "int64"}
+    path = tmp_path / "out.nc"
+    stream_to_netcdf(ds, path, 1)
+
+    with xr.open_dataset(path) as out:
+        np.testing.assert_array_equal(out["time"].values, ds["time"].values)
@@ -0,0 +1,54 @@
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts" / "zdlawren"))
+from timeseries_store import build_store, get_series
+
+
+def write_compiled(root, model, experiment, init, calendar, steps=4):
+    path = root / f"{model}/{experiment}/{init}/zonal_means/{model}_{experiment}_{init}_zonalmeans.nc"
+    path.parent.mkdir(parents=True)
+    time = xr.date_range("2018-02-29" if calendar == "360_day" else "2018-02-28", periods=steps, freq="6h",
+                         calendar=calendar, use_cftime=calendar != "standard")
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset(
+        {
+            "u": (("member_id", "time", "plev", "lat"), rng.standard_normal((2, steps, 2, 3))),
+            "uw": (("member_id", "wavenum", "time", "plev", "lat"), rng.standard_normal((2, 2, steps, 2, 3))),
+        },
+        coords={
+            "member_id": ["r1i1p1f1", "r2i1p1f1"], "time": time, "wavenum": [1, 2],
+            "plev": [10000.0, 1000.0], "lat": [50.0, 60.0, 70.0],
+        },
+    )
+    ds.to_netcdf(path)
+    return path, ds
+
+
+@pytest.mark.parametrize("calendar", ["standard", "360_day"])
+def test_series_keep_the_calendar_of_the_runs(tmp_path, calendar):
+    path, ds = write_compiled(tmp_path, "UKESM", "control", "s20180228", calendar)
+    build_store("UKESM", [path], tmp_path / "store")
+
+    series = get_series("UKESM", "u", 1000.0, 60, store_root=tmp_path / "store")
+    np.testing.assert_allclose(series.isel(run=0).values, ds["u"].sel(plev=1000.0, lat=60).values, rtol=1e-6)
+    assert list(series["valid_time"].isel(run=0).values) == list(ds["time"].values)
+
+    series = get_series("UKESM", "uw", 1000.0, 60, store_root=tmp_path / "store", wavenum=2)
+    np.testing.assert_allclose(series.isel(run=0).values, ds["uw"].sel(plev=1000.0, lat=60, wavenum=2).values, rtol=1e-6)
+
+
+def test_selections_are_validated(tmp_path):
+    path, _ = write_compiled(tmp_path, "UKESM", "control", "s20180228", "standard")
+    build_store("UKESM", [path], tmp_path / "store")
+
+    with pytest.raises(ValueError, match="select one of its values with wavenum"):
+        get_series("UKESM", "uw", 1000.0, 60, store_root=tmp_path / "store")
+    with pytest.raises(ValueError, match="No wavenum 3"):
+        get_series("UKESM", "uw", 1000.0, 60, store_root=tmp_path / "store", wavenum=3)
+    with pytest.raises(ValueError, match="no dims"):
+        get_series("UKESM", "u", 1000.0, 60, store_root=tmp_path / "store", wavenum=1)
@@ -0,0 +1,57 @@
+import pathlib
+import sys
+
+import numpy as np
+import pytest
+import xarray as xr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1] / "scripts"))
+from vertical_interpolation import log_pressure_interpolation
+
+
+def reference_interpolation(da, plev, ps=100000):
+    # The original formulation: xarray.interp along -log(p/ps)
+    tmp = da.copy()
+    tmp["plev"] = -np.log(tmp.plev / ps)
+    tmp = tmp.interp(plev=-np.log(plev / ps))
+    tmp["plev"] = plev
+    return tmp
+
+
+def make_levels(source, nan=False):
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((4, len(source), 3))
+    if nan:
+        data[:, 2, 1] = np.nan
+        data[1, 0, 0] = np.nan
+    return xr.DataArray(data, coords={"plev": source}, dims=["time", "plev", "lat"], name="zg")
+
+
+# Targets between, on and beyond the source levels
+TARGET = np.array([120000.0, 100000.0, 85000.0, 50000.0, 30000.0, 10000.0, 7000.0, 1000.0, 500.0])
+
+
+@pytest.mark.parametrize("source", [
+    [100000.0, 85000.0, 50000.0, 25000.0, 10000.0, 1000.0],
+    [1000.0, 10000.0, 25000.0, 50000.0, 85000.0, 100000.0],
+])
+@pytest.mark.parametrize("nan", [False, True])
+def test_interpolation_matches_xarray_interp(source, nan):
+    da = make_levels(source, nan)
+    expected = reference_interpolation(da, TARGET)
+
+    result = log_pressure_interpolation(da, TARGET)
+    assert result.dims == expected.dims
+    np.testing.assert_array_equal(result["plev"].values, TARGET)
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-12, atol=1e-12)
+
+    lazy = log_pressure_interpolation(da.chunk({"time": 1}), TARGET)
+    assert lazy.chunks is not None
+    np.testing.assert_allclose(lazy.values, expected.values, rtol=1e-12, atol=1e-12)
+
+
+def test_interpolation_from_snap34_levels():
+    da = make_levels([100000.0, 50000.0, 10000.0, 1000.0])
+    expected = reference_interpolation(da, TARGET)
+    result = log_pressure_interpolation(da.rename(plev="snap34"), TARGET)
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-12, atol=1e-12)